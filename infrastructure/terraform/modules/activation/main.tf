@@ -435,6 +435,7 @@ module "trigger_function_account" {
     "${module.project_services.project_id}=>roles/dataflow.admin",
     "${module.project_services.project_id}=>roles/dataflow.worker",
     "${module.project_services.project_id}=>roles/bigquery.dataEditor",
+    "${module.project_services.project_id}=>roles/bigquery.jobUser",
     "${module.project_services.project_id}=>roles/pubsub.editor",
     "${module.project_services.project_id}=>roles/storage.admin",
     "${module.project_services.project_id}=>roles/artifactregistry.reader",
@@ -904,10 +905,26 @@ resource "google_pubsub_topic" "activation_trigger" {
 }
 
 # This data resource generates a ZIP archive file containing the contents of the specified source_dir directory
+# When direct_send_max_rows is set, the trigger function archive also packages the activation application and its
+# apache-beam requirements, which the function uses to activate small source tables without launching a Dataflow job.
 data "archive_file" "activation_trigger_source" {
   type        = "zip"
   output_path = "${local.trigger_function_dir}/${local.source_archive_file}"
-  source_dir  = "${local.trigger_function_dir}/trigger_activation"
+  source {
+    content  = file("${local.trigger_function_dir}/trigger_activation/main.py")
+    filename = "main.py"
+  }
+  source {
+    content = join("", concat(
+      [file("${local.trigger_function_dir}/trigger_activation/requirements.txt")],
+      var.direct_send_max_rows > 0 ? [file("${local.trigger_function_dir}/trigger_activation/requirements-direct.txt")] : []
+    ))
+    filename = "requirements.txt"
+  }
+  source {
+    content  = var.direct_send_max_rows > 0 ? file("${local.pipeline_source_dir}/main.py") : "# Direct activations are disabled, see direct_send_max_rows.\n"
+    filename = "activation_pipeline.py"
+  }
 }
 
 # This module creates a Cloud Sorage bucket and sets the trigger_function_account_email as the admin.
@@ -978,9 +995,9 @@ resource "google_cloudfunctions2_function" "activation_trigger_cf" {
 
   # Service endpoint configuration for the Cloud Function
   service_config {
-    available_memory      = "256M"
+    available_memory      = "1G"
     max_instance_count    = 3
-    timeout_seconds       = 60
+    timeout_seconds       = 540
     ingress_settings      = "ALLOW_INTERNAL_ONLY"
     service_account_email = module.trigger_function_account.email
     environment_variables = {
@@ -991,6 +1008,9 @@ resource "google_cloudfunctions2_function" "activation_trigger_cf" {
       PIPELINE_TEMP_LOCATION        = "gs://${module.pipeline_bucket.name}/tmp/"
       LOG_DATA_SET                  = module.bigquery.bigquery_dataset.dataset_id
       PIPELINE_WORKER_EMAIL         = module.pipeline_service_account.email
+      DIRECT_SEND_MAX_ROWS          = tostring(var.direct_send_max_rows)
+      LAUNCH_LEASE_LOCATION         = "gs://${module.pipeline_bucket.name}/activation-launch-leases/"
+      LAUNCH_DEDUP_WINDOW_SECONDS   = "3600"
     }
     # Sets the environment variables from the secrets stored on Secret Manager
     secret_environment_variables {
@@ -86,3 +86,9 @@ variable "project_owner_email" {
   description = "Email address of the project owner."
   type        = string
 }
+
+variable "direct_send_max_rows" {
+  description = "Maximum number of rows of a source table activated by the trigger function without Dataflow. 0 disables it and leaves apache-beam out of the function build."
+  type        = number
+  default     = 10000
+}
@@ -0,0 +1,589 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Offline benchmarks for the activation pipeline.
+
+The benchmarks run against a local stand-in for the Measurement Protocol API, so they never reach Google Analytics 4.
+
+Usage:
+  python benchmark.py sessions --requests 2000
+  python benchmark.py senders --requests 2000 --latency_ms 20 --concurrency 16
+  python benchmark.py payloads --rows 100000 --columns 60
+  python benchmark.py batches --rows 50000 --pipeline_rows 10000 --columns 60
+  python benchmark.py compression --requests 2000 --columns 60 --events_per_request 1 25 --levels 0 1 6 9
+  python benchmark.py pipeline --rows 5000 --latency_ms 20 --error_rate 0.01 --throttle_rate 0.02 -- --send_concurrency=16
+
+Arguments after `--` are passed to the activation pipeline options of the `pipeline` benchmark.
+"""
+import argparse
+import collections
+import contextlib
+import gzip
+import json
+import random
+import resource
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import apache_beam as beam
+import requests
+
+from apache_beam.options.pipeline_options import PipelineOptions
+
+from main import ActivationOptions, CallMeasurementProtocolAPI, TransformToPayload, send_and_log, send_to_measurement_protocol
+from main import EnforcePayloadLimits, encode_payload, TransformToPayloadBatch, ToLogFormat, ToLogFormatBatch
+
+
+class MeasurementProtocolStandIn:
+  """
+  This class defines a local HTTP server that mimics the Measurement Protocol `/mp/collect` and `/debug/mp/collect` endpoints.
+
+  The server answers `204 No Content` on `/mp/collect` and an empty validation result on `/debug/mp/collect`.
+  It supports HTTP/1.1 keep-alive, so clients that reuse connections can be compared with clients that do not.
+  A fraction of the requests can be answered with `500 Internal Server Error` or `429 Too Many Requests`
+  to exercise the retry and rate limiting logic of the senders. Request bodies sent with `Content-Encoding: gzip`
+  are decompressed, and answered with `400 Bad Request` if they are not valid gzip.
+  """
+
+  def __init__(self, latency_ms=0, error_rate=0.0, throttle_rate=0.0, retry_after=None, seed=0):
+    """
+    Initializes the server on a free local port.
+
+    Args:
+      latency_ms: The time the server waits before answering each request, in milliseconds.
+      error_rate: The fraction of requests answered with a 500 status code.
+      throttle_rate: The fraction of requests answered with a 429 status code.
+      retry_after: The value of the `Retry-After` header of the 429 responses, if any.
+      seed: The seed of the random generator selecting the failing requests.
+    """
+    self.latency_ms = latency_ms
+    self.error_rate = error_rate
+    self.throttle_rate = throttle_rate
+    self.retry_after = retry_after
+    self.request_count = 0
+    self.bytes_received = 0
+    self.bytes_decoded = 0
+    self.status_counts = collections.Counter()
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+    self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+    self.server.daemon_threads = True
+    self.endpoint = f"http://127.0.0.1:{self.server.server_address[1]}"
+    self._thread = None
+
+
+  def _handler_class(self):
+    """
+    Builds the request handler class bound to this server instance.
+
+    Returns:
+      A `BaseHTTPRequestHandler` subclass.
+    """
+    stand_in = self
+
+    class Handler(BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        received = len(data)
+        malformed = False
+        if self.headers.get('Content-Encoding') == 'gzip':
+          try:
+            data = gzip.decompress(data)
+          except (OSError, EOFError):
+            malformed = True
+        if stand_in.latency_ms:
+          time.sleep(stand_in.latency_ms / 1000)
+        with stand_in._lock:
+          stand_in.request_count += 1
+          stand_in.bytes_received += received
+          stand_in.bytes_decoded += len(data)
+          draw = stand_in._random.random()
+        body = b''
+        if malformed:
+          status = 400
+        elif draw < stand_in.throttle_rate:
+          status = 429
+        elif draw < stand_in.throttle_rate + stand_in.error_rate:
+          status = 500
+        elif self.path.startswith('/debug/mp/collect'):
+          status = 200
+          body = json.dumps({'validationMessages': []}).encode()
+        elif self.path.startswith('/mp/collect'):
+          status = 204
+        else:
+          status = 404
+        with stand_in._lock:
+          stand_in.status_counts[status] += 1
+        self.send_response(status)
+        if status == 429 and stand_in.retry_after is not None:
+          self.send_header('Retry-After', str(stand_in.retry_after))
+        if body:
+          self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    return Handler
+
+
+  def __enter__(self):
+    self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+
+  def __exit__(self, *exc_info):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+
+
+def sample_payload(index):
+  """
+  Builds a synthetic Measurement Protocol payload.
+
+  Args:
+    index: The index of the payload, used to derive a unique client id.
+
+  Returns:
+    A dictionary containing the Measurement Protocol payload.
+  """
+  return {
+    'client_id': f"{index}.{1700000000 + index}",
+    'timestamp_micros': 1677283200000000,
+    'non_personalized_ads': False,
+    'consent': {'ad_user_data': 'GRANTED', 'ad_personalization': 'GRANTED'},
+    'user_properties': {'p_p_decile': {'value': str(index % 10 + 1)}},
+    'events': [{'name': 'maj_benchmark', 'params': {'p_p_prediction': 'true'}}]
+  }
+
+
+def sample_row(index, columns):
+  """
+  Builds a synthetic row of an activation source query.
+
+  Args:
+    index: The index of the row, used to derive a unique client id.
+    columns: The total number of columns of the row. Half of the extra columns are user properties and half are event parameters.
+
+  Returns:
+    A dictionary containing the row.
+  """
+  row = {
+    'client_id': f"{index}.{1700000000 + index}",
+    'user_id': None if index % 2 else f"user-{index}",
+    'inference_date': '2023-02-25',
+  }
+  for column in range(max(0, columns - len(row))):
+    if column % 2:
+      row[f"event_param_param_{column}"] = index % 100 if column % 3 else f"value-{column}"
+    else:
+      row[f"user_prop_property_{column}"] = index % 10 if column % 3 else f"value-{column}"
+  return row
+
+
+def benchmark_payloads(args):
+  """
+  Measures the rows per second converted to payloads by `TransformToPayload`.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with the rows per second of the element path.
+  """
+  rows = [sample_row(i, args.columns) for i in range(args.rows)]
+  transform = TransformToPayload('maj_benchmark')
+  transform.setup()
+  transform.start_bundle()
+  start = time.process_time()
+  for row in rows:
+    for _ in transform.process(row):
+      pass
+  return {'rows': args.rows, 'columns': args.columns, 'rows_per_cpu_sec': args.rows / (time.process_time() - start)}
+
+
+def benchmark_batches(args):
+  """
+  Compares the CPU time per million rows of the element and the batched payload building and log formatting.
+
+  The DoFns are measured by calling them directly on `rows` rows, with lists of `batch_size` rows for the batched ones,
+  and in a DirectRunner pipeline on `pipeline_rows` rows, where Beam buffers the elements of the batched DoFns into lists.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with the CPU seconds per million rows of each path.
+  """
+  rows = [sample_row(i, args.columns) for i in range(args.rows)]
+  per_million = 1e6 / args.rows
+  results = {'rows': args.rows, 'pipeline_rows': min(args.rows, args.pipeline_rows), 'columns': args.columns}
+
+  transform = TransformToPayload('maj_benchmark')
+  transform.start_bundle()
+  log_format = ToLogFormat(run_id='benchmark')
+  start = time.process_time()
+  payloads = [payload for row in rows for payload in transform.process(row)]
+  results['element_payload_cpu_sec_per_million'] = (time.process_time() - start) * per_million
+  responses = [(payload, 204, b'', encode_payload(payload)) for payload in payloads]
+  start = time.process_time()
+  for response in responses:
+    for _ in log_format.process(response):
+      pass
+  results['element_log_cpu_sec_per_million'] = (time.process_time() - start) * per_million
+
+  batch_transform = TransformToPayloadBatch('maj_benchmark')
+  batch_transform.start_bundle()
+  batch_log_format = ToLogFormatBatch(run_id='benchmark')
+  start = time.process_time()
+  batch_payloads = [
+    payload
+    for i in range(0, len(rows), args.batch_size)
+    for batch in batch_transform.process_batch(rows[i:i + args.batch_size])
+    for payload in batch
+  ]
+  results['batched_payload_cpu_sec_per_million'] = (time.process_time() - start) * per_million
+  assert batch_payloads == payloads
+  start = time.process_time()
+  for i in range(0, len(responses), args.batch_size):
+    for _ in batch_log_format.process_batch(responses[i:i + args.batch_size]):
+      pass
+  results['batched_log_cpu_sec_per_million'] = (time.process_time() - start) * per_million
+
+  for name, transform_class, log_format_class in (
+      ('element', TransformToPayload, ToLogFormat), ('batched', TransformToPayloadBatch, ToLogFormatBatch)):
+    start = time.process_time()
+    with beam.Pipeline() as p:
+      _ = (p
+      | beam.Create(rows[:args.pipeline_rows])
+      | 'Prepare Measurement Protocol API payload' >> beam.ParDo(transform_class('maj_benchmark'))
+      | 'Simulate responses' >> beam.Map(lambda payload: (payload, 204, b''))
+      | 'Transform log format' >> beam.ParDo(log_format_class(run_id='benchmark'))
+      )
+    results[f'{name}_pipeline_cpu_sec_per_million'] = (time.process_time() - start) * 1e6 / min(args.rows, args.pipeline_rows)
+
+  return {key: round(value, 2) if isinstance(value, float) else value for key, value in results.items()}
+
+
+@contextlib.contextmanager
+def recording_send_latencies():
+  """
+  Records the latency of every Measurement Protocol request sent by the senders while the context is active.
+
+  The DirectRunner runs in-process, so wrapping `CallMeasurementProtocolAPI.send` also covers the batched
+  and concurrent senders, which inherit it.
+
+  Yields:
+    The list where latencies are appended, in milliseconds.
+  """
+  latencies = []
+  send = CallMeasurementProtocolAPI.send
+
+  def timed_send(self, data):
+    start = time.perf_counter()
+    try:
+      return send(self, data)
+    finally:
+      latencies.append((time.perf_counter() - start) * 1000)
+
+  CallMeasurementProtocolAPI.send = timed_send
+  try:
+    yield latencies
+  finally:
+    CallMeasurementProtocolAPI.send = send
+
+
+def percentile(values, fraction):
+  """
+  Computes a percentile with the nearest-rank method.
+
+  Args:
+    values: The list of values.
+    fraction: The percentile, between 0 and 1.
+
+  Returns:
+    The percentile, or None if there are no values.
+  """
+  if not values:
+    return None
+  ordered = sorted(values)
+  return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def benchmark_pipeline(args):
+  """
+  Runs the transform, send and log steps of the activation pipeline on the DirectRunner over synthetic rows.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with the events per second, the send latency percentiles, the response status counts and the peak RSS.
+  """
+  rows = [sample_row(i, args.columns) for i in range(args.rows)]
+  with MeasurementProtocolStandIn(latency_ms=args.latency_ms, error_rate=args.error_rate, throttle_rate=args.throttle_rate, retry_after=args.retry_after) as stand_in:
+    options = activation_options(stand_in.endpoint, *args.pipeline_args)
+    with recording_send_latencies() as latencies:
+      start = time.perf_counter()
+      with beam.Pipeline(options=options) as p:
+        payloads = (p
+        | beam.Create(rows)
+        | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload('maj_benchmark'))
+        )
+        _ = send_and_log(payloads, options.view_as(ActivationOptions), 'benchmark')
+      elapsed = time.perf_counter() - start
+
+  return {
+    'rows': args.rows,
+    'pipeline_args': args.pipeline_args,
+    'elapsed_sec': elapsed,
+    'events_per_sec': args.rows / elapsed,
+    'requests': stand_in.request_count,
+    'status_counts': dict(stand_in.status_counts),
+    'send_latency_p50_ms': percentile(latencies, 0.5),
+    'send_latency_p99_ms': percentile(latencies, 0.99),
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+
+
+def benchmark_sessions(args):
+  """
+  Compares the request rate of one `requests.post` per event with the pooled session of `CallMeasurementProtocolAPI`.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with the requests per second of each sender.
+  """
+  results = {}
+  with MeasurementProtocolStandIn() as stand_in:
+    sender = CallMeasurementProtocolAPI('G-BENCHMARK', 'secret', endpoint=stand_in.endpoint, initial_send_rate=args.initial_send_rate)
+
+    start = time.perf_counter()
+    for i in range(args.requests):
+      requests.post(sender.event_post_url, data=json.dumps(sample_payload(i)), headers={'content-type': 'application/json'}, timeout=20)
+    results['requests_post_per_sec'] = args.requests / (time.perf_counter() - start)
+
+    sender.setup()
+    try:
+      start = time.perf_counter()
+      for i in range(args.requests):
+        sender.send(encode_payload(sample_payload(i)))
+      results['pooled_session_per_sec'] = args.requests / (time.perf_counter() - start)
+    finally:
+      sender.teardown()
+
+  return results
+
+
+def sample_request_bodies(requests_count, columns, events_per_request):
+  """
+  Builds the JSON encoded bodies of synthetic Measurement Protocol requests.
+
+  Args:
+    requests_count: The number of requests.
+    columns: The number of columns of the source rows the events are built from.
+    events_per_request: The number of events carried by each request, built from consecutive rows.
+
+  Returns:
+    A list of request bodies.
+  """
+  transform = TransformToPayload('maj_benchmark')
+  transform.start_bundle()
+  enforce_limits = EnforcePayloadLimits()
+  payloads = [
+    limited
+    for i in range(requests_count * events_per_request)
+    for payload in transform.process(sample_row(i, columns))
+    for limited in enforce_limits.process(payload)
+  ]
+  return [
+    encode_payload(dict(payloads[i], events=[payload['events'][0] for payload in payloads[i:i + events_per_request]]))
+    for i in range(0, len(payloads), events_per_request)
+  ]
+
+
+def benchmark_compression(args):
+  """
+  Measures the CPU cost and the bytes saved by the gzip compression of the request bodies at each level.
+
+  The break-even bandwidth is the network throughput at which sending the saved bytes takes as long as compressing
+  them on one core: compression pays off on links slower than it, per core sending requests.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with, for each number of events per request and each level, the mean request size, the CPU time of
+    the compression per request, the break-even bandwidth and the requests per second sent to the stand-in.
+  """
+  results = {}
+  for events_per_request in args.events_per_request:
+    bodies = sample_request_bodies(args.requests, args.columns, events_per_request)
+    raw_bytes = sum(len(body) for body in bodies)
+    for level in args.levels:
+      start = time.process_time()
+      compressed_bytes = sum(len(gzip.compress(body, compresslevel=level, mtime=0)) for body in bodies) if level else raw_bytes
+      compress_sec = time.process_time() - start if level else 0.0
+
+      with MeasurementProtocolStandIn(latency_ms=args.latency_ms) as stand_in:
+        sender = CallMeasurementProtocolAPI('G-BENCHMARK', 'secret', endpoint=stand_in.endpoint, initial_send_rate=1e6, gzip_level=level)
+        sender.setup()
+        try:
+          start = time.perf_counter()
+          for body in bodies:
+            sender.send(body)
+          elapsed = time.perf_counter() - start
+        finally:
+          sender.teardown()
+      assert stand_in.bytes_decoded == raw_bytes and stand_in.status_counts == {204: len(bodies)}
+
+      saved_bytes = raw_bytes - compressed_bytes
+      results[f'events_{events_per_request}_level_{level}'] = {
+        'request_bytes': round(compressed_bytes / len(bodies)),
+        'ratio': round(compressed_bytes / raw_bytes, 3),
+        'compress_us_per_request': round(compress_sec / len(bodies) * 1e6, 1),
+        'break_even_mbps_per_core': round(saved_bytes * 8 / compress_sec / 1e6, 1) if compress_sec else None,
+        'requests_per_sec': round(len(bodies) / elapsed),
+      }
+  return results
+
+
+def activation_options(endpoint, *extra_args):
+  """
+  Builds pipeline options for a benchmark run against the local stand-in.
+
+  Args:
+    endpoint: The base URL of the local stand-in.
+    *extra_args: Additional command-line arguments of the activation pipeline.
+
+  Returns:
+    The pipeline options.
+  """
+  return PipelineOptions([
+    '--project=benchmark',
+    '--source_table=benchmark.source',
+    '--ga4_measurement_id=G-BENCHMARK',
+    '--ga4_api_secret=secret',
+    '--log_db_dataset=benchmark',
+    '--activation_type=benchmark',
+    '--activation_type_configuration=gs://benchmark/config.json',
+    f'--measurement_protocol_endpoint={endpoint}',
+    *extra_args
+  ])
+
+
+def run_send_step(payloads, options):
+  """
+  Runs the Measurement Protocol send step of the activation pipeline on the DirectRunner.
+
+  Args:
+    payloads: The list of payloads to send.
+    options: The pipeline options.
+
+  Returns:
+    The elapsed time in seconds.
+  """
+  start = time.perf_counter()
+  with beam.Pipeline(options=options) as p:
+    _ = send_to_measurement_protocol(p | beam.Create(payloads), options.view_as(ActivationOptions))
+  return time.perf_counter() - start
+
+
+def benchmark_senders(args):
+  """
+  Compares the events per second of the sequential and the concurrent Measurement Protocol senders.
+
+  Args:
+    args: The parsed command-line arguments.
+
+  Returns:
+    A dictionary with the events per second of each sender.
+  """
+  payloads = [sample_payload(i) for i in range(args.requests)]
+  results = {}
+  with MeasurementProtocolStandIn(latency_ms=args.latency_ms) as stand_in:
+    rate = f'--initial_send_rate={args.initial_send_rate}'
+    elapsed = run_send_step(payloads, activation_options(stand_in.endpoint, rate))
+    results['sequential_events_per_sec'] = args.requests / elapsed
+    elapsed = run_send_step(payloads, activation_options(stand_in.endpoint, rate, f'--send_concurrency={args.concurrency}'))
+    results[f'concurrent_{args.concurrency}_events_per_sec'] = args.requests / elapsed
+  return results
+
+
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline benchmarks for the activation pipeline')
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  sessions = subparsers.add_parser('sessions', help='requests/sec with and without a pooled HTTP session')
+  sessions.add_argument('--requests', type=int, default=2000)
+  sessions.add_argument('--initial_send_rate', type=float, default=1e6)
+  sessions.set_defaults(func=benchmark_sessions)
+
+  senders = subparsers.add_parser('senders', help='events/sec of the sequential and the concurrent senders')
+  senders.add_argument('--requests', type=int, default=2000)
+  senders.add_argument('--latency_ms', type=float, default=20)
+  senders.add_argument('--concurrency', type=int, default=16)
+  senders.add_argument('--initial_send_rate', type=float, default=1e6)
+  senders.set_defaults(func=benchmark_senders)
+
+  payloads = subparsers.add_parser('payloads', help='rows/sec of the payload builder')
+  payloads.add_argument('--rows', type=int, default=100000)
+  payloads.add_argument('--columns', type=int, default=60)
+  payloads.set_defaults(func=benchmark_payloads)
+
+  batches = subparsers.add_parser('batches', help='CPU per million rows of the element and the batched DoFns')
+  batches.add_argument('--rows', type=int, default=50000)
+  batches.add_argument('--columns', type=int, default=60)
+  batches.add_argument('--batch_size', type=int, default=4096)
+  batches.add_argument('--pipeline_rows', type=int, default=10000)
+  batches.set_defaults(func=benchmark_batches)
+
+  compression = subparsers.add_parser('compression', help='CPU cost and bytes saved by the gzip compression of the request bodies')
+  compression.add_argument('--requests', type=int, default=2000)
+  compression.add_argument('--columns', type=int, default=60)
+  compression.add_argument('--events_per_request', type=int, nargs='+', default=[1, 25])
+  compression.add_argument('--levels', type=int, nargs='+', default=[0, 1, 6, 9])
+  compression.add_argument('--latency_ms', type=float, default=0)
+  compression.set_defaults(func=benchmark_compression)
+
+  pipeline = subparsers.add_parser('pipeline', help='events/sec, send latency and peak RSS of the transform/send/log graph')
+  pipeline.add_argument('--rows', type=int, default=5000)
+  pipeline.add_argument('--columns', type=int, default=20)
+  pipeline.add_argument('--latency_ms', type=float, default=20)
+  pipeline.add_argument('--error_rate', type=float, default=0.0)
+  pipeline.add_argument('--throttle_rate', type=float, default=0.0)
+  pipeline.add_argument('--retry_after', type=float, default=None)
+  pipeline.add_argument('pipeline_args', nargs='*', help='activation pipeline options, after --')
+  pipeline.set_defaults(func=benchmark_pipeline)
+
+  args = parser.parse_args()
+  print(json.dumps(args.func(args), indent=2))
+
+
+if __name__ == '__main__':
+  main()
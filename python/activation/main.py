@@ -11,12 +11,27 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import concurrent.futures
+import email.utils
+import functools
+import gzip
+import hashlib
 import logging
+import os
+import random
 import re
+import tempfile
+import threading
+import time
 import traceback
+import zlib
 
 from apache_beam.io.gcp.internal.clients import bigquery
 from apache_beam.options.pipeline_options import GoogleCloudOptions
+from apache_beam.options.pipeline_options import StandardOptions
+from apache_beam.utils.timestamp import Timestamp
+from apache_beam.utils.windowed_value import WindowedValue
 import apache_beam as beam
 
 import json
@@ -25,9 +40,116 @@ import uuid
 import datetime
 
 from decimal import Decimal
+from google.cloud import bigquery as google_bigquery
 from google.cloud import storage
 from jinja2 import Environment, BaseLoader
 
+try:
+  import orjson
+except ImportError:
+  # Payloads are encoded with the standard library when orjson is not installed.
+  orjson = None
+
+# Formats of the inference dates of the source data.
+DATE_FORMAT = "%Y-%m-%d"
+DATE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f %Z"
+# Prefixes of the source columns sent as user properties and event parameters.
+USER_PROPERTY_PREFIX = 'user_prop_'
+EVENT_PARAMETER_PREFIX = 'event_param_'
+# Columns of the source data read by TransformToPayload, besides the user properties and event parameters.
+PAYLOAD_COLUMNS = ('client_id', 'user_id', 'inference_date')
+# Bad shaping strings removed from the client ids of the source data.
+CLIENT_ID_BAD_STRINGS = (
+  '<img onerror="_exploit_dom_xss(20007)',
+  '<img onerror="_exploit_dom_xss(20023)',
+  '<img onerror="_exploit_dom_xss(20013)',
+  '<img onerror="_exploit_dom_xss(20010)',
+  'q="><script>_exploit_dom_xss(40007)</script>',
+  'q="><script>_exploit_dom_xss(40013)</script>',
+)
+CLIENT_ID_SANITIZER = re.compile('|'.join(re.escape(bad_string) for bad_string in CLIENT_ID_BAD_STRINGS))
+# Name of the day-partitioned table where all the activation runs are logged.
+ACTIVATION_LOG_TABLE = 'activation_log'
+# Schema of the activation log table.
+LOG_TABLE_SCHEMA = {
+  'fields': [{
+    'name': 'id', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'activation_id', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'payload', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'latest_state', 'type': 'STRING', 'mode': 'REQUIRED'
+    }, {
+    'name': 'updated_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED'
+    }, {
+    'name': 'run_id', 'type': 'STRING', 'mode': 'NULLABLE'
+  }]
+}
+# Local directory where configuration files and query templates read from GCS are cached by generation.
+CONFIG_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'activation_config_cache')
+# Namespace of the Beam metrics reported by the activation pipeline.
+METRICS_NAMESPACE = 'activation'
+# Base URL of the Measurement Protocol API.
+MEASUREMENT_PROTOCOL_ENDPOINT = 'https://www.google-analytics.com'
+# Name of the Pub/Sub message attribute carrying the activation type of a prediction event.
+ACTIVATION_TYPE_ATTRIBUTE = 'activation_type'
+# Maximum time a streaming activation buffers events before sending an incomplete batch, in seconds.
+STREAMING_BATCH_BUFFERING_SECONDS = 1
+# Interval between the writes of a streaming activation to the activation log table, in seconds.
+STREAMING_LOG_TRIGGERING_FREQUENCY_SECONDS = 10
+# Maximum number of events accepted by the Measurement Protocol API in a single request.
+MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST = 25
+# Limits of the Measurement Protocol API on the size of a request and on the contents of its events.
+MEASUREMENT_PROTOCOL_MAX_REQUEST_BYTES = 130000
+MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES = 25
+MEASUREMENT_PROTOCOL_MAX_EVENT_PARAMS = 25
+MEASUREMENT_PROTOCOL_MAX_EVENT_NAME_LENGTH = 40
+MEASUREMENT_PROTOCOL_MAX_PARAM_NAME_LENGTH = 40
+MEASUREMENT_PROTOCOL_MAX_PARAM_VALUE_LENGTH = 100
+MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_NAME_LENGTH = 24
+MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_VALUE_LENGTH = 36
+# Names reserved by Google Analytics 4, which the Measurement Protocol API does not accept.
+MEASUREMENT_PROTOCOL_RESERVED_EVENT_NAMES = frozenset((
+  'ad_activeview', 'ad_click', 'ad_exposure', 'ad_impression', 'ad_query', 'ad_reward', 'adunit_exposure',
+  'app_background', 'app_clear_data', 'app_exception', 'app_install', 'app_remove', 'app_store_refund',
+  'app_update', 'app_upgrade', 'dynamic_link_app_open', 'dynamic_link_app_update', 'dynamic_link_first_open',
+  'error', 'firebase_campaign', 'firebase_in_app_message_action', 'firebase_in_app_message_dismiss',
+  'firebase_in_app_message_impression', 'first_open', 'first_visit', 'in_app_purchase', 'notification_dismiss',
+  'notification_foreground', 'notification_open', 'notification_receive', 'notification_send', 'os_update',
+  'screen_view', 'session_start', 'user_engagement',
+))
+MEASUREMENT_PROTOCOL_RESERVED_PARAM_NAMES = frozenset(('firebase_conversion',))
+MEASUREMENT_PROTOCOL_RESERVED_USER_PROPERTY_NAMES = frozenset((
+  'first_open_after_install', 'first_open_time', 'first_visit_time', 'last_deep_link_referrer', 'user_id',
+))
+MEASUREMENT_PROTOCOL_RESERVED_PREFIXES = ('firebase_', 'ga_', 'google_')
+# Valid event, parameter and user property names: a letter followed by letters, digits and underscores.
+MEASUREMENT_PROTOCOL_NAME = re.compile('[A-Za-z][A-Za-z0-9_]*')
+# Status code reported for the payloads rejected by the local validation, which are not sent.
+INVALID_PAYLOAD = requests.status_codes.codes.BAD_REQUEST
+# Status code reported for the requests exceeding MEASUREMENT_PROTOCOL_MAX_REQUEST_BYTES, which are not sent.
+REQUEST_TOO_LARGE = requests.status_codes.codes.REQUEST_ENTITY_TOO_LARGE
+# Column of the source query result holding the rank of a row, 1 being the first row to be sent.
+PRIORITY_COLUMN = 'activation_priority'
+# Log states of the payloads that were not sent because the event budget or the deadline of the run was exhausted.
+SKIPPED_BUDGET = 'SKIPPED_BUDGET'
+SKIPPED_DEADLINE = 'SKIPPED_DEADLINE'
+
+def parse_bool(value):
+  """
+  Parses the value of a boolean command-line flag.
+
+  Args:
+    value: The value of the flag, e.g. `true`, `false`, `1` or `0`.
+
+  Returns:
+    True if the value is `1`, `true` or `yes`, in any case, False otherwise.
+  """
+  return value.lower() in ('1', 'true', 'yes')
+
+
+
 
 class ActivationOptions(GoogleCloudOptions):
   """
@@ -63,14 +185,44 @@ class ActivationOptions(GoogleCloudOptions):
         - purchase-propensity-15-7
         - churn-propensity-30-15
         - lead-score-propensity-5-1
-      activation_type_configuration: The GCS path to the configuration file for all activation types.
+      activation_type_configuration: The GCS path, or the file:// path, to the configuration file for all activation types.
+      events_per_request: The maximum number of events packed into a single Measurement Protocol request.
+        Values greater than 1 enable batched delivery, which only saves requests when a client id appears several times,
+        e.g. in the activations of several activation types.
+      http_pool_size: The maximum number of pooled HTTP connections kept open by each sender.
+      gzip_level: The gzip compression level of the request bodies, from 1 to 9. 0 sends them uncompressed.
+      measurement_protocol_endpoint: The base URL of the Measurement Protocol API.
+      send_concurrency: The maximum number of Measurement Protocol requests in flight per worker.
+      validation_sample_rate: The fraction of the payloads also sent to the Measurement Protocol validation server,
+        whose validation messages are logged and counted.
+      send_shards: The number of shards the payloads are spread over before they are sent one event per request.
+        0 keeps the payloads on the workers that read them.
+      initial_send_rate: The initial send rate of each worker process, in requests per second. It adapts to the responses of the API.
+      max_send_retries: The maximum number of retries of a request throttled with a 429 or 5xx response.
+      replay_table: A comma-separated list of retry log tables whose failed payloads are sent again instead of
+        reading the source table.
+      skip_delivered: A boolean flag indicating whether to drop the payloads already delivered by a previous run.
+      replay_run_id: A comma-separated list of activation run ids whose failed payloads are sent again instead of
+        reading the source table.
+      log_write_method: The method used to write to the activation log table.
+      read_method: The method used to read the query results, either EXPORT or DIRECT_READ.
+      activations: A JSON list of {"activation_type": ..., "source_table": ...} objects activated in a single job.
+        Replaces source_table and activation_type.
+      input_subscription: The Pub/Sub subscription of the row-level prediction events activated by a streaming job.
+        Replaces source_table.
+      priority_expression: The SQL ordering expression over the source columns ranking the rows, the first rows being
+        the highest priority ones. It requires `max_events`.
+      max_events: The maximum number of events sent per activation. The rows ranked below the budget are logged as skipped.
+      send_deadline_seconds: The number of seconds after the launch of the job after which no more events are sent.
+        The payloads not sent by then are logged as skipped, whatever their priority.
+      batched_transforms: A boolean flag indicating whether to build the payloads and the log rows with the batched DoFns.
     """
 
     parser.add_argument(
       '--source_table',
       type=str,
-      help='table specification for the source data. Format [dataset.data_table]',
-      required=True
+      help='table specification for the source data. Format [dataset.data_table]. Required unless --replay_table or --replay_run_id is set',
+      default=None
     )
     parser.add_argument(
       '--ga4_measurement_id',
@@ -112,339 +264,1956 @@ class ActivationOptions(GoogleCloudOptions):
         purchase-propensity-15-7
         churn-propensity-30-15
         lead-score-propensity-5-1
+      Required unless --replay_table or --replay_run_id is set
       ''',
-      required=True
+      default=None
     )
     parser.add_argument(
       '--activation_type_configuration',
       type=str,
-      help='GCS path to the configuration file all activation types',
-      required=True
+      help='GCS path (gs://...), or local path (file://...), to the configuration file all activation types. Required unless --replay_table or --replay_run_id is set',
+      default=None
+    )
+    parser.add_argument(
+      '--events_per_request',
+      type=int,
+      help=f'Maximum number of events packed into a single Measurement Protocol request (1 to {MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST}). Values greater than 1 enable batched delivery, which groups the payloads by client id in a shuffle and only saves requests when a client id appears several times, e.g. in the --activations of several activation types',
+      default=1
+    )
+    parser.add_argument(
+      '--http_pool_size',
+      type=int,
+      help='Maximum number of pooled HTTP connections kept open by each sender',
+      default=10
+    )
+    parser.add_argument(
+      '--gzip_level',
+      type=int,
+      choices=range(10),
+      help='Compression level, from 1 (fastest) to 9 (smallest), of the request bodies sent with Content-Encoding: gzip. 0 sends them uncompressed',
+      default=0
+    )
+    parser.add_argument(
+      '--measurement_protocol_endpoint',
+      type=str,
+      help='Base URL of the Measurement Protocol API',
+      default=MEASUREMENT_PROTOCOL_ENDPOINT
+    )
+    parser.add_argument(
+      '--send_concurrency',
+      type=int,
+      help='Maximum number of Measurement Protocol requests in flight per worker. Values greater than 1 enable concurrent delivery',
+      default=1
+    )
+    parser.add_argument(
+      '--validation_sample_rate',
+      type=float,
+      help='Fraction, between 0 and 1, of the payloads also sent to the Measurement Protocol validation server. Their validation messages are logged and counted in the debug_validation_messages metric',
+      default=0.0
+    )
+    parser.add_argument(
+      '--send_shards',
+      type=int,
+      help='Number of shards, keyed by a hash of the client id, the payloads are reshuffled into before being sent one event per request, so sending is spread across all the workers. 0 disables the reshuffle',
+      default=0
+    )
+    parser.add_argument(
+      '--initial_send_rate',
+      type=float,
+      help='Initial send rate of each worker process in requests per second, shared by its senders. It adapts to the 429/5xx responses of the API',
+      default=500.0
+    )
+    parser.add_argument(
+      '--max_send_retries',
+      type=int,
+      help='Maximum number of retries of a request throttled with a 429 or 5xx response',
+      default=3
+    )
+    parser.add_argument(
+      '--replay_table',
+      type=str,
+      help='Comma-separated list of legacy activation_retry tables whose failed payloads are sent again instead of reading the source table. Format [dataset.data_table]',
+      default=None
+    )
+    parser.add_argument(
+      '--skip_delivered',
+      type=parse_bool,
+      help='Drop the payloads already delivered with SEND_OK by a previous run of the same activation type',
+      default=False,
+      const=True,
+      nargs='?'
+    )
+    parser.add_argument(
+      '--replay_run_id',
+      type=str,
+      help='Comma-separated list of activation run ids whose failed payloads in the activation_log table are sent again instead of reading the source table',
+      default=None
+    )
+    parser.add_argument(
+      '--log_write_method',
+      type=str,
+      choices=['STORAGE_WRITE_API', 'STREAMING_INSERTS', 'FILE_LOADS'],
+      help='Method used to write to the activation_log table',
+      default='STORAGE_WRITE_API'
+    )
+    parser.add_argument(
+      '--read_method',
+      type=str,
+      choices=['EXPORT', 'DIRECT_READ'],
+      help='Method used to read the query results. EXPORT exports them to GCS as JSON, DIRECT_READ materializes them in the log dataset and reads only the needed columns with the BigQuery Storage Read API',
+      default='EXPORT'
+    )
+    parser.add_argument(
+      '--activations',
+      type=str,
+      help='JSON list of {"activation_type": ..., "source_table": ...} objects activated in a single job, sharing the senders and the log table. Replaces --source_table and --activation_type',
+      default=None
+    )
+    parser.add_argument(
+      '--input_subscription',
+      type=str,
+      help='Pub/Sub subscription, in the format projects/<project>/subscriptions/<subscription>, of row-level prediction events activated by a streaming job. Each message carries a source table row as JSON and its activation type in the activation_type attribute. Replaces --source_table',
+      default=None
+    )
+    parser.add_argument(
+      '--batched_transforms',
+      type=parse_bool,
+      help='Build the payloads and the log rows with batched DoFns processing lists of rows, which lowers the per-element overhead of large runs. The DirectRunner builds them element by element with --input_subscription or --events_per_request > 1',
+      default=False,
+      const=True,
+      nargs='?'
+    )
+    parser.add_argument(
+      '--priority_expression',
+      type=str,
+      help='SQL ordering expression over the source columns ranking the rows of each activation, e.g. "user_prop_p_p_decile ASC". The highest ranked rows are kept by --max_events, which is required',
+      default=None
+    )
+    parser.add_argument(
+      '--max_events',
+      type=int,
+      help=f'Maximum number of events sent per activation, in the order of --priority_expression. The other rows are logged with the {SKIPPED_BUDGET} state. 0 sends all the events',
+      default=0
+    )
+    parser.add_argument(
+      '--send_deadline_seconds',
+      type=int,
+      help=f'Number of seconds after the launch of the job after which no more events are sent. The payloads not sent by then are logged with the {SKIPPED_DEADLINE} state, whatever their priority, as workers send in no particular order. 0 disables the deadline',
+      default=0
     )
 
 
 
 
-def build_query(args, activation_type_configuration):
+def build_query(args, activation_type_configuration, source_table=None):
   """
   Builds the query to be used to retrieve data from the source table.
 
   Args:
     args: The command-line arguments.
     activation_type_configuration: The activation type configuration.
+    source_table: The source table to be read. Defaults to the `source_table` argument.
 
   Returns:
     The query to be used to retrieve data from the source table.
   """
   return activation_type_configuration['source_query_template'].render(
-    source_table=args.source_table
+    source_table=source_table or args.source_table
   )
 
 
 
 
-def gcs_read_file(project_id, gcs_path):
+def build_priority_query(query, priority_expression=None):
   """
-  Reads a file from Google Cloud Storage (GCS).
+  Ranks the rows of a source query in the order they should be sent.
 
   Args:
-    project_id: The ID of the Google Cloud project that contains the GCS bucket.
-    gcs_path: The path to the file in GCS, in the format "gs://bucket_name/object_name".
+    query: The query retrieving the data from the source table.
+    priority_expression: The SQL ordering expression ranking the rows, e.g. `user_prop_p_p_decile ASC`.
+      The rows are ranked in an arbitrary order if None.
 
   Returns:
-    The contents of the file as a string.
-
-  Raises:
-    ValueError: If the GCS path is invalid.
-    IOError: If an error occurs while reading the file.
+    The query adding the rank of each row, 1 being the highest priority, in the `activation_priority` column.
   """
-  # Validate the GCS path.
-  if not gcs_path.startswith("gs://"):
-    raise ValueError("Invalid GCS path: {}".format(gcs_path))
+  order_by = f"ORDER BY {priority_expression}" if priority_expression else ''
+  return f"SELECT *, ROW_NUMBER() OVER ({order_by}) AS {PRIORITY_COLUMN} FROM ({query})"
+
 
-  # Extract the bucket name and object name from the GCS path.
-  matches = re.match("gs://(.*?)/(.*)", gcs_path)
-  if not matches:
-    raise ValueError("Invalid GCS path: {}".format(gcs_path))
-  bucket_name, blob_name = matches.groups()
 
-  # Create a storage client.
-  storage_client = storage.Client(project=project_id)
-  # Get a reference to the bucket and blob.
-  bucket = storage_client.bucket(bucket_name)
-  blob = bucket.blob(blob_name)
-  # Open the blob for reading.
-  with blob.open("r") as f:
-    return f.read()
 
+def build_replay_query(project_id, replay_tables):
+  """
+  Builds the query to be used to retrieve the failed payloads of previous activation runs.
 
+  Args:
+    project_id: The ID of the Google Cloud project used for table specifications without a project.
+    replay_tables: A comma-separated list of retry log table specifications in the format [project.]dataset.data_table.
 
+  Returns:
+    The query to be used to retrieve the distinct failed payloads of all the retry log tables.
 
-class CallMeasurementProtocolAPI(beam.DoFn):
+  Raises:
+    ValueError: If a table specification is invalid.
   """
-  This class defines a DoFn that sends events to the Google Analytics 4 Measurement Protocol API.
+  selects = []
+  for table_spec in replay_tables.split(','):
+    table_spec = table_spec.strip().replace(':', '.')
+    parts = table_spec.split('.')
+    if len(parts) == 2:
+      parts.insert(0, project_id)
+    if len(parts) != 3 or not all(parts):
+      raise ValueError("Invalid replay table: {}".format(table_spec))
+    selects.append(f"SELECT DISTINCT payload FROM `{'.'.join(parts)}`")
+  return ' UNION DISTINCT '.join(selects)
 
-  The DoFn takes the following arguments:
 
-  - measurement_id: The Measurement ID of the Google Analytics 4 property.
-  - api_secret: The API secret for the Google Analytics 4 property.
-  - debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
 
-  The DoFn yields the following output:
 
-  - The event that was sent.
-  - The HTTP status code of the response.
-  - The content of the response.
+def build_replay_run_query(project_id, log_db_dataset, run_ids):
   """
-  
+  Builds the query to be used to retrieve the failed payloads of previous activation runs from the activation log table.
 
-  def __init__(self, measurement_id, api_secret, debug=False):
-    """
-    Initializes the DoFn.
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    log_db_dataset: The dataset where the log table is created.
+    run_ids: A comma-separated list of activation run ids.
 
-    Args:
-      measurement_id: The Measurement ID of the Google Analytics 4 property.
-      api_secret: The API secret for the Google Analytics 4 property.
-      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
-    """
-    if debug:
-      debug_str = "debug/"
-    else:
-      debug_str = ''
-    self.event_post_url = f"https://www.google-analytics.com/{debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+  Returns:
+    The query to be used to retrieve the distinct failed payloads of the activation runs.
+  """
+  run_id_list = ', '.join(f"'{run_id.strip()}'" for run_id in run_ids.split(','))
+  return (f"SELECT DISTINCT payload FROM `{project_id}.{log_db_dataset}.{ACTIVATION_LOG_TABLE}` "
+    f"WHERE run_id IN ({run_id_list}) AND STARTS_WITH(latest_state, 'SEND_FAIL')")
 
 
-  def process(self, element):
-    """
-    Sends the event to the Measurement Protocol API.
 
-    Args:
-      element: The event to be sent.
 
-    Yields:
-      The event that was sent.
-      The HTTP status code of the response.
-      The content of the response.
-    """
-    response = requests.post(self.event_post_url, data=json.dumps(element),headers={'content-type': 'application/json'}, timeout=20)
-    yield element, response.status_code, response.content
+def validate_options(activation_options):
+  """
+  Checks that the activation options describe either a source activation or a replay.
 
+  Args:
+    activation_options: The activation options.
+
+  Raises:
+    ValueError: If an option required by the selected mode is missing.
+  """
+  if activation_options.max_events < 0 or activation_options.send_deadline_seconds < 0:
+    raise ValueError("--max_events and --send_deadline_seconds must not be negative")
+  if activation_options.priority_expression and not activation_options.max_events:
+    raise ValueError("--priority_expression requires --max_events, the deadline alone sends the rows in no particular order")
+  if activation_options.input_subscription:
+    if activation_options.replay_table or activation_options.replay_run_id or activation_options.skip_delivered:
+      raise ValueError("--replay_table, --replay_run_id and --skip_delivered are not supported with --input_subscription")
+    if activation_options.priority_expression or activation_options.max_events or activation_options.send_deadline_seconds:
+      raise ValueError("--priority_expression, --max_events and --send_deadline_seconds are not supported with --input_subscription")
+    if not activation_options.activation_type_configuration:
+      raise ValueError("--activation_type_configuration is required with --input_subscription")
+    return
+  if activation_options.replay_table or activation_options.replay_run_id:
+    if activation_options.priority_expression or activation_options.max_events or activation_options.skip_delivered:
+      raise ValueError("--priority_expression, --max_events and --skip_delivered are not supported with --replay_table or --replay_run_id")
+    return
+  if not activation_options.activation_type_configuration:
+    raise ValueError("--activation_type_configuration is required unless --replay_table or --replay_run_id is set")
+  if activation_options.activations:
+    parse_activations(activation_options)
+    return
+  for option in ('source_table', 'activation_type'):
+    if not getattr(activation_options, option):
+      raise ValueError(f"--{option} is required unless --activations, --replay_table or --replay_run_id is set")
+
+
+
+
+def parse_activations(activation_options):
+  """
+  Lists the (activation type, source table) pairs activated by the job.
 
+  Args:
+    activation_options: The activation options.
 
+  Returns:
+    A list of (activation type, source table) tuples, without duplicates, in the order they were given. It contains
+    the `activation_type` and `source_table` pair unless `activations` is set.
 
-class ToLogFormat(beam.DoFn):
+  Raises:
+    ValueError: If `activations` is not a non-empty JSON list of objects with an activation type and a source table.
   """
-  This class defines a DoFn that transforms the output of the Measurement Protocol API call into a format suitable for logging.
+  if not activation_options.activations:
+    return [(activation_options.activation_type, activation_options.source_table)]
 
-  The DoFn takes the following arguments:
+  try:
+    activations = json.loads(activation_options.activations)
+  except json.JSONDecodeError as e:
+    raise ValueError(f"--activations is not valid JSON: {e}") from e
+  if not isinstance(activations, list) or not activations:
+    raise ValueError(f"--activations must be a non-empty JSON list: {activation_options.activations}")
 
-  - element: A tuple containing the event that was sent and the HTTP status code of the response.
+  pairs = []
+  for activation in activations:
+    if not isinstance(activation, dict) or not activation.get('activation_type') or not activation.get('source_table'):
+      raise ValueError(f"Each activation must have an activation_type and a source_table: {activation}")
+    pair = (activation['activation_type'], activation['source_table'])
+    if pair not in pairs:
+      pairs.append(pair)
+  return pairs
 
-  The DoFn yields the following output:
 
-  - A dictionary containing the following fields:
-    - id: A unique identifier for the log entry.
-    - activation_id: The ID of the activation event.
-    - payload: The JSON payload of the event that was sent.
-    - latest_state: The latest state of the event, which can be either "SEND_OK" or "SEND_FAIL".
-    - updated_at: The timestamp when the log entry was created.
-  """
 
-  def process(self, element):
-    """
-    Transforms the output of the Measurement Protocol API call into a format suitable for logging.
 
-    Args:
-      element: A tuple containing the event that was sent and the HTTP status code of the response.
+def build_undelivered_query(query, project_id, log_db_dataset, event_name):
+  """
+  Drops the rows of a source query whose event was already delivered by a previous activation run.
 
-    Yields:
-      A dictionary containing the following fields:
-        - id: A unique identifier for the log entry.
-        - activation_id: The ID of the activation event.
-        - payload: The JSON payload of the event that was sent.
-        - latest_state: The latest state of the event, which can be either "SEND_OK" or "SEND_FAIL".
-        - updated_at: The timestamp when the log entry was created.
-    """
-    time_cast = datetime.datetime.now(tz=datetime.timezone.utc)
+  The anti-join runs in BigQuery against the events logged with a `SEND_OK` state in the activation log table,
+  or in the per-run `activation_log_*` tables of older versions, so the pipeline only reads the rows that are
+  left to send. A row was delivered when an event of the same name was sent to its sanitized client id with the
+  timestamp of its inference date, including events packed into the request of another activation type.
+  Only the log rows updated since the earliest inference date of the source are scanned.
 
-    if element[1] == requests.status_codes.codes.NO_CONTENT:
-      state_msg = 'SEND_OK'
-    else:
-      state_msg = 'SEND_FAIL'
+  Args:
+    query: The query retrieving the data from the source table.
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    log_db_dataset: The dataset where the log tables are created.
+    event_name: The name of the activation event.
 
-    result = {}
-    try:
-      result = {
-        'id': str(uuid.uuid4()),
-        'activation_id': element[0]['events'][0]['name'],
-        'payload': json.dumps(element[0]),
-        'latest_state': f"{state_msg} {element[1]}",
-        'updated_at': str(time_cast)
-      }
-    except KeyError as e:
-      logging.error(element)
-      result = {
-        'id': str(uuid.uuid4()),
-        'activation_id': "",
-        'payload': json.dumps(element[0]),
-        'latest_state': f"{state_msg} {element[1]}",
-        'updated_at': str(time_cast)
-      }
-      logging.error(traceback.format_exc())
-    yield result
+  Returns:
+    The query retrieving the rows of the source query that were not delivered yet.
+  """
+  client_id = 'source.client_id'
+  for bad_string in CLIENT_ID_BAD_STRINGS:
+    client_id = f"REPLACE({client_id}, '{bad_string}', '')"
+  return f"""
+    WITH source AS ({query}),
+    delivered AS (
+      SELECT DISTINCT
+        JSON_VALUE(log.payload, '$.client_id') AS client_id,
+        CAST(COALESCE(JSON_VALUE(event, '$.timestamp_micros'), JSON_VALUE(log.payload, '$.timestamp_micros')) AS INT64) AS timestamp_micros
+      FROM `{project_id}.{log_db_dataset}.{ACTIVATION_LOG_TABLE}*` AS log, UNNEST(JSON_QUERY_ARRAY(log.payload, '$.events')) AS event
+      WHERE log.updated_at >= (SELECT TIMESTAMP(MIN(inference_date)) FROM source)
+        AND STARTS_WITH(log.latest_state, 'SEND_OK') AND JSON_VALUE(event, '$.name') = '{event_name}'
+    )
+    SELECT source.* FROM source
+    LEFT JOIN delivered
+    ON delivered.client_id = {client_id} AND delivered.timestamp_micros = UNIX_MICROS(TIMESTAMP(source.inference_date))
+    WHERE delivered.client_id IS NULL
+  """
 
 
 
 
-class DecimalEncoder(json.JSONEncoder):
+class ApplySendBudget(beam.DoFn):
   """
-  This class defines a custom JSON encoder that handles Decimal objects correctly.
-
-  The DecimalEncoder class inherits from the `json.JSONEncoder` class and overrides the `default` method to handle Decimal objects. 
-  The `default` method is called for objects that are not of a basic type (string, number, boolean, None, list, tuple, dictionary). 
-  The DecimalEncoder class checks if the object is a Decimal object and, if so, returns its value as a float. 
-  Otherwise, it calls the parent class's `default` method to handle the object.
+  This class defines a DoFn that keeps the highest priority source rows within the event budget of an activation.
 
-  The DecimalEncoder class is used to ensure that Decimal objects are encoded as floats when they are converted to JSON. 
-  This is important because Decimal objects cannot be directly encoded as JSON strings.
+  The DoFn reads the rank of each row from the `activation_priority` column added by `build_priority_query`.
+  The rows ranked within the budget are yielded to its main output, the other rows to the `skipped` output,
+  so they are logged without being sent.
   """
 
-  def default(self, obj):
+  SKIPPED = 'skipped'
+
+  def __init__(self, max_events):
     """
-    Handles the encoding of Decimal objects.
+    Initializes the DoFn.
 
     Args:
-      obj: The object to be encoded.
-
-    Returns:
-      The JSON representation of the object.
+      max_events: The maximum number of events sent for the activation.
     """
-    if isinstance(obj, Decimal):
-      return float(obj)
-    return json.JSONEncoder.default(self, obj)
+    self.max_events = max_events
+    self.skipped_budget_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'skipped_budget')
 
 
+  def process(self, element):
+    """
+    Checks if a source row is within the event budget.
 
+    Args:
+      element: A dictionary containing the source data and its rank.
 
-class TransformToPayload(beam.DoFn):
-  """
-  This class defines a DoFn that transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+    Yields:
+      The row if it is ranked within the budget, or the row to the `skipped` output.
+    """
+    if element[PRIORITY_COLUMN] <= self.max_events:
+      yield element
+      return
+    self.skipped_budget_counter.inc()
+    yield beam.pvalue.TaggedOutput(self.SKIPPED, element)
 
-  The DoFn takes the following arguments:
 
-  - event_name: The name of the event to be sent to Google Analytics 4.
 
-  The DoFn yields the following output:
 
-  - A dictionary containing the Measurement Protocol payload.
+class ParsePredictionEvent(beam.DoFn):
+  """
+  This class defines a DoFn that parses the row-level prediction events read from Pub/Sub.
 
-  The DoFn performs the following steps:
-  1. Removes bad shaping strings in the `client_id` field.
-  2. Converts the rendered template string into a JSON object.
-  4. Handles any JSON decoding errors.
+  Each message carries a row of the source data as a JSON object and its activation type in the `activation_type`
+  attribute. Messages without the attribute take the default activation type, if any. Messages that cannot be parsed
+  or whose activation type is not activated by the job are logged and dropped.
 
-  The DoFn is used to ensure that the Measurement Protocol payload is formatted correctly before being sent to Google Analytics 4.
+  The DoFn yields tuples containing the activation type and the row.
   """
-  def __init__(self, event_name):
+
+  def __init__(self, activation_types, default_activation_type=None):
     """
     Initializes the DoFn.
 
     Args:
-      event_name: The name of the event to be sent to Google Analytics 4.
+      activation_types: The activation types activated by the job.
+      default_activation_type: The activation type of the messages without the `activation_type` attribute.
     """
-    self.date_format = "%Y-%m-%d"
-    self.date_time_format = "%Y-%m-%d %H:%M:%S.%f %Z"
-    self.event_name = event_name
-    self.consent_obj = {
-      'ad_user_data':'GRANTED',
-      'ad_personalization':'GRANTED'
-    }
-    self.user_property_prefix = 'user_prop_'
-    self.event_parameter_prefix = 'event_param_'
+    self.activation_types = frozenset(activation_types)
+    self.default_activation_type = default_activation_type
+    self.invalid_events_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'invalid_prediction_events')
 
 
   def process(self, element):
     """
-    Transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+    Parses a prediction event.
 
     Args:
-      element: A dictionary containing the output of the inference pipeline.
+      element: The `PubsubMessage` of the prediction event.
 
     Yields:
-      A dictionary containing the Measurement Protocol payload.
+      A tuple containing the activation type and the row of the prediction event.
     """
-    # Removing bad shaping strings in client_id
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20007)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20023)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20013)', '')
-    _client_id = element['client_id'].replace(r'<img onerror="_exploit_dom_xss(20010)', '')
-    _client_id = element['client_id'].replace(r'q="><script>_exploit_dom_xss(40007)</script>', '')
-    _client_id = element['client_id'].replace(r'q="><script>_exploit_dom_xss(40013)</script>', '')
-
-    result = {}
-    result['client_id'] = _client_id
-    if element['user_id']:
-      result['user_id'] = element['user_id']
-    result['timestamp_micros'] = self.date_to_micro(element["inference_date"])
-    result['non_personalized_ads'] = False
-    result['consent'] = self.consent_obj
-    result['user_properties'] = self.extract_user_properties(element)
-    result['events'] = [self.extract_event(element)]
-
-    yield result
-    
+    activation_type = (element.attributes or {}).get(ACTIVATION_TYPE_ATTRIBUTE, self.default_activation_type)
+    try:
+      row = json.loads(element.data)
+    except ValueError:
+      row = None
+    if activation_type not in self.activation_types or not isinstance(row, dict):
+      self.invalid_events_counter.inc()
+      logging.error(f"Dropping prediction event of activation type {activation_type}: {element.data[:1024]}")
+      return
+    yield activation_type, row
 
-  def date_to_micro(self, date_str):
-    """
-    Converts a date string to a microsecond timestamp.
 
-    Args:
-      date_str: The date string to be converted.
 
-    Returns:
-      The microsecond timestamp.
-    """
-    try:  # try if date_str with date time format
-      return int(datetime.datetime.strptime(date_str, self.date_time_format).timestamp() * 1E6)
 
-    except Exception as e:
-      return int(datetime.datetime.strptime(date_str, self.date_format).timestamp() * 1E6)
+def gcs_read_file(project_id, gcs_path):
+  """
+  Reads a file from Google Cloud Storage (GCS).
 
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS bucket.
+    gcs_path: The path to the file in GCS, in the format "gs://bucket_name/object_name".
 
-  def extract_user_properties(self, element):
-    """
-    Generates a dictionary containing the user properties of the element.
+  Returns:
+    The contents of the file as a string.
 
-    Args:
+  Raises:
+    ValueError: If the GCS path is invalid.
+    IOError: If an error occurs while reading the file.
+  """
+  # Validate the GCS path.
+  if not gcs_path.startswith("gs://"):
+    raise ValueError("Invalid GCS path: {}".format(gcs_path))
+
+  # Extract the bucket name and object name from the GCS path.
+  matches = re.match("gs://(.*?)/(.*)", gcs_path)
+  if not matches:
+    raise ValueError("Invalid GCS path: {}".format(gcs_path))
+  bucket_name, blob_name = matches.groups()
+
+  # Get the storage client of the project.
+  storage_client = get_storage_client(project_id)
+  # Get a reference to the bucket and blob.
+  bucket = storage_client.bucket(bucket_name)
+  blob = bucket.blob(blob_name)
+  # Open the blob for reading.
+  with blob.open("r") as f:
+    return f.read()
+
+
+
+
+@functools.lru_cache(maxsize=None)
+def get_storage_client(project_id):
+  """
+  Creates the storage client of a project, once per process.
+
+  Args:
+    project_id: The ID of the Google Cloud project.
+
+  Returns:
+    A `storage.Client`.
+  """
+  return storage.Client(project=project_id)
+
+
+
+
+def read_config_file(project_id, path, cache_dir=CONFIG_CACHE_DIR):
+  """
+  Reads a configuration file or query template from GCS or from the local file system.
+
+  GCS objects are cached in `cache_dir` by generation, so an object is only downloaded again after it changed.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the GCS bucket.
+    path: The path to the file, in the format "gs://bucket_name/object_name" or "file:///path/to/file".
+    cache_dir: The local directory where GCS objects are cached.
+
+  Returns:
+    The contents of the file as a string.
+
+  Raises:
+    ValueError: If the path is invalid.
+    IOError: If an error occurs while reading the file.
+  """
+  if path.startswith('file://'):
+    with open(path[len('file://'):], 'r') as f:
+      return f.read()
+
+  matches = re.match("gs://(.*?)/(.*)", path)
+  if not matches:
+    raise ValueError("Invalid GCS path: {}".format(path))
+  bucket_name, blob_name = matches.groups()
+
+  blob = get_storage_client(project_id).bucket(bucket_name).get_blob(blob_name)
+  if blob is None:
+    raise IOError(f"GCS object not found: {path}")
+  cache_path = os.path.join(cache_dir, f"{hashlib.sha256(path.encode('utf-8')).hexdigest()}-{blob.generation}")
+  try:
+    with open(cache_path, 'r') as f:
+      return f.read()
+  except FileNotFoundError:
+    pass
+
+  contents = blob.download_as_text()
+  # Write the cache entry atomically, so concurrent readers never see a partial file.
+  os.makedirs(cache_dir, exist_ok=True)
+  with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as f:
+    f.write(contents)
+  os.replace(f.name, cache_path)
+  return contents
+
+
+
+
+def parse_retry_after(value):
+  """
+  Parses the value of a `Retry-After` response header.
+
+  Args:
+    value: The header value, either a number of seconds or an HTTP date. May be None.
+
+  Returns:
+    The number of seconds to wait, or 0 if the value is missing or invalid.
+  """
+  if not value:
+    return 0.0
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  try:
+    retry_at = email.utils.parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return 0.0
+  return max(0.0, (retry_at - datetime.datetime.now(tz=datetime.timezone.utc)).total_seconds())
+
+
+
+
+class AdaptiveRateLimiter:
+  """
+  This class defines a thread-safe token bucket whose refill rate adapts to the responses of the Measurement Protocol API.
+
+  The rate follows an additive-increase/multiplicative-decrease (AIMD) policy: every successful response adds
+  `increase / rate` requests per second, so the rate grows by about `increase` every second, and every throttling
+  response (429 or 5xx) multiplies it by `decrease`. A `Retry-After` delay, or an exponential backoff when the
+  header is missing, blocks all callers until it expires. Senders therefore converge on the highest rate the endpoint sustains.
+
+  The limiter keeps cumulative statistics, reported as Beam metrics by the senders:
+
+  - throttle_seconds: The total time callers were blocked by the limiter.
+  - throttled_responses: The number of throttling responses.
+  """
+
+  def __init__(self, initial_rate, min_rate=1.0, max_rate=None, increase=None, decrease=0.5, max_backoff=60.0):
+    """
+    Initializes the limiter.
+
+    Args:
+      initial_rate: The initial rate, in requests per second.
+      min_rate: The lowest rate the limiter decreases to.
+      max_rate: The highest rate the limiter increases to. Unbounded if None.
+      increase: The rate increase per second of successful responses. Defaults to 10% of the initial rate.
+      decrease: The factor applied to the rate on every throttling response.
+      max_backoff: The maximum time callers are blocked after a throttling response, in seconds.
+    """
+    self.rate = float(initial_rate)
+    self.min_rate = min_rate
+    self.max_rate = max_rate
+    self.increase = increase if increase is not None else max(1.0, initial_rate / 10)
+    self.decrease = decrease
+    self.max_backoff = max_backoff
+    self.tokens = 1.0
+    self.updated_at = time.monotonic()
+    self.blocked_until = 0.0
+    self.consecutive_throttles = 0
+    self.throttle_seconds = 0.0
+    self.throttled_responses = 0
+    self._lock = threading.Lock()
+
+
+  def acquire(self):
+    """
+    Blocks until a request can be sent.
+
+    Returns:
+      The time spent waiting, in seconds.
+    """
+    waited = 0.0
+    while True:
+      with self._lock:
+        now = time.monotonic()
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if now >= self.blocked_until and self.tokens >= 1.0:
+          self.tokens -= 1.0
+          self.throttle_seconds += waited
+          return waited
+        delay = max(self.blocked_until - now, (1.0 - self.tokens) / self.rate)
+      time.sleep(delay)
+      waited += delay
+
+
+  def on_success(self):
+    """
+    Increases the rate after a successful response.
+    """
+    with self._lock:
+      self.consecutive_throttles = 0
+      self.rate += self.increase / self.rate
+      if self.max_rate is not None:
+        self.rate = min(self.rate, self.max_rate)
+
+
+  def on_throttle(self, retry_after=0.0):
+    """
+    Decreases the rate and blocks callers after a throttling response.
+
+    Args:
+      retry_after: The delay requested by the `Retry-After` header, in seconds.
+    """
+    with self._lock:
+      self.throttled_responses += 1
+      self.consecutive_throttles += 1
+      self.rate = max(self.min_rate, self.rate * self.decrease)
+      backoff = retry_after or min(self.max_backoff, 2 ** (self.consecutive_throttles - 1) / self.rate)
+      self.blocked_until = max(self.blocked_until, time.monotonic() + min(backoff, self.max_backoff))
+
+
+
+
+# Rate limiters shared by the senders of a worker process, keyed by request URL and initial rate.
+_SHARED_RATE_LIMITERS = {}
+_SHARED_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def shared_rate_limiter(url, initial_rate):
+  """
+  Returns the rate limiter shared by the senders of the worker process posting to a URL.
+
+  A worker process runs a sender per SDK thread, so a limiter per sender would make each of them start at the
+  initial rate and back off independently. The senders of a process share a single limiter instead.
+
+  Args:
+    url: The URL of the Measurement Protocol requests.
+    initial_rate: The initial rate of the limiter, in requests per second.
+
+  Returns:
+    The shared `AdaptiveRateLimiter`.
+  """
+  with _SHARED_RATE_LIMITERS_LOCK:
+    limiter = _SHARED_RATE_LIMITERS.get((url, initial_rate))
+    if limiter is None:
+      limiter = AdaptiveRateLimiter(initial_rate)
+      _SHARED_RATE_LIMITERS[(url, initial_rate)] = limiter
+    return limiter
+
+
+
+
+class CallMeasurementProtocolAPI(beam.DoFn):
+  """
+  This class defines a DoFn that sends events to the Google Analytics 4 Measurement Protocol API.
+
+  The DoFn takes the following arguments:
+
+  - measurement_id: The Measurement ID of the Google Analytics 4 property.
+  - api_secret: The API secret for the Google Analytics 4 property.
+  - debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+  - endpoint: The base URL of the Measurement Protocol API.
+  - pool_size: The maximum number of pooled connections kept open to the endpoint.
+  - initial_send_rate: The initial rate of the adaptive rate limiter, in requests per second.
+  - max_retries: The maximum number of retries of a request throttled with a 429 or 5xx response.
+  - deadline: The time, in seconds since the epoch, after which no more requests are sent.
+  - gzip_level: The gzip compression level of the request bodies.
+  - metrics_prefix: The prefix of the names of the metrics reported by the DoFn.
+
+  The DoFn owns a pooled `requests.Session`, created in `setup()` and closed in `teardown()`, so connections and
+  TLS sessions are reused across the events of all the bundles processed by a worker. Requests go through the
+  `AdaptiveRateLimiter` shared by the senders of the worker process and throttled requests are retried before their
+  final status is reported. Once the deadline has passed, events are reported with the `SKIPPED_DEADLINE` status
+  instead of being sent.
+
+  The DoFn yields the following output:
+
+  - The event that was sent.
+  - The HTTP status code of the response.
+  - The content of the response.
+  - The JSON encoded event, as sent in the request body.
+  """
+  
+
+  def __init__(self, measurement_id, api_secret, debug=False, endpoint=MEASUREMENT_PROTOCOL_ENDPOINT, pool_size=10, initial_send_rate=500.0, max_retries=3, deadline=None, gzip_level=0, metrics_prefix=''):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      debug: A boolean flag indicating whether to use the Measurement Protocol API validation for debugging instead of sending the events.
+      endpoint: The base URL of the Measurement Protocol API.
+      pool_size: The maximum number of pooled connections kept open to the endpoint.
+      initial_send_rate: The initial rate of the adaptive rate limiter, in requests per second.
+      max_retries: The maximum number of retries of a request throttled with a 429 or 5xx response.
+      deadline: The time, in seconds since the epoch, after which no more requests are sent. None sends all the requests.
+      gzip_level: The gzip compression level of the request bodies, from 1 to 9. 0 sends them uncompressed.
+      metrics_prefix: The prefix of the names of the metrics reported by the DoFn, so the requests of other
+        senders, like the validation requests of `SampleDebugValidation`, are not counted with the events sent.
+    """
+    if debug:
+      debug_str = "debug/"
+    else:
+      debug_str = ''
+    self.event_post_url = f"{endpoint.rstrip('/')}/{debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+    self.pool_size = pool_size
+    self.initial_send_rate = initial_send_rate
+    self.max_retries = max_retries
+    self.deadline = deadline
+    self.gzip_level = gzip_level
+    self.session = None
+    self.rate_limiter = None
+    self.reported = {}
+    self.metrics_prefix = metrics_prefix
+    self.send_rate_gauge = beam.metrics.Metrics.gauge(METRICS_NAMESPACE, f'{metrics_prefix}send_rate_limit')
+    self.throttle_time_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, f'{metrics_prefix}throttle_time_ms')
+    self.throttled_responses_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, f'{metrics_prefix}throttled_responses')
+    self.retries_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, f'{metrics_prefix}send_retries')
+    self.send_latency_distribution = beam.metrics.Metrics.distribution(METRICS_NAMESPACE, f'{metrics_prefix}send_latency_ms')
+    self.payload_bytes_distribution = beam.metrics.Metrics.distribution(METRICS_NAMESPACE, f'{metrics_prefix}payload_bytes')
+    self.status_counters = {}
+    self.send_stats = collections.deque()
+
+
+  def setup(self):
+    """
+    Creates the pooled HTTP session and gets the shared rate limiter used to send the events.
+    """
+    self.rate_limiter = shared_rate_limiter(self.event_post_url, self.initial_send_rate)
+    self.reported = {'throttle_time_ms': 0, 'throttled_responses': 0}
+    self.session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+    self.session.headers.update({'content-type': 'application/json'})
+    if self.gzip_level:
+      self.session.headers.update({'content-encoding': 'gzip'})
+
+
+  def teardown(self):
+    """
+    Closes the pooled HTTP session.
+    """
+    if self.session is not None:
+      self.session.close()
+      self.session = None
+
+
+  def process(self, element):
+    """
+    Sends the event to the Measurement Protocol API.
+
+    Args:
+      element: The event to be sent.
+
+    Yields:
+      The event that was sent.
+      The HTTP status code of the response.
+      The content of the response.
+      The JSON encoded event, as sent in the request body.
+    """
+    yield from self.send_element(element)
+    self.report_metrics()
+
+
+  def report_metrics(self):
+    """
+    Reports the requests sent since the last call as Beam metrics.
+
+    Beam metrics can only be updated from the thread running the DoFn, so requests sent from other threads
+    are recorded in `send_stats` and this method publishes them. The throttling totals reported by the sender
+    are kept in `reported`, as the shared rate limiter also counts the requests of the other senders.
+    """
+    self.send_rate_gauge.set(int(self.rate_limiter.rate))
+    while self.send_stats:
+      status_code, latency_ms, payload_bytes, retry, waited_ms = self.send_stats.popleft()
+      self.throttle_time_counter.inc(waited_ms)
+      self.reported['throttle_time_ms'] += waited_ms
+      if isinstance(status_code, int) and is_throttled(status_code):
+        self.throttled_responses_counter.inc()
+        self.reported['throttled_responses'] += 1
+      self.status_counter(status_code).inc()
+      if latency_ms is not None:
+        self.send_latency_distribution.update(latency_ms)
+      self.payload_bytes_distribution.update(payload_bytes)
+      if retry:
+        self.retries_counter.inc()
+
+
+  def status_counter(self, status_code):
+    """
+    Returns the counter of the responses with the given HTTP status code.
+
+    The counters form the HTTP status code histogram of the job, one `http_status_<code>` counter per code seen.
+    Requests skipped after the deadline are counted by the `skipped_deadline` counter. Both are prefixed with `metrics_prefix`.
+
+    Args:
+      status_code: The HTTP status code of the response, or `SKIPPED_DEADLINE`.
+
+    Returns:
+      The Beam counter for the status code.
+    """
+    counter = self.status_counters.get(status_code)
+    if counter is None:
+      name = 'skipped_deadline' if status_code == SKIPPED_DEADLINE else f'http_status_{status_code}'
+      counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, f'{self.metrics_prefix}{name}')
+      self.status_counters[status_code] = counter
+    return counter
+
+
+  def send_element(self, element):
+    """
+    Sends the request for a single input element.
+
+    Args:
+      element: The event to be sent.
+
+    Returns:
+      A list of tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    body = encode_payload(element)
+    status_code, content = self.send(body)
+    return [(element, status_code, content, body)]
+
+
+  def send(self, data):
+    """
+    Posts a single Measurement Protocol request.
+
+    The request waits for the rate limiter and is retried up to `max_retries` times while the response
+    is a 429 or 5xx status code. Every attempt is recorded in `send_stats` and published by `report_metrics`.
+    Requests larger than the Measurement Protocol API accepts are not sent and are reported with a 413 status code.
+    Requests submitted after the deadline are not sent and are reported with the `SKIPPED_DEADLINE` status.
+    With a `gzip_level`, the body is compressed once before the first attempt and `payload_bytes` records
+    the compressed size, as sent on the network.
+
+    Args:
+      data: The JSON encoded Measurement Protocol request payload, as returned by `encode_payload`.
+
+    Returns:
+      A tuple containing the HTTP status code and the content of the response.
+    """
+    if self.deadline is not None and time.time() >= self.deadline:
+      self.send_stats.append((SKIPPED_DEADLINE, None, len(data), False, 0))
+      return SKIPPED_DEADLINE, b''
+    if len(data) > MEASUREMENT_PROTOCOL_MAX_REQUEST_BYTES:
+      self.send_stats.append((REQUEST_TOO_LARGE, None, len(data), False, 0))
+      return REQUEST_TOO_LARGE, b''
+    if self.gzip_level:
+      data = gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+    for attempt in range(self.max_retries + 1):
+      waited = self.rate_limiter.acquire()
+      start = time.perf_counter()
+      response = self.session.post(self.event_post_url, data=data, timeout=20)
+      self.send_stats.append((response.status_code, int((time.perf_counter() - start) * 1000), len(data), attempt > 0, int(waited * 1000)))
+      if not is_throttled(response.status_code):
+        self.rate_limiter.on_success()
+        break
+      self.rate_limiter.on_throttle(parse_retry_after(response.headers.get('Retry-After')))
+    return response.status_code, response.content
+
+
+
+
+def is_throttled(status_code):
+  """
+  Checks if a Measurement Protocol API response asks the sender to slow down.
+
+  Args:
+    status_code: The HTTP status code of the response.
+
+  Returns:
+    True for 429 Too Many Requests and 5xx status codes, False otherwise.
+  """
+  return status_code == requests.status_codes.codes.TOO_MANY_REQUESTS or status_code >= 500
+
+
+
+
+def pack_payloads(payloads, max_events):
+  """
+  Packs payloads of the same user into Measurement Protocol requests.
+
+  A Measurement Protocol request carries a single `client_id`, `user_id`, consent and set of user properties for up to 25 events.
+  Payloads of the same user are merged when their user properties do not set different values for the same name and fit
+  in the limit of the Measurement Protocol API together, so the payloads of several activation types of a user share a request.
+  The events of a payload whose `timestamp_micros` differs from the one of the request carry their own `timestamp_micros`.
+
+  Args:
+    payloads: An iterable of Measurement Protocol payloads.
+    max_events: The maximum number of events in a single request.
+
+  Returns:
+    A list of tuples containing the packed request payload and the list of original payloads it carries.
+  """
+  packs = []
+  open_packs = {}
+  for payload in payloads:
+    header = {k: v for k, v in payload.items() if k not in ('events', 'user_properties', 'timestamp_micros')}
+    header_key = json.dumps(header, sort_keys=True, default=str)
+    user_properties = payload.get('user_properties', {})
+    pack = open_packs.get(header_key)
+    if pack is None or not can_pack(pack[0], payload, max_events):
+      request_payload = dict(header)
+      if 'timestamp_micros' in payload:
+        request_payload['timestamp_micros'] = payload['timestamp_micros']
+      pack = (dict(request_payload, user_properties={}, events=[]), [])
+      open_packs[header_key] = pack
+      packs.append(pack)
+    pack[0]['user_properties'].update(user_properties)
+    if payload.get('timestamp_micros') == pack[0].get('timestamp_micros'):
+      pack[0]['events'].extend(payload['events'])
+    else:
+      pack[0]['events'].extend(dict(event, timestamp_micros=payload['timestamp_micros']) for event in payload['events'])
+    pack[1].append(payload)
+  return packs
+
+
+
+
+def can_pack(request_payload, payload, max_events):
+  """
+  Checks if a payload can be merged into a packed request of the same user.
+
+  Args:
+    request_payload: The packed request payload.
+    payload: The Measurement Protocol payload.
+    max_events: The maximum number of events in a single request.
+
+  Returns:
+    True if the events fit in the request and the user properties of the payload agree with the ones of the request,
+    False otherwise.
+  """
+  if len(request_payload['events']) + len(payload['events']) > max_events:
+    return False
+  packed_properties = request_payload['user_properties']
+  user_properties = payload.get('user_properties', {})
+  if any(name in packed_properties and packed_properties[name] != value for name, value in user_properties.items()):
+    return False
+  return len(packed_properties.keys() | user_properties.keys()) <= MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES
+
+
+
+
+class CallMeasurementProtocolAPIBatch(CallMeasurementProtocolAPI):
+  """
+  This class defines a DoFn that sends batches of events to the Google Analytics 4 Measurement Protocol API.
+
+  The DoFn consumes the output of `GroupIntoBatches`, packs the payloads of each batch into as few requests as
+  the Measurement Protocol allows and yields one output per original payload, so downstream logging is unchanged.
+
+  The DoFn yields the following output:
+
+  - The event that was sent.
+  - The HTTP status code of the response for the request carrying the event.
+  - The content of the response.
+  - The JSON encoded event.
+  """
+
+  def __init__(self, measurement_id, api_secret, max_events=MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST, **kwargs):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      max_events: The maximum number of events packed into a single request.
+      **kwargs: The remaining arguments of `CallMeasurementProtocolAPI`.
+    """
+    super().__init__(measurement_id, api_secret, **kwargs)
+    self.max_events = max_events
+
+
+  def send_element(self, element):
+    """
+    Sends a batch of events to the Measurement Protocol API.
+
+    Args:
+      element: A tuple containing the batch key and the list of events to be sent.
+
+    Returns:
+      A list of tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    _, payloads = element
+    results = []
+    for request_payload, originals in pack_payloads(payloads, self.max_events):
+      results.extend(self.send_pack(request_payload, originals))
+    return results
+
+
+  def send_pack(self, request_payload, originals):
+    """
+    Sends a packed request, split in halves until it fits in the maximum request size.
+
+    Args:
+      request_payload: The packed request payload.
+      originals: The list of payloads carried by the request.
+
+    Returns:
+      A list of tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    body = encode_payload(request_payload)
+    if len(body) > MEASUREMENT_PROTOCOL_MAX_REQUEST_BYTES and len(originals) > 1:
+      half = len(originals) // 2
+      return [
+        result
+        for part in (originals[:half], originals[half:])
+        for pack in pack_payloads(part, self.max_events)
+        for result in self.send_pack(*pack)
+      ]
+    status_code, content = self.send(body)
+    return [(payload, status_code, content, encode_payload(payload)) for payload in originals]
+
+
+
+
+class CallMeasurementProtocolAPIConcurrent(CallMeasurementProtocolAPI):
+  """
+  This class defines a DoFn that keeps several requests to the Google Analytics 4 Measurement Protocol API in flight.
+
+  The DoFn is a drop-in replacement for `CallMeasurementProtocolAPI`. Each input element is sent on a bounded thread pool
+  sharing the pooled HTTP session, and at most `concurrency` elements are in flight per DoFn instance. Completed results
+  are emitted as soon as a slot is needed and the remaining ones are flushed in `finish_bundle`, each in the window of
+  its input element.
+
+  The DoFn yields the following output:
+
+  - The event that was sent.
+  - The HTTP status code of the response.
+  - The content of the response.
+  - The JSON encoded event, as sent in the request body.
+  """
+
+  def __init__(self, measurement_id, api_secret, concurrency=16, **kwargs):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      concurrency: The maximum number of requests in flight.
+      **kwargs: The remaining arguments of the parent sender.
+    """
+    super().__init__(measurement_id, api_secret, **kwargs)
+    self.concurrency = concurrency
+    self.pool_size = max(self.pool_size, concurrency)
+    self.executor = None
+    self.in_flight = {}
+
+
+  def setup(self):
+    """
+    Creates the pooled HTTP session and the thread pool used to send the events.
+    """
+    super().setup()
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+
+
+  def teardown(self):
+    """
+    Shuts down the thread pool and closes the pooled HTTP session.
+    """
+    if self.executor is not None:
+      self.executor.shutdown(wait=True)
+      self.executor = None
+    super().teardown()
+
+
+  def start_bundle(self):
+    """
+    Resets the requests in flight.
+    """
+    self.in_flight = {}
+
+
+  def process(self, element, timestamp=beam.DoFn.TimestampParam, window=beam.DoFn.WindowParam):
+    """
+    Submits the event to the thread pool and emits the results of the requests that completed.
+
+    Args:
+      element: The event to be sent.
+      timestamp: The timestamp of the element.
+      window: The window of the element.
+
+    Yields:
+      WindowedValues of the tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    if len(self.in_flight) >= self.concurrency:
+      done, _ = concurrent.futures.wait(self.in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+      yield from self._collect(done)
+    future = self.executor.submit(self.send_element, element)
+    self.in_flight[future] = (timestamp, window)
+    self.report_metrics()
+
+
+  def finish_bundle(self):
+    """
+    Waits for the requests in flight and emits their results.
+
+    Yields:
+      WindowedValues of the tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    done, _ = concurrent.futures.wait(self.in_flight)
+    yield from self._collect(done)
+    self.report_metrics()
+
+
+  def _collect(self, done):
+    """
+    Removes completed requests from the requests in flight.
+
+    Args:
+      done: The completed futures.
+
+    Yields:
+      WindowedValues of the tuples containing the event that was sent, the HTTP status code, the content of the response
+      and the JSON encoded event.
+    """
+    for future in done:
+      timestamp, window = self.in_flight.pop(future)
+      for result in future.result():
+        yield WindowedValue(result, timestamp, [window])
+
+
+
+
+class CallMeasurementProtocolAPIConcurrentBatch(CallMeasurementProtocolAPIConcurrent, CallMeasurementProtocolAPIBatch):
+  """
+  This class defines a DoFn that keeps several batched requests to the Google Analytics 4 Measurement Protocol API in flight.
+
+  It combines the packing of `CallMeasurementProtocolAPIBatch` with the bounded concurrency of `CallMeasurementProtocolAPIConcurrent`.
+  """
+
+
+
+
+class ToLogFormat(beam.DoFn):
+  """
+  This class defines a DoFn that transforms the output of the Measurement Protocol API call into a format suitable for logging.
+
+  The DoFn takes the following arguments:
+
+  - element: A tuple containing the event that was sent, the HTTP status code and the content of the response
+    and, optionally, the JSON encoded event, which is then logged without encoding the event again.
+
+  The DoFn yields the following output:
+
+  - A dictionary containing the following fields:
+    - id: A unique identifier for the log entry.
+    - activation_id: The ID of the activation event.
+    - payload: The JSON payload of the event that was sent.
+    - latest_state: The latest state of the event, which can be "SEND_OK", "SEND_FAIL", "SKIPPED_BUDGET" or "SKIPPED_DEADLINE".
+    - updated_at: The timestamp when the log entry was created.
+    - run_id: The id of the activation run.
+  """
+
+  def __init__(self, run_id=None):
+    """
+    Initializes the DoFn.
+
+    Args:
+      run_id: The id of the activation run.
+    """
+    self.run_id = run_id
+
+
+  def process(self, element):
+    """
+    Transforms the output of the Measurement Protocol API call into a format suitable for logging.
+
+    Args:
+      element: A tuple containing the event that was sent, the HTTP status code and the content of the response
+        and, optionally, the JSON encoded event.
+
+    Yields:
+      A dictionary containing the following fields:
+        - id: A unique identifier for the log entry.
+        - activation_id: The ID of the activation event.
+        - payload: The JSON payload of the event that was sent.
+        - latest_state: The latest state of the event, which can be "SEND_OK", "SEND_FAIL", "SKIPPED_BUDGET" or "SKIPPED_DEADLINE".
+        - updated_at: The timestamp when the log entry was created.
+        - run_id: The id of the activation run.
+    """
+    time_cast = datetime.datetime.now(tz=datetime.timezone.utc)
+    yield self.log_row(element, str(uuid.uuid4()), str(time_cast))
+
+
+  def log_row(self, element, log_id, updated_at):
+    """
+    Builds the log row of the output of the Measurement Protocol API call.
+
+    Args:
+      element: A tuple containing the event that was sent, the HTTP status code and the content of the response
+        and, optionally, the JSON encoded event.
+      log_id: The unique identifier of the log entry.
+      updated_at: The timestamp of the log entry.
+
+    Returns:
+      A dictionary containing the log row.
+    """
+    if element[1] in (SKIPPED_BUDGET, SKIPPED_DEADLINE):
+      # Payloads that were not sent are logged with the reason they were skipped.
+      latest_state = element[1]
+    elif element[1] == requests.status_codes.codes.NO_CONTENT:
+      latest_state = f"SEND_OK {element[1]}"
+    else:
+      latest_state = f"SEND_FAIL {element[1]}"
+
+    # Reuse the request body of the sender, so the event is encoded only once.
+    body = element[3] if len(element) > 3 else encode_payload(element[0])
+    payload = body.decode('utf-8')
+
+    result = {}
+    try:
+      result = {
+        'id': log_id,
+        'activation_id': element[0]['events'][0]['name'],
+        'payload': payload,
+        'latest_state': latest_state,
+        'updated_at': updated_at,
+        'run_id': self.run_id
+      }
+    except KeyError as e:
+      logging.error(element)
+      result = {
+        'id': log_id,
+        'activation_id': "",
+        'payload': payload,
+        'latest_state': latest_state,
+        'updated_at': updated_at,
+        'run_id': self.run_id
+      }
+      logging.error(traceback.format_exc())
+    return result
+
+
+
+
+class ToLogFormatBatch(beam.DoFn):
+  """
+  This class defines a batched DoFn that transforms lists of outputs of the Measurement Protocol API calls into log rows.
+
+  The DoFn only defines `process_batch`, so Beam buffers its input elements into lists, and the lists of log rows
+  it yields are exploded into elements for the element-wise steps downstream. The log rows are those of `ToLogFormat`,
+  but the timestamp and the random bytes of the unique identifiers are generated once per list.
+  """
+
+  def __init__(self, run_id=None):
+    """
+    Initializes the DoFn.
+
+    Args:
+      run_id: The id of the activation run.
+    """
+    self.log_format = ToLogFormat(run_id=run_id)
+
+
+  def get_input_batch_type(self, input_element_type):
+    """
+    Declares the lists of elements processed by `process_batch`.
+
+    Args:
+      input_element_type: The element type of the input PCollection.
+
+    Returns:
+      The type of the lists of input elements.
+    """
+    return beam.typehints.List[input_element_type]
+
+
+  def get_output_batch_type(self, input_element_type):
+    """
+    Declares the lists of log rows yielded by `process_batch`.
+
+    Args:
+      input_element_type: The element type of the input PCollection.
+
+    Returns:
+      The type of the lists of log rows.
+    """
+    return beam.typehints.List[self.infer_output_type(input_element_type)]
+
+
+  def process_batch(self, batch):
+    """
+    Transforms a list of outputs of the Measurement Protocol API calls into log rows.
+
+    Args:
+      batch: A list of tuples containing the event that was sent, the HTTP status code and the content of the response
+        and, optionally, the JSON encoded event.
+
+    Yields:
+      The list of log rows, as built by `ToLogFormat`.
+    """
+    updated_at = str(datetime.datetime.now(tz=datetime.timezone.utc))
+    random_bytes = os.urandom(16 * len(batch))
+    log_ids = [str(uuid.UUID(bytes=random_bytes[i:i + 16], version=4)) for i in range(0, len(random_bytes), 16)]
+    yield [self.log_format.log_row(element, log_id, updated_at) for element, log_id in zip(batch, log_ids)]
+
+
+
+
+class DecimalEncoder(json.JSONEncoder):
+  """
+  This class defines a custom JSON encoder that handles Decimal objects correctly.
+
+  The DecimalEncoder class inherits from the `json.JSONEncoder` class and overrides the `default` method to handle Decimal objects. 
+  The `default` method is called for objects that are not of a basic type (string, number, boolean, None, list, tuple, dictionary). 
+  The DecimalEncoder class checks if the object is a Decimal object and, if so, returns its value as a float. 
+  Otherwise, it calls the parent class's `default` method to handle the object.
+
+  The DecimalEncoder class is used to ensure that Decimal objects are encoded as floats when they are converted to JSON. 
+  This is important because Decimal objects cannot be directly encoded as JSON strings.
+  Dates and timestamps, as returned by direct BigQuery reads, are encoded as ISO 8601 strings.
+  """
+
+  def default(self, obj):
+    """
+    Handles the encoding of Decimal objects.
+
+    Args:
+      obj: The object to be encoded.
+
+    Returns:
+      The JSON representation of the object.
+    """
+    if isinstance(obj, Decimal):
+      return float(obj)
+    if isinstance(obj, (datetime.date, datetime.time)):
+      return obj.isoformat()
+    return json.JSONEncoder.default(self, obj)
+
+
+# Encoder whose `default` method handles the values orjson cannot encode natively.
+DECIMAL_ENCODER = DecimalEncoder()
+
+
+
+
+def encode_payload(payload):
+  """
+  Encodes a Measurement Protocol payload into the compact JSON bytes sent in the request body.
+
+  The payload is encoded with orjson when it is installed and with `DecimalEncoder` otherwise. In both cases
+  Decimal values are encoded as floats, and dates and timestamps as ISO 8601 strings.
+
+  Args:
+    payload: The Measurement Protocol payload.
+
+  Returns:
+    The UTF-8 encoded JSON representation of the payload.
+  """
+  if orjson is not None:
+    return orjson.dumps(payload, default=DECIMAL_ENCODER.default)
+  return json.dumps(payload, cls=DecimalEncoder, separators=(',', ':')).encode('utf-8')
+
+
+
+
+@functools.lru_cache(maxsize=1024)
+def date_to_micro(value):
+  """
+  Converts an inference date to a microsecond timestamp.
+
+  The format of a date string is detected from its length instead of by catching parsing errors, and recent results
+  are memoized for the rows sharing an inference date, e.g. those of a DATE column. The activation query templates
+  derive the inference date of each user from their latest event timestamp, so their rows rarely hit the cache. Native `datetime.datetime`
+  and `datetime.date` objects, as returned by direct BigQuery reads, are converted without any parsing.
+
+  Args:
+    value: The date string, in the `DATE_FORMAT` or `DATE_TIME_FORMAT` format, or a `datetime.date`/`datetime.datetime` object.
+
+  Returns:
+    The microsecond timestamp.
+
+  Raises:
+    ValueError: If the date string does not match any of the supported formats.
+  """
+  if isinstance(value, datetime.datetime):
+    date_time = value
+  elif isinstance(value, datetime.date):
+    date_time = datetime.datetime(value.year, value.month, value.day)
+  elif len(value) == len('YYYY-MM-DD'):
+    date_time = datetime.datetime.strptime(value, DATE_FORMAT)
+  else:
+    date_time = datetime.datetime.strptime(value, DATE_TIME_FORMAT)
+  return int(date_time.timestamp() * 1E6)
+
+
+
+
+class TransformToPayload(beam.DoFn):
+  """
+  This class defines a DoFn that transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+
+  The DoFn takes the following arguments:
+
+  - event_name: The name of the event to be sent to Google Analytics 4.
+
+  The DoFn yields the following output:
+
+  - A dictionary containing the Measurement Protocol payload.
+
+  The DoFn performs the following steps:
+  1. Compiles a plan of the user property and event parameter columns from the first element of each bundle.
+  2. Removes bad shaping strings in the `client_id` field.
+  3. Builds the Measurement Protocol payload from the plan.
+
+  The DoFn is used to ensure that the Measurement Protocol payload is formatted correctly before being sent to Google Analytics 4.
+  """
+  def __init__(self, event_name):
+    """
+    Initializes the DoFn.
+
+    Args:
+      event_name: The name of the event to be sent to Google Analytics 4.
+    """
+    self.date_format = DATE_FORMAT
+    self.date_time_format = DATE_TIME_FORMAT
+    self.event_name = event_name
+    self.consent_obj = {
+      'ad_user_data':'GRANTED',
+      'ad_personalization':'GRANTED'
+    }
+    self.user_property_prefix = USER_PROPERTY_PREFIX
+    self.event_parameter_prefix = EVENT_PARAMETER_PREFIX
+    self.plan = None
+    self.rows_read_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'rows_read')
+    self.payloads_built_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'payloads_built')
+
+
+  def start_bundle(self):
+    """
+    Resets the compiled plan, so it is compiled from the first element of the bundle.
+    """
+    self.plan = None
+
+
+  def compile_plan(self, element):
+    """
+    Compiles the plan used to build the payloads of the elements sharing the schema of the element.
+
+    Args:
+      element: A dictionary containing the output of the inference pipeline.
+
+    Returns:
+      A tuple containing the set of columns of the schema, the tuple of (column, user property name) pairs
+      and the tuple of (column, event parameter name) pairs.
+    """
+    user_properties = tuple(
+      (k, k[len(self.user_property_prefix):]) for k in element if k.startswith(self.user_property_prefix))
+    event_parameters = tuple(
+      (k, k[len(self.event_parameter_prefix):]) for k in element if k.startswith(self.event_parameter_prefix))
+    return frozenset(element), user_properties, event_parameters
+
+
+  def process(self, element):
+    """
+    Transforms the output of the inference pipeline into a format suitable for sending to the Google Analytics 4 Measurement Protocol API.
+
+    Args:
+      element: A dictionary containing the output of the inference pipeline.
+
+    Yields:
+      A dictionary containing the Measurement Protocol payload.
+    """
+    self.rows_read_counter.inc()
+    if self.plan is None or self.plan[0] != element.keys():
+      self.plan = self.compile_plan(element)
+    result = self.build_payload(element)
+    self.payloads_built_counter.inc()
+    yield result
+
+
+  def build_payload(self, element):
+    """
+    Builds the Measurement Protocol payload of an element sharing the schema of the compiled plan.
+
+    Args:
+      element: A dictionary containing the output of the inference pipeline.
+
+    Returns:
+      A dictionary containing the Measurement Protocol payload.
+    """
+    result = {}
+    # Removing bad shaping strings in client_id
+    result['client_id'] = CLIENT_ID_SANITIZER.sub('', element['client_id'])
+    if element['user_id']:
+      result['user_id'] = element['user_id']
+    result['timestamp_micros'] = self.date_to_micro(element["inference_date"])
+    result['non_personalized_ads'] = False
+    result['consent'] = self.consent_obj
+    result['user_properties'] = self.extract_user_properties(element)
+    result['events'] = [self.extract_event(element)]
+    return result
+
+
+  def date_to_micro(self, date_str):
+    """
+    Converts a date string to a microsecond timestamp.
+
+    Args:
+      date_str: The date string, or the `datetime.date`/`datetime.datetime` object, to be converted.
+
+    Returns:
+      The microsecond timestamp.
+    """
+    return date_to_micro(date_str)
+
+
+  def extract_user_properties(self, element):
+    """
+    Generates a dictionary containing the user properties of the element.
+
+    Args:
+      element: The element to be processed.
+
+    Returns:
+      A dictionary containing the user properties of the element.
+    """
+    if self.plan is None:
+      self.plan = self.compile_plan(element)
+    user_properties = {}
+    for column, name in self.plan[1]:
+      v = element.get(column)
+      if v:
+        user_properties[name] = {'value': str(v)}
+    return user_properties
+
+  def extract_event(self, element):
+    """
+    Generates a dictionary containing the event parameters from the element.
+
+    Args:
       element: The element to be processed.
 
-    Returns:
-      A dictionary containing the user properties of the element.
+    Returns:
+      A dictionary containing the event parameters from the element.
+    """
+    if self.plan is None:
+      self.plan = self.compile_plan(element)
+    params = {}
+    for column, name in self.plan[2]:
+      v = element.get(column)
+      if v:
+        params[name] = v
+    return {
+      'name': self.event_name,
+      'params': params
+    }
+
+
+
+
+class TransformToPayloadBatch(beam.DoFn):
+  """
+  This class defines a batched DoFn that builds the Measurement Protocol payloads of lists of source rows.
+
+  The DoFn only defines `process_batch`, so Beam buffers its input elements into lists, and the lists of payloads
+  it yields are exploded into elements for the element-wise steps downstream. The payloads are built by
+  `TransformToPayload.build_payload`: the rows sharing the schema of the first row of the list are built from its compiled
+  plan, with the counters updated once per list. The other rows fall back to the element path of `TransformToPayload`.
+  """
+
+  def __init__(self, event_name):
+    """
+    Initializes the DoFn.
+
+    Args:
+      event_name: The name of the event to be sent to Google Analytics 4.
+    """
+    self.transform = TransformToPayload(event_name)
+
+
+  def start_bundle(self):
+    """
+    Resets the compiled plan, so it is compiled from the first row of the bundle.
+    """
+    self.transform.start_bundle()
+
+
+  def get_input_batch_type(self, input_element_type):
+    """
+    Declares the lists of rows processed by `process_batch`.
+
+    Args:
+      input_element_type: The element type of the input PCollection.
+
+    Returns:
+      The type of the lists of input rows.
+    """
+    return beam.typehints.List[input_element_type]
+
+
+  def get_output_batch_type(self, input_element_type):
+    """
+    Declares the lists of payloads yielded by `process_batch`.
+
+    Args:
+      input_element_type: The element type of the input PCollection.
+
+    Returns:
+      The type of the lists of payloads.
+    """
+    return beam.typehints.List[self.infer_output_type(input_element_type)]
+
+
+  def process_batch(self, batch):
+    """
+    Transforms a list of rows of the inference pipeline into Measurement Protocol payloads.
+
+    Args:
+      batch: A list of dictionaries containing the output of the inference pipeline.
+
+    Yields:
+      The list of Measurement Protocol payloads.
+    """
+    transform = self.transform
+    if transform.plan is None or transform.plan[0] != batch[0].keys():
+      transform.plan = transform.compile_plan(batch[0])
+    schema = transform.plan[0]
+    rows = [row for row in batch if row.keys() == schema]
+    transform.rows_read_counter.inc(len(rows))
+    payloads = [transform.build_payload(row) for row in rows]
+    transform.payloads_built_counter.inc(len(rows))
+
+    if len(rows) < len(batch):
+      payloads.extend(payload for row in batch if row.keys() != schema for payload in transform.process(row))
+    yield payloads
+
+
+
+
+class EnforcePayloadLimits(beam.DoFn):
+  """
+  This class defines a DoFn that trims Measurement Protocol payloads to the limits of the Measurement Protocol API.
+
+  Payloads are trimmed deterministically, so the same source row always produces the same request:
+
+  - User properties and event parameters whose name is too long are dropped.
+  - String values that are too long are truncated.
+  - Only the first `MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES` user properties and `MEASUREMENT_PROTOCOL_MAX_EVENT_PARAMS`
+    parameters of each event are kept, in the order of the source columns.
+  - Events whose name is too long are dropped, and so are payloads left without events.
+
+  Everything that is dropped or truncated is counted in Beam metrics. Requests that are still too large are
+  not sent by the senders.
+  """
+
+  def __init__(self):
+    """
+    Initializes the DoFn.
+    """
+    self.user_properties_dropped_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'user_properties_dropped')
+    self.event_params_dropped_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'event_params_dropped')
+    self.values_truncated_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'values_truncated')
+    self.events_dropped_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'events_dropped')
+
+
+  def process(self, element):
+    """
+    Trims the payload to the limits of the Measurement Protocol API.
+
+    Args:
+      element: The Measurement Protocol payload.
+
+    Yields:
+      The payload, or a trimmed copy of it, unless none of its events can be sent.
+    """
+    user_properties = self.limit(element.get('user_properties', {}),
+      MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES, MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_NAME_LENGTH,
+      MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_VALUE_LENGTH, self.user_properties_dropped_counter)
+    events = []
+    for event in element['events']:
+      if len(event['name']) > MEASUREMENT_PROTOCOL_MAX_EVENT_NAME_LENGTH:
+        self.events_dropped_counter.inc()
+        continue
+      params = self.limit(event.get('params', {}),
+        MEASUREMENT_PROTOCOL_MAX_EVENT_PARAMS, MEASUREMENT_PROTOCOL_MAX_PARAM_NAME_LENGTH,
+        MEASUREMENT_PROTOCOL_MAX_PARAM_VALUE_LENGTH, self.event_params_dropped_counter)
+      events.append(event if params is event.get('params') else dict(event, params=params))
+    if not events:
+      logging.error(f"Dropping payload without sendable events: {element}")
+      return
+
+    if user_properties is element.get('user_properties') and len(events) == len(element['events']) and all(
+        event is original for event, original in zip(events, element['events'])):
+      yield element
+    else:
+      yield dict(element, user_properties=user_properties, events=events)
+
+
+  def limit(self, values, max_count, max_name_length, max_value_length, dropped_counter):
+    """
+    Trims user properties or event parameters.
+
+    Args:
+      values: The dictionary of user properties, whose values are {'value': ...} dictionaries, or of event parameters.
+      max_count: The maximum number of entries.
+      max_name_length: The maximum length of a name.
+      max_value_length: The maximum length of a string value.
+      dropped_counter: The counter of the dropped entries.
+
+    Returns:
+      The dictionary itself if it is within the limits, a trimmed copy otherwise.
+    """
+    if len(values) <= max_count and all(
+        len(name) <= max_name_length and not self.too_long(value, max_value_length) for name, value in values.items()):
+      return values
+
+    limited = {}
+    for name, value in values.items():
+      if len(name) > max_name_length or len(limited) == max_count:
+        dropped_counter.inc()
+        continue
+      if self.too_long(value, max_value_length):
+        self.values_truncated_counter.inc()
+        value = dict(value, value=value['value'][:max_value_length]) if isinstance(value, dict) else value[:max_value_length]
+      limited[name] = value
+    return limited
+
+
+  def too_long(self, value, max_length):
+    """
+    Checks if a user property or event parameter value is a string longer than allowed.
+
+    Args:
+      value: The event parameter value, or the {'value': ...} dictionary of a user property.
+      max_length: The maximum length of a string value.
+
+    Returns:
+      True if the value must be truncated, False otherwise.
+    """
+    if isinstance(value, dict):
+      value = value.get('value')
+    return isinstance(value, str) and len(value) > max_length
+
+
+
+
+def validate_name(name, max_length, reserved_names, kind):
+  """
+  Validates an event, parameter or user property name against the rules of the Measurement Protocol API.
+
+  Args:
+    name: The name to be validated.
+    max_length: The maximum length of the name.
+    reserved_names: The names reserved by Google Analytics 4.
+    kind: The kind of name, used in the validation messages.
+
+  Returns:
+    A list of validation messages, empty if the name is valid.
+  """
+  if not isinstance(name, str) or not MEASUREMENT_PROTOCOL_NAME.fullmatch(name):
+    return [f"Invalid {kind} name {name!r}: it must start with a letter and contain only letters, digits and underscores"]
+  if len(name) > max_length:
+    return [f"Invalid {kind} name {name!r}: it is longer than {max_length} characters"]
+  if name in reserved_names or name.startswith(MEASUREMENT_PROTOCOL_RESERVED_PREFIXES):
+    return [f"Invalid {kind} name {name!r}: it is reserved"]
+  return []
+
+
+
+
+def validate_payload(payload):
+  """
+  Validates a Measurement Protocol payload against the rules of the Measurement Protocol API.
+
+  The rules are those checked by the Measurement Protocol validation server on the requests built by the activation
+  application: required fields, reserved names, name and value lengths, parameter counts and value types.
+
+  Args:
+    payload: The Measurement Protocol payload.
+
+  Returns:
+    A list of validation messages, empty if the payload is valid.
+  """
+  messages = []
+  if not isinstance(payload.get('client_id'), str) or not payload['client_id']:
+    messages.append("client_id is required and must be a non-empty string")
+  if 'timestamp_micros' in payload and (not isinstance(payload['timestamp_micros'], int) or isinstance(payload['timestamp_micros'], bool)):
+    messages.append(f"timestamp_micros must be an integer: {payload['timestamp_micros']!r}")
+
+  user_properties = payload.get('user_properties', {})
+  if len(user_properties) > MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES:
+    messages.append(f"More than {MEASUREMENT_PROTOCOL_MAX_USER_PROPERTIES} user properties")
+  for name, value in user_properties.items():
+    messages.extend(validate_name(name, MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_NAME_LENGTH, MEASUREMENT_PROTOCOL_RESERVED_USER_PROPERTY_NAMES, 'user property'))
+    if not isinstance(value, dict) or not isinstance(value.get('value'), (str, int, float)) or isinstance(value.get('value'), bool):
+      messages.append(f"Invalid value of user property {name!r}: {value!r}")
+    elif isinstance(value['value'], str) and len(value['value']) > MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_VALUE_LENGTH:
+      messages.append(f"Value of user property {name!r} is longer than {MEASUREMENT_PROTOCOL_MAX_USER_PROPERTY_VALUE_LENGTH} characters")
+
+  events = payload.get('events')
+  if not isinstance(events, list) or not events:
+    return messages + ["events is required and must be a non-empty list"]
+  if len(events) > MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST:
+    messages.append(f"More than {MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST} events")
+  for event in events:
+    messages.extend(validate_name(event.get('name'), MEASUREMENT_PROTOCOL_MAX_EVENT_NAME_LENGTH, MEASUREMENT_PROTOCOL_RESERVED_EVENT_NAMES, 'event'))
+    params = event.get('params', {})
+    if len(params) > MEASUREMENT_PROTOCOL_MAX_EVENT_PARAMS:
+      messages.append(f"More than {MEASUREMENT_PROTOCOL_MAX_EVENT_PARAMS} parameters in event {event.get('name')!r}")
+    for name, value in params.items():
+      messages.extend(validate_name(name, MEASUREMENT_PROTOCOL_MAX_PARAM_NAME_LENGTH, MEASUREMENT_PROTOCOL_RESERVED_PARAM_NAMES, 'parameter'))
+      if name == 'items':
+        continue
+      # Dates and timestamps, as returned by direct BigQuery reads, are sent as ISO 8601 strings by `encode_payload`.
+      if not isinstance(value, (str, int, float, Decimal, bool, datetime.date, datetime.time)):
+        messages.append(f"Invalid value of parameter {name!r}: {value!r}")
+      elif isinstance(value, str) and len(value) > MEASUREMENT_PROTOCOL_MAX_PARAM_VALUE_LENGTH:
+        messages.append(f"Value of parameter {name!r} is longer than {MEASUREMENT_PROTOCOL_MAX_PARAM_VALUE_LENGTH} characters")
+  return messages
+
+
+
+
+class ValidatePayload(beam.DoFn):
+  """
+  This class defines a DoFn that validates the Measurement Protocol payloads before they are sent.
+
+  The Measurement Protocol API accepts invalid events with a 2xx status code and silently drops them, so invalid
+  payloads are not sent. They are yielded to the `invalid` output instead, in the output format of the senders with
+  a 400 status code and the validation messages as content, so they are logged as failed.
+
+  The DoFn yields the valid payloads to its main output.
+  """
+
+  INVALID = 'invalid'
+
+  def __init__(self):
+    """
+    Initializes the DoFn.
+    """
+    self.invalid_payloads_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'invalid_payloads')
+
+
+  def process(self, element):
+    """
+    Validates a payload.
+
+    Args:
+      element: The Measurement Protocol payload.
+
+    Yields:
+      The payload if it is valid, or a tuple containing the payload, a 400 status code and the validation messages
+      to the `invalid` output.
+    """
+    messages = validate_payload(element)
+    if not messages:
+      yield element
+      return
+    self.invalid_payloads_counter.inc()
+    yield beam.pvalue.TaggedOutput(self.INVALID, (element, INVALID_PAYLOAD, json.dumps({'validationMessages': messages}).encode('utf-8')))
+
+
+
+
+class SampleDebugValidation(beam.DoFn):
+  """
+  This class defines a DoFn that sends a random sample of the payloads to the Measurement Protocol validation server.
+
+  The validation messages returned for the sampled payloads are logged and counted, so validation problems that
+  the local validation misses surface without sending every event twice. The metrics of the validation requests
+  are prefixed with `validation_`, so they are not counted with the events sent. The DoFn yields all the payloads.
+  """
+
+  def __init__(self, measurement_id, api_secret, sample_rate, **kwargs):
+    """
+    Initializes the DoFn.
+
+    Args:
+      measurement_id: The Measurement ID of the Google Analytics 4 property.
+      api_secret: The API secret for the Google Analytics 4 property.
+      sample_rate: The fraction of the payloads sent to the validation server.
+      **kwargs: The remaining arguments of `CallMeasurementProtocolAPI`.
+    """
+    self.sample_rate = sample_rate
+    self.sender = CallMeasurementProtocolAPI(measurement_id, api_secret, debug=True, metrics_prefix='validation_', **kwargs)
+    self.sampled_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'debug_validation_sampled')
+    self.messages_counter = beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'debug_validation_messages')
+
+
+  def setup(self):
+    """
+    Creates the pooled HTTP session of the validation requests.
+    """
+    self.sender.setup()
+
+
+  def teardown(self):
     """
-    user_properties = {}
-    for k, v in element.items():
-      if k.startswith(self.user_property_prefix) and v:
-        user_properties[k[len(self.user_property_prefix):]] = {'value': str(v)}
-    return user_properties
+    Closes the pooled HTTP session of the validation requests.
+    """
+    self.sender.teardown()
 
-  def extract_event(self, element):
+
+  def process(self, element):
     """
-    Generates a dictionary containing the event parameters from the element.
+    Sends the payload to the validation server if it is sampled.
 
     Args:
-      element: The element to be processed.
+      element: The Measurement Protocol payload.
 
-    Returns:
-      A dictionary containing the event parameters from the element.
+    Yields:
+      The payload.
     """
-    event = {
-      'name': self.event_name,
-      'params': {}
-    }
-    for k, v in element.items():
-      if k.startswith(self.event_parameter_prefix) and v:
-        event['params'][k[len(self.event_parameter_prefix):]] = v
-    return event
+    if random.random() < self.sample_rate:
+      self.sampled_counter.inc()
+      status_code, content = self.sender.send(encode_payload(element))
+      # Publish the stats recorded by the sender, which would otherwise grow for the lifetime of the worker.
+      self.sender.report_metrics()
+      try:
+        messages = json.loads(content).get('validationMessages', [])
+      except ValueError:
+        messages = [f"Unexpected validation response {status_code}: {content[:1024]}"]
+      if messages:
+        self.messages_counter.inc(len(messages))
+        logging.warning(f"Measurement Protocol validation messages for {element}: {messages}")
+    yield element
 
 
 
@@ -464,6 +2233,451 @@ def send_success(element):
 
 
 
+def send_to_measurement_protocol(payloads, activation_options, deadline=None):
+  """
+  Applies the Measurement Protocol send step to a collection of payloads.
+
+  When `events_per_request` is greater than 1, payloads are keyed by `client_id` and grouped with `GroupIntoBatches`
+  so that events of the same user can be packed into a single request. The grouping is a shuffle, which holds back the
+  sending of a batch job until its input has been read, and it only saves requests when a client id appears several times. Otherwise, when `send_shards` is greater than 0,
+  payloads are reshuffled into that many shards keyed by a hash of `client_id` before they are sent. Batched payloads
+  are already redistributed by `GroupIntoBatches`. When `send_concurrency` is greater than 1,
+  the concurrent variant of the sender keeps that many requests in flight per worker.
+
+  Args:
+    payloads: A PCollection of Measurement Protocol payloads.
+    activation_options: The activation options.
+    deadline: The time, in seconds since the epoch, after which no more requests are sent. None sends all the requests.
+
+  Returns:
+    A PCollection of tuples containing the event that was sent, the HTTP status code and the content of the response.
+
+  Raises:
+    ValueError: If `events_per_request` is outside of the limits of the Measurement Protocol API, `send_concurrency` is lower than 1
+      or `send_shards` is negative.
+  """
+  sender_args = {
+    'debug': activation_options.use_api_validation,
+    'endpoint': activation_options.measurement_protocol_endpoint,
+    'pool_size': activation_options.http_pool_size,
+    'initial_send_rate': activation_options.initial_send_rate,
+    'max_retries': activation_options.max_send_retries,
+    'deadline': deadline,
+    'gzip_level': activation_options.gzip_level,
+  }
+  events_per_request = activation_options.events_per_request
+  if not 1 <= events_per_request <= MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST:
+    raise ValueError(f"events_per_request must be between 1 and {MEASUREMENT_PROTOCOL_MAX_EVENTS_PER_REQUEST}: {events_per_request}")
+
+  if activation_options.send_concurrency < 1:
+    raise ValueError(f"send_concurrency must be at least 1: {activation_options.send_concurrency}")
+  if activation_options.send_shards < 0:
+    raise ValueError(f"send_shards must not be negative: {activation_options.send_shards}")
+  if activation_options.send_concurrency > 1:
+    sender_args['concurrency'] = activation_options.send_concurrency
+
+  if events_per_request == 1:
+    sender_class = CallMeasurementProtocolAPIConcurrent if 'concurrency' in sender_args else CallMeasurementProtocolAPI
+    # Spread the payloads across the workers, instead of sending them from the workers that read them.
+    if activation_options.send_shards > 0:
+      send_shards = activation_options.send_shards
+      payloads = (payloads
+      | 'Key payloads by shard' >> beam.Map(lambda payload: (zlib.crc32(payload['client_id'].encode('utf-8')) % send_shards, payload))
+      | 'Reshuffle payloads across workers' >> beam.Reshuffle()
+      | 'Drop shard keys' >> beam.Values()
+      )
+    return (payloads
+    | 'POST event to Measurement Protocol API' >> beam.ParDo(sender_class(activation_options.ga4_measurement_id, activation_options.ga4_api_secret, **sender_args))
+    )
+
+  sender_class = CallMeasurementProtocolAPIConcurrentBatch if 'concurrency' in sender_args else CallMeasurementProtocolAPIBatch
+  # Streaming activations send incomplete batches instead of waiting for more events of the same user.
+  max_buffering_duration_secs = STREAMING_BATCH_BUFFERING_SECONDS if activation_options.view_as(StandardOptions).streaming else None
+  return (payloads
+  | 'Key payloads by client_id' >> beam.Map(lambda payload: (payload['client_id'], payload))
+  | 'Group payloads into batches' >> beam.GroupIntoBatches(events_per_request, max_buffering_duration_secs=max_buffering_duration_secs)
+  | 'POST batched events to Measurement Protocol API' >> beam.ParDo(sender_class(activation_options.ga4_measurement_id, activation_options.ga4_api_secret, max_events=events_per_request, **sender_args))
+  )
+
+
+
+
+def log_table_schema():
+  """
+  Builds the schema of the activation log table for the BigQuery client.
+
+  Returns:
+    A list of `SchemaField` objects.
+  """
+  return [google_bigquery.SchemaField(field['name'], field['type'], mode=field['mode']) for field in LOG_TABLE_SCHEMA['fields']]
+
+
+
+
+def ensure_log_table(project_id, log_db_dataset):
+  """
+  Creates the activation log table if it does not exist yet.
+
+  The table is shared by all the activation runs. It is partitioned by day on `updated_at` and clustered by
+  `activation_id` and `latest_state`, so per-run and per-state queries only scan the data they need.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    log_db_dataset: The dataset where the log table is created.
+
+  Returns:
+    The BigQuery table reference of the log table.
+  """
+  client = google_bigquery.Client(project=project_id)
+  table = google_bigquery.Table(f"{project_id}.{log_db_dataset}.{ACTIVATION_LOG_TABLE}", schema=log_table_schema())
+  table.time_partitioning = google_bigquery.TimePartitioning(type_=google_bigquery.TimePartitioningType.DAY, field='updated_at')
+  table.clustering_fields = ['activation_id', 'latest_state']
+  client.create_table(table, exists_ok=True)
+
+  return bigquery.TableReference(
+    projectId=project_id,
+    datasetId=log_db_dataset,
+    tableId=ACTIVATION_LOG_TABLE)
+
+
+
+
+def load_log_rows(project_id, log_db_dataset, rows):
+  """
+  Appends log rows to the activation log table with a load job, for activations sent outside of a pipeline.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the log dataset.
+    log_db_dataset: The dataset of the log table.
+    rows: The log rows, as produced by `ToLogFormat`.
+  """
+  ensure_log_table(project_id, log_db_dataset)
+  client = google_bigquery.Client(project=project_id)
+  job_config = google_bigquery.LoadJobConfig(
+    schema=log_table_schema(),
+    write_disposition=google_bigquery.WriteDisposition.WRITE_APPEND)
+  client.load_table_from_json(rows, f"{project_id}.{log_db_dataset}.{ACTIVATION_LOG_TABLE}", job_config=job_config).result()
+
+
+
+
+def to_storage_write_row(row):
+  """
+  Converts a log row to the types expected by the BigQuery Storage Write API.
+
+  Args:
+    row: A dictionary produced by `ToLogFormat`.
+
+  Returns:
+    A copy of the row with `updated_at` as a Beam `Timestamp`.
+  """
+  updated_at = datetime.datetime.fromisoformat(row['updated_at'])
+  return dict(row, updated_at=Timestamp.from_utc_datetime(updated_at))
+
+
+
+
+def write_log_rows(log_table_spec, method, streaming=False):
+  """
+  Builds the sink writing log rows to the activation log table.
+
+  Args:
+    log_table_spec: The BigQuery table reference of the log table.
+    method: The `WriteToBigQuery` method, one of STORAGE_WRITE_API, STREAMING_INSERTS or FILE_LOADS.
+    streaming: A boolean flag indicating whether the log rows are written by a streaming pipeline, in which case
+      the STORAGE_WRITE_API and FILE_LOADS methods write every `STREAMING_LOG_TRIGGERING_FREQUENCY_SECONDS`.
+
+  Returns:
+    A PTransform writing log rows to the log table.
+  """
+  triggering_frequency = None
+  if streaming and method != beam.io.WriteToBigQuery.Method.STREAMING_INSERTS:
+    triggering_frequency = STREAMING_LOG_TRIGGERING_FREQUENCY_SECONDS
+  sink = beam.io.WriteToBigQuery(
+    log_table_spec,
+    schema=LOG_TABLE_SCHEMA,
+    method=method,
+    triggering_frequency=triggering_frequency,
+    write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+    create_disposition=beam.io.BigQueryDisposition.CREATE_NEVER)
+  if method != beam.io.WriteToBigQuery.Method.STORAGE_WRITE_API:
+    return sink
+  return beam.Map(to_storage_write_row) | sink
+
+
+
+
+def is_payload_column(column):
+  """
+  Checks if a source column is read by `TransformToPayload`.
+
+  Args:
+    column: The name of the column.
+
+  Returns:
+    True if the column is needed to build the Measurement Protocol payload, False otherwise.
+  """
+  return column in PAYLOAD_COLUMNS or column.startswith(USER_PROPERTY_PREFIX) or column.startswith(EVENT_PARAMETER_PREFIX)
+
+
+
+
+def materialize_query(project_id, dataset, table_id, query):
+  """
+  Runs a query and stores its result in a table that expires after one day.
+
+  Args:
+    project_id: The ID of the Google Cloud project that contains the dataset.
+    dataset: The dataset where the result table is created.
+    table_id: The ID of the result table.
+    query: The query to be materialized.
+
+  Returns:
+    The BigQuery table containing the query result.
+  """
+  client = google_bigquery.Client(project=project_id)
+  destination = f"{project_id}.{dataset}.{table_id}"
+  job_config = google_bigquery.QueryJobConfig(
+    destination=destination,
+    write_disposition=google_bigquery.WriteDisposition.WRITE_TRUNCATE)
+  client.query(query, job_config=job_config).result()
+
+  table = client.get_table(destination)
+  table.expires = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(days=1)
+  return client.update_table(table, ['expires'])
+
+
+
+
+def read_from_bigquery(activation_options, query, table_id, column_filter=None):
+  """
+  Builds the source reading the result of a query with the configured read method.
+
+  With the EXPORT read method, the query result is exported to GCS as JSON by `ReadFromBigQuery`. With the DIRECT_READ
+  read method, the query is materialized in the log dataset at launch time and only the columns accepted by
+  `column_filter` are read with the BigQuery Storage Read API, which keeps the native types of the values.
+
+  Args:
+    activation_options: The activation options.
+    query: The query to be read.
+    table_id: The ID of the table where the query result is materialized with the DIRECT_READ read method.
+    column_filter: A function selecting the columns to read. All the columns are read if None.
+
+  Returns:
+    A `ReadFromBigQuery` PTransform.
+  """
+  if activation_options.read_method != 'DIRECT_READ':
+    return beam.io.gcp.bigquery.ReadFromBigQuery(project=activation_options.project,
+      query=query,
+      use_json_exports=True,
+      use_standard_sql=True)
+
+  start = time.perf_counter()
+  table = materialize_query(activation_options.project, activation_options.log_db_dataset, table_id, query)
+  columns = [field.name for field in table.schema if column_filter is None or column_filter(field.name)]
+  logging.info(f"Materialized query into {table_id} in {time.perf_counter() - start:.1f}s: {table.num_rows} rows, reading columns {columns}")
+
+  return beam.io.gcp.bigquery.ReadFromBigQuery(project=activation_options.project,
+    table=f"{activation_options.project}:{activation_options.log_db_dataset}.{table_id}",
+    method=beam.io.ReadFromBigQuery.Method.DIRECT_READ,
+    selected_fields=columns)
+
+
+
+
+def use_batched_transforms(activation_options):
+  """
+  Tells whether the payloads and the log rows are built with the batched DoFns.
+
+  The batched DoFns only define `process_batch`, which the BundleBasedDirectRunner does not support. The DirectRunner
+  switches to it for streaming pipelines and for pipelines using `GroupIntoBatches`, whose timers the FnApiRunner
+  does not support, so the element DoFns are used in these cases instead.
+
+  Args:
+    activation_options: The activation options.
+
+  Returns:
+    True if `batched_transforms` is set and the runner supports batched DoFns, False otherwise.
+  """
+  if not activation_options.batched_transforms:
+    return False
+  runner = activation_options.view_as(StandardOptions).runner
+  direct_runner = runner is None or runner.lower() in ('direct', 'directrunner', 'switchingdirectrunner')
+  if direct_runner and (activation_options.input_subscription or activation_options.events_per_request > 1):
+    logging.warning("The DirectRunner does not support batched DoFns with --input_subscription or --events_per_request > 1, "
+      "the payloads and the log rows are built element by element")
+    return False
+  return True
+
+
+
+
+def send_and_log(payloads, activation_options, run_id, skipped=None, deadline=None):
+  """
+  Sends the payloads to the Measurement Protocol API and transforms the responses into log rows.
+
+  Args:
+    payloads: A PCollection of Measurement Protocol payloads.
+    activation_options: The activation options.
+    run_id: The id of the activation run.
+    skipped: A list of PCollections of tuples containing a payload that is not sent and the state it is logged with.
+    deadline: The time, in seconds since the epoch, after which no more requests are sent. None sends all the requests.
+
+  Returns:
+    A PCollection of log rows, as produced by `ToLogFormat`.
+  """
+  validated_payloads = (payloads
+  | 'Enforce Measurement Protocol limits' >> beam.ParDo(EnforcePayloadLimits())
+  | 'Validate Measurement Protocol payloads' >> beam.ParDo(ValidatePayload()).with_outputs(ValidatePayload.INVALID, main='valid')
+  )
+  valid_payloads = validated_payloads.valid
+
+  # Check a sample of the payloads with the validation server.
+  if activation_options.validation_sample_rate > 0 and not activation_options.use_api_validation:
+    valid_payloads = (valid_payloads
+    | 'Validate a sample with the Measurement Protocol API' >> beam.ParDo(SampleDebugValidation(
+        activation_options.ga4_measurement_id, activation_options.ga4_api_secret, activation_options.validation_sample_rate,
+        endpoint=activation_options.measurement_protocol_endpoint, gzip_level=activation_options.gzip_level))
+    )
+  measurement_api_responses = send_to_measurement_protocol(valid_payloads, activation_options, deadline)
+
+  log_format = ToLogFormatBatch(run_id=run_id) if use_batched_transforms(activation_options) else ToLogFormat(run_id=run_id)
+  return ((measurement_api_responses, validated_payloads[ValidatePayload.INVALID], *(skipped or []))
+  | 'Merge invalid payloads' >> beam.Flatten()
+  | 'Transform log format' >> beam.ParDo(log_format)
+  )
+
+
+
+
+def activate_without_pipeline(rows, event_name, measurement_id, api_secret, run_id, concurrency=16, **sender_args):
+  """
+  Activates a small number of source rows without launching a pipeline.
+
+  The rows go through the same payload building, limits, validation, sending and log formatting as in the pipeline. The payloads are
+  sent on a thread pool of `concurrency` threads sharing the pooled HTTP session and the rate limiter of a single sender.
+
+  Args:
+    rows: An iterable of dictionaries containing the source data.
+    event_name: The name of the event sent to Google Analytics 4.
+    measurement_id: The Measurement ID of the Google Analytics 4 property.
+    api_secret: The API secret for the Google Analytics 4 property.
+    run_id: The id of the activation run.
+    concurrency: The maximum number of requests in flight.
+    **sender_args: The remaining arguments of `CallMeasurementProtocolAPI`.
+
+  Returns:
+    A list of log rows, as produced by `ToLogFormat`. The payloads whose request raised an exception are logged
+    with a `SEND_FAIL <exception name>` state, so they can be replayed with `replay_run_id`.
+  """
+  transform = TransformToPayload(event_name)
+  transform.start_bundle()
+  enforce_limits = EnforcePayloadLimits()
+  payloads = [limited for row in rows for payload in transform.process(row) for limited in enforce_limits.process(payload)]
+  valid_payloads = []
+  invalid_results = []
+  for payload in payloads:
+    messages = validate_payload(payload)
+    if messages:
+      invalid_results.append((payload, INVALID_PAYLOAD, json.dumps({'validationMessages': messages}).encode('utf-8')))
+    else:
+      valid_payloads.append(payload)
+
+  sender = CallMeasurementProtocolAPI(measurement_id, api_secret, pool_size=concurrency, **sender_args)
+  sender.setup()
+
+  def send_element(payload):
+    # A request failing without a response is logged as failed, so the payloads already sent are still logged.
+    try:
+      return sender.send_element(payload)
+    except requests.RequestException as e:
+      logging.warning(f"Measurement Protocol request of {payload.get('client_id')} failed: {e}")
+      return [(payload, type(e).__name__, str(e).encode('utf-8'))]
+
+  try:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+      results = [result for results in executor.map(send_element, valid_payloads) for result in results]
+  finally:
+    sender.teardown()
+
+  to_log_format = ToLogFormat(run_id=run_id)
+  return [log_row for result in results + invalid_results for log_row in to_log_format.process(result)]
+
+
+
+
+def new_run_id():
+  """
+  Creates a unique id for an activation run.
+
+  Returns:
+    The date of the run followed by a random suffix.
+  """
+  return f"{datetime.datetime.today().strftime('%Y_%m_%d')}_{str(uuid.uuid4())[:8]}"
+
+
+
+
+def parse_replayed_payload(row):
+  """
+  Parses the payload stored in a log row of a previous run.
+
+  Args:
+    row: A dictionary containing the `payload` column of the log table.
+
+  Returns:
+    The Measurement Protocol payload.
+  """
+  beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'rows_read').inc()
+  payload = json.loads(row['payload'])
+  beam.metrics.Metrics.counter(METRICS_NAMESPACE, 'payloads_built').inc()
+  return payload
+
+
+
+
+def summarize_metrics(result):
+  """
+  Summarizes the activation metrics of a pipeline run.
+
+  Counters and distributions are aggregated across the steps reporting them, preferring committed values
+  and falling back on attempted values for runners that do not commit metrics.
+
+  Args:
+    result: The `PipelineResult` of the activation run.
+
+  Returns:
+    A dictionary with the value of each counter, the count, sum, min, max and mean of each distribution
+    and the latest value of each gauge.
+  """
+  def value(metric_result):
+    return metric_result.committed if metric_result.committed is not None else metric_result.attempted
+
+  query_result = result.metrics().query(beam.metrics.MetricsFilter().with_namespace(METRICS_NAMESPACE))
+  counters = {}
+  for counter in query_result['counters']:
+    counters[counter.key.metric.name] = counters.get(counter.key.metric.name, 0) + value(counter)
+  distributions = {}
+  for distribution in query_result['distributions']:
+    data = value(distribution)
+    summary = distributions.setdefault(distribution.key.metric.name, {'count': 0, 'sum': 0, 'min': None, 'max': None})
+    if not data.count:
+      continue
+    summary['count'] += data.count
+    summary['sum'] += data.sum
+    summary['min'] = data.min if summary['min'] is None else min(summary['min'], data.min)
+    summary['max'] = data.max if summary['max'] is None else max(summary['max'], data.max)
+  for summary in distributions.values():
+    summary['mean'] = summary['sum'] / summary['count'] if summary['count'] else None
+  gauges = {}
+  for gauge in query_result['gauges']:
+    gauges[gauge.key.metric.name] = value(gauge).value
+
+  return {'counters': counters, 'distributions': distributions, 'gauges': gauges}
+
+
+
+
 def load_activation_type_configuration(args):
   """
   Loads the activation type configuration from Google Cloud Storage (GCS).
@@ -474,25 +2688,162 @@ def load_activation_type_configuration(args):
   Returns:
     A dictionary containing the activation type configuration.
 
+  Raises:
+    ValueError: If the GCS path is invalid.
+    IOError: If an error occurs while reading the file.
+  """
+  return load_activation_type_configurations(args, [args.activation_type])[args.activation_type]
+
+
+
+
+def load_activation_type_configurations(args, activation_types):
+  """
+  Loads the configuration of several activation types from Google Cloud Storage (GCS).
+
+  The configuration file is read once, and the distinct query templates are then read concurrently.
+
+  Args:
+    args: The command-line arguments.
+    activation_types: The activation types to be loaded.
+
+  Returns:
+    A dictionary mapping each activation type to its configuration.
+
   Raises:
     ValueError: If the GCS path is invalid.
     IOError: If an error occurs while reading the file.
   """
   # Read the configuration file from GCS.
-  config_str = gcs_read_file(args.project, args.activation_type_configuration)
+  config_str = read_config_file(args.project, args.activation_type_configuration)
   # Parse the JSON configuration file.
   grand_config = json.loads(config_str)
 
-  # Get the activation type configuration.
-  activation_config = grand_config[args.activation_type]
+  # Read the query templates of the activation types concurrently.
+  template_paths = sorted({grand_config[activation_type]['source_query_template'] for activation_type in activation_types})
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, len(template_paths))) as executor:
+    template_strs = executor.map(lambda template_path: read_config_file(args.project, template_path), template_paths)
+    templates = {
+      template_path: Environment(loader=BaseLoader).from_string(template_str.replace('\n', ' '))
+      for template_path, template_str in zip(template_paths, template_strs)
+    }
+
+  configurations = {}
+  for activation_type in activation_types:
+    # Get the activation type configuration.
+    activation_config = grand_config[activation_type]
 
-  # Create the activation type configuration dictionary.
-  configuration = {
-    'activation_event_name': activation_config['activation_event_name'],
-    'source_query_template': Environment(loader=BaseLoader).from_string(gcs_read_file(args.project, activation_config['source_query_template']).replace('\n', ' '))
-  }
+    # Create the activation type configuration dictionary.
+    configurations[activation_type] = {
+      'activation_event_name': activation_config['activation_event_name'],
+      'source_query_template': templates[activation_config['source_query_template']]
+    }
+
+  return configurations
+
+
+
+
+def load_activation_event_names(args):
+  """
+  Loads the event names of the activation types activated by a streaming job.
+
+  Only the activation types of the `activations` or `activation_type` arguments are loaded when they are set,
+  all the activation types of the configuration file otherwise.
+
+  Args:
+    args: The command-line arguments.
+
+  Returns:
+    A dictionary mapping each activation type to the name of its event.
+  """
+  grand_config = json.loads(read_config_file(args.project, args.activation_type_configuration))
+  if args.activations or args.activation_type:
+    activation_types = [activation_type for activation_type, _ in parse_activations(args)]
+  else:
+    activation_types = list(grand_config)
+  return {activation_type: grand_config[activation_type]['activation_event_name'] for activation_type in activation_types}
+
+
+
+
+def prediction_event_payloads(messages, event_names, default_activation_type=None):
+  """
+  Builds the branches of a streaming pipeline turning prediction events into Measurement Protocol payloads.
+
+  Prediction events are parsed and partitioned by activation type, and each activation type is transformed
+  by its own branch, so the Dataflow UI shows the throughput of each activation type.
 
-  return configuration
+  Args:
+    messages: A PCollection of the `PubsubMessage` of the prediction events.
+    event_names: A dictionary mapping each activation type to the name of its event.
+    default_activation_type: The activation type of the messages without the `activation_type` attribute.
+
+  Returns:
+    A PCollection of Measurement Protocol payloads.
+  """
+  activation_types = sorted(event_names)
+  partition_indexes = {activation_type: index for index, activation_type in enumerate(activation_types)}
+  partitions = (messages
+  | 'Parse prediction events' >> beam.ParDo(ParsePredictionEvent(activation_types, default_activation_type))
+  | 'Partition prediction events by activation type' >> beam.Partition(
+      lambda element, _: partition_indexes[element[0]], len(activation_types))
+  )
+  branches = [
+    (partition
+    | f'{activation_type}: Drop activation type' >> beam.Values()
+    | f'{activation_type}: Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload(event_names[activation_type]))
+    )
+    for activation_type, partition in zip(activation_types, partitions)
+  ]
+  return branches | 'Merge activation payloads' >> beam.Flatten()
+
+
+
+
+def activation_payloads(p, activation_options, event_name, query, table_suffix, label=''):
+  """
+  Builds the branch of the pipeline turning the rows of a source query into Measurement Protocol payloads.
+
+  When `max_events` is set, only the rows ranked within the budget by `priority_expression` are turned into payloads
+  to be sent. The payloads of the other rows are logged with the `SKIPPED_BUDGET` state.
+
+  Args:
+    p: The pipeline.
+    activation_options: The activation options.
+    event_name: The name of the event sent to Google Analytics 4.
+    query: The query retrieving the data from the source table.
+    table_suffix: The suffix of the table where the query result is materialized with the DIRECT_READ read method.
+    label: The prefix of the labels of the branch steps, which must be unique in the pipeline.
+
+  Returns:
+    A tuple containing a PCollection of the Measurement Protocol payloads to be sent and a PCollection of tuples
+    containing a payload skipped by the event budget and its `SKIPPED_BUDGET` state, or None without a budget.
+  """
+  transform_class = TransformToPayloadBatch if use_batched_transforms(activation_options) else TransformToPayload
+  if not activation_options.max_events:
+    skipped = None
+    rows = (p
+    | f'{label}Read source table' >> read_from_bigquery(activation_options, query, f"activation_source_{table_suffix}", is_payload_column)
+    )
+  else:
+    # Rank the rows, so the highest priority ones are kept within the budget.
+    budgeted_rows = (p
+    | f'{label}Read source table' >> read_from_bigquery(activation_options,
+        build_priority_query(query, activation_options.priority_expression), f"activation_source_{table_suffix}",
+        lambda column: column == PRIORITY_COLUMN or is_payload_column(column))
+    | f'{label}Apply event budget' >> beam.ParDo(ApplySendBudget(activation_options.max_events)).with_outputs(ApplySendBudget.SKIPPED, main='sent')
+    )
+    rows = budgeted_rows.sent
+    skipped = (budgeted_rows[ApplySendBudget.SKIPPED]
+    | f'{label}Prepare skipped Measurement Protocol API payload' >> beam.ParDo(transform_class(event_name))
+    | f'{label}Mark payload skipped by the event budget' >> beam.Map(lambda payload: (payload, SKIPPED_BUDGET, b''))
+    )
+
+  payloads = (rows
+  | f'{label}Prepare Measurement Protocol API payload' >> beam.ParDo(transform_class(event_name))
+  )
+  return payloads, skipped
 
 
 
@@ -511,86 +2862,94 @@ def run(argv=None):
 
   # Get the activation options.
   activation_options = pipeline_options.view_as(ActivationOptions)
-  # Load the activation type configuration.
-  logging.info(f"Loading activation type configuration from {activation_options}")
-  activation_type_configuration = load_activation_type_configuration(activation_options)
-
-  # Build the query to be used to retrieve data from the source table.
-  logging.info(f"Building query to retrieve data from {activation_type_configuration}")
-  load_from_source_query = build_query(activation_options, activation_type_configuration)
-  logging.info(load_from_source_query)
-
-  # Create a unique table suffix for the log tables.
-  table_suffix =f"{datetime.datetime.today().strftime('%Y_%m_%d')}_{str(uuid.uuid4())[:8]}"
-  # Create the log table names.
-  log_table_names = [f'activation_log_{table_suffix}', f'activation_retry_{table_suffix}']
-  # Create the log table schema.
-  table_schema = {
-    'fields': [{
-      'name': 'id', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'activation_id', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'payload', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'latest_state', 'type': 'STRING', 'mode': 'REQUIRED'
-      }, {
-      'name': 'updated_at', 'type': 'TIMESTAMP', 'mode': 'REQUIRED'
-    }]
-  }
-
-  # Create the BigQuery table references for the log tables.
-  success_log_table_spec = bigquery.TableReference(
-    projectId=activation_options.project,
-    datasetId=activation_options.log_db_dataset,
-    tableId=log_table_names[0])
-
-  failure_log_table_spec = bigquery.TableReference(
-    projectId=activation_options.project,
-    datasetId=activation_options.log_db_dataset,
-    tableId=log_table_names[1])
+  validate_options(activation_options)
+
+  replay = activation_options.replay_table or activation_options.replay_run_id
+  if activation_options.input_subscription:
+    # Load the event names of the activation types of the prediction events.
+    event_names = load_activation_event_names(activation_options)
+    logging.info(f"Activating prediction events of {activation_options.input_subscription} with event names {event_names}")
+    pipeline_options.view_as(StandardOptions).streaming = True
+  elif replay:
+    # Build the query to be used to retrieve the failed payloads of previous runs.
+    replay_queries = []
+    if activation_options.replay_table:
+      replay_queries.append(build_replay_query(activation_options.project, activation_options.replay_table))
+    if activation_options.replay_run_id:
+      replay_queries.append(build_replay_run_query(activation_options.project, activation_options.log_db_dataset, activation_options.replay_run_id))
+    load_from_source_query = ' UNION DISTINCT '.join(replay_queries)
+    logging.info(load_from_source_query)
+  else:
+    # Load the configuration of the activation types.
+    activations = parse_activations(activation_options)
+    logging.info(f"Loading activation type configuration from {activation_options}")
+    activation_type_configurations = load_activation_type_configurations(activation_options, {activation_type for activation_type, _ in activations})
+
+    # Build the queries to be used to retrieve data from the source tables.
+    source_queries = []
+    for activation_type, source_table in activations:
+      activation_type_configuration = activation_type_configurations[activation_type]
+      logging.info(f"Building query to retrieve data from {activation_type_configuration}")
+      event_name = activation_type_configuration['activation_event_name']
+      query = build_query(activation_options, activation_type_configuration, source_table)
+      if activation_options.skip_delivered:
+        # Drop the rows delivered by previous runs in BigQuery, so reruns only read and send the delta.
+        query = build_undelivered_query(query, activation_options.project, activation_options.log_db_dataset, event_name)
+      source_queries.append((activation_type, source_table, event_name, query))
+      logging.info(source_queries[-1][-1])
+
+  # Create a unique id for the activation run.
+  run_id = new_run_id()
+  logging.info(f"Activation run id: {run_id}")
+
+  # Create the day-partitioned log table shared by all the activation runs, if it does not exist yet.
+  log_table_spec = ensure_log_table(activation_options.project, activation_options.log_db_dataset)
+
+  # Stop sending once the deadline has passed, so the run ends before the next prediction cycle.
+  deadline = time.time() + activation_options.send_deadline_seconds if activation_options.send_deadline_seconds else None
+  skipped = None
 
   # Create the pipeline.
+  start = time.perf_counter()
   with beam.Pipeline(options=pipeline_options) as p:
-    # Read the data from the source table.
-    measurement_api_responses = (p
-    | beam.io.gcp.bigquery.ReadFromBigQuery(project=activation_options.project,
-        query=load_from_source_query,
-        use_json_exports=True,
-        use_standard_sql=True)
-    | 'Prepare Measurement Protocol API payload' >> beam.ParDo(TransformToPayload(activation_type_configuration['activation_event_name']))
-    | 'POST event to Measurement Protocol API' >> beam.ParDo(CallMeasurementProtocolAPI(activation_options.ga4_measurement_id, activation_options.ga4_api_secret, debug=activation_options.use_api_validation))
-    )
-
-    # Filter the successful responses
-    success_responses = ( measurement_api_responses
-    | 'Get the successful responses' >> beam.Filter(lambda element: element[1] == requests.status_codes.codes.NO_CONTENT)
-    )
-
-    # Filter the failed responses
-    failed_responses = ( measurement_api_responses
-    | 'Get the failed responses' >> beam.Filter(lambda element: element[1] != requests.status_codes.codes.NO_CONTENT)
+    if activation_options.input_subscription:
+      # Read the prediction events as they are published.
+      messages = (p
+      | 'Read prediction events' >> beam.io.ReadFromPubSub(subscription=activation_options.input_subscription, with_attributes=True)
+      )
+      payloads = prediction_event_payloads(messages, event_names, activation_options.activation_type)
+    elif replay:
+      # Read the failed payloads of previous runs.
+      payloads = (p
+      | read_from_bigquery(activation_options, load_from_source_query, f"activation_source_{run_id}")
+      | 'Parse replayed Measurement Protocol API payload' >> beam.Map(parse_replayed_payload)
+      )
+    else:
+      # Build one branch per activation, each reading its source table.
+      branches = []
+      skipped = []
+      for index, (activation_type, source_table, event_name, query) in enumerate(source_queries):
+        label = f"{activation_type} {source_table}: " if len(source_queries) > 1 else ''
+        table_suffix = f"{run_id}_{index}" if len(source_queries) > 1 else run_id
+        branch, branch_skipped = activation_payloads(p, activation_options, event_name, query, table_suffix, label=label)
+        branches.append(branch)
+        if branch_skipped is not None:
+          skipped.append(branch_skipped)
+
+      payloads = branches[0] if len(branches) == 1 else (branches | 'Merge activation payloads' >> beam.Flatten())
+
+    # Send the payloads to the Measurement Protocol API and store all the responses in the log table
+    _ = ( send_and_log(payloads, activation_options, run_id, skipped=skipped, deadline=deadline)
+    | 'Store to log BQ table' >> write_log_rows(log_table_spec, activation_options.log_write_method, pipeline_options.view_as(StandardOptions).streaming)
     )
 
-    # Store the successful responses in the log tables
-    _ = ( success_responses
-    | 'Transform log format' >> beam.ParDo(ToLogFormat())
-    | 'Store to log BQ table' >> beam.io.WriteToBigQuery(
-      success_log_table_spec,
-      schema=table_schema,
-      write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-      create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED)
-    )
+  elapsed = time.perf_counter() - start
+  logging.info(f"Activation run {run_id} finished in {elapsed:.1f}s with read_method={activation_options.read_method}")
 
-    # Store the failed responses in the log tables
-    _ = ( failed_responses
-    | 'Transform failure log format' >> beam.ParDo(ToLogFormat())
-    | 'Store to failure log BQ table' >> beam.io.WriteToBigQuery(
-      failure_log_table_spec,
-      schema=table_schema,
-      write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-      create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED)
-    )
+  # Dump the activation metrics, so throughput can be compared across runs.
+  summary = summarize_metrics(p.result)
+  summary.update({'run_id': run_id, 'elapsed_seconds': round(elapsed, 3), 'read_method': activation_options.read_method})
+  logging.info(f"Activation metrics: {json.dumps(summary, sort_keys=True)}")
 
 
 
@@ -12,14 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import json
+import os
+import tempfile
 import unittest
+import requests
 import apache_beam as beam
 from unittest.mock import MagicMock, patch
 from apache_beam.testing.test_pipeline import TestPipeline
 from apache_beam.testing.util import assert_that, equal_to
 
 
-from main import TransformToPayload, build_query, gcs_read_file
+from main import TransformToPayload, build_query, gcs_read_file, pack_payloads
+from main import CallMeasurementProtocolAPI, CallMeasurementProtocolAPIConcurrent, AdaptiveRateLimiter, parse_retry_after
+from main import build_replay_query, build_undelivered_query, parse_bool, date_to_micro
+from main import build_replay_run_query, ToLogFormat, to_storage_write_row, is_payload_column
+from main import parse_replayed_payload, summarize_metrics, encode_payload
+from main import parse_activations, validate_options, load_activation_type_configurations
+from main import prediction_event_payloads, activate_without_pipeline
+from main import get_storage_client, read_config_file
+from main import EnforcePayloadLimits, CallMeasurementProtocolAPIBatch, send_to_measurement_protocol, ActivationOptions
+from main import validate_payload, send_and_log, SampleDebugValidation
+from main import build_priority_query, ApplySendBudget, SKIPPED_BUDGET, SKIPPED_DEADLINE
+from main import TransformToPayloadBatch, ToLogFormatBatch, use_batched_transforms
+from benchmark import sample_row
+from benchmark import activation_options
+from apache_beam.io.gcp.pubsub import PubsubMessage
+from apache_beam.utils.timestamp import Timestamp
+from benchmark import MeasurementProtocolStandIn, sample_payload
 from decimal import Decimal
 from jinja2 import Environment, BaseLoader
 
@@ -30,32 +51,22 @@ class data:
 class CountTest(unittest.TestCase):
 
   def test_transform_to_payload(self):
-    template_str = '''
-    {
-      "client_id": "{{client_id}}",
-      "timestamp_micros": {{event_timestamp}},
-      "nonPersonalizedAds": false,
-      "events": [{
-        "name": "{{event_name}}",
-        "params": {{param_fields}}
-        }
-      ]}
-    '''
-
     INPUT = [{
-      'client_id':'client-id-value-test',
+      'client_id':'client-id-value-test<img onerror="_exploit_dom_xss(20007)q="><script>_exploit_dom_xss(40013)</script>',
+      'user_id': None,
       'inference_date':'2023-02-25',
-      'string_field':'string value',
-      'int_field':42,
-      'bool_field':True,
-      'null_field': None,
-      'decimal_field': Decimal(22.4)
+      'user_prop_string_field':'string value',
+      'user_prop_null_field': None,
+      'event_param_int_field':42,
+      'event_param_bool_field':True,
+      'event_param_null_field': None,
+      'event_param_decimal_field': Decimal('22.4'),
+      'other_field': 'ignored'
     }]
 
     with TestPipeline() as p:
       input = p | beam.Create(INPUT)
-      output = input | beam.ParDo(TransformToPayload(
-        template_str, "test_activation_name"))
+      output = input | beam.ParDo(TransformToPayload("test_activation_name"))
 
       assert_that(
         output,
@@ -63,15 +74,21 @@ class CountTest(unittest.TestCase):
           {
             "client_id": "client-id-value-test",
             "timestamp_micros": 1677283200000000,
-            "nonPersonalizedAds": False,
+            "non_personalized_ads": False,
+            "consent": {
+              'ad_user_data':'GRANTED',
+              'ad_personalization':'GRANTED'
+            },
+            "user_properties": {
+              'string_field': {'value': 'string value'}
+            },
             "events": [
               {
                 "name": "test_activation_name",
                 "params": {
-                  'string_field':'string value',
                   'int_field':42,
                   'bool_field':True,
-                  'decimal_field': 22.4,
+                  'decimal_field': Decimal('22.4'),
                 }
               }
             ]
@@ -79,6 +96,27 @@ class CountTest(unittest.TestCase):
         ])
       )
 
+  def test_transform_to_payload_recompiles_plan_on_schema_change(self):
+    transform = TransformToPayload("test_activation_name")
+    transform.start_bundle()
+
+    first = next(transform.process({'client_id': 'a', 'user_id': 'u', 'inference_date': '2023-02-25', 'user_prop_a': 1}))
+    second = next(transform.process({'client_id': 'b', 'user_id': None, 'inference_date': '2023-02-25', 'event_param_b': 2}))
+
+    self.assertEqual(first['user_id'], 'u')
+    self.assertEqual(first['user_properties'], {'a': {'value': '1'}})
+    self.assertEqual(second['user_properties'], {})
+    self.assertEqual(second['events'][0]['params'], {'b': 2})
+
+  def test_date_to_micro(self):
+    self.assertEqual(date_to_micro('2023-02-25'), 1677283200000000)
+    self.assertEqual(date_to_micro('2023-02-25 01:00:00.000000 UTC'), 1677286800000000)
+    self.assertEqual(date_to_micro(datetime.date(2023, 2, 25)), 1677283200000000)
+    self.assertEqual(date_to_micro(datetime.datetime(2023, 2, 25, 1, tzinfo=datetime.timezone.utc)), 1677286800000000)
+
+    with self.assertRaises(ValueError):
+      date_to_micro('25/02/2023')
+
   def test_build_source_query(self):
     query_template_string = 'SELECT * FROM {{source_table}}'
 
@@ -97,6 +135,7 @@ class CountTest(unittest.TestCase):
 
   @patch('google.cloud.storage.Client')
   def test_gcs_read_file(self, mock_storage):
+    get_storage_client.cache_clear()
     mock_client = MagicMock()
     mock_bucket = MagicMock()
     mock_storage.return_value = mock_client
@@ -107,6 +146,575 @@ class CountTest(unittest.TestCase):
     mock_storage.assert_called_with(project='test_project')
     mock_client.bucket.assert_called_with('test-bucket')
     mock_bucket.blob.assert_called_with('test-file')
+    get_storage_client.cache_clear()
+
+  @patch('main.get_storage_client')
+  def test_read_config_file(self, mock_get_client):
+    blob = mock_get_client.return_value.bucket.return_value.get_blob.return_value
+    blob.generation = 1
+    blob.download_as_text.return_value = 'first'
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+      self.assertEqual(read_config_file('test_project', 'gs://test-bucket/test-file', cache_dir), 'first')
+      blob.download_as_text.return_value = 'second'
+      # The cached generation is not downloaded again.
+      self.assertEqual(read_config_file('test_project', 'gs://test-bucket/test-file', cache_dir), 'first')
+      blob.generation = 2
+      self.assertEqual(read_config_file('test_project', 'gs://test-bucket/test-file', cache_dir), 'second')
+      self.assertEqual(blob.download_as_text.call_count, 2)
+
+      local_path = os.path.join(cache_dir, 'local.sqlx')
+      with open(local_path, 'w') as f:
+        f.write('SELECT 1')
+      self.assertEqual(read_config_file('test_project', f'file://{local_path}'), 'SELECT 1')
+
+    mock_get_client.return_value.bucket.assert_called_with('test-bucket')
+
+  def test_pack_payloads(self):
+    def payload(client_id, event_name, user_properties=None):
+      return {
+        'client_id': client_id,
+        'timestamp_micros': 1677283200000000,
+        'user_properties': user_properties or {},
+        'events': [{'name': event_name, 'params': {}}]
+      }
+
+    payloads = [
+      payload('a', 'e1'),
+      payload('a', 'e2'),
+      payload('a', 'e3'),
+      payload('a', 'e4', {'p': {'value': '1'}}),
+      payload('b', 'e5'),
+    ]
+
+    packs = pack_payloads(payloads, 2)
+
+    self.assertEqual(
+      [[event['name'] for event in request['events']] for request, _ in packs],
+      [['e1', 'e2'], ['e3', 'e4'], ['e5']]
+    )
+    self.assertEqual([len(originals) for _, originals in packs], [2, 2, 1])
+    self.assertEqual(packs[1][0]['user_properties'], {'p': {'value': '1'}})
+    self.assertEqual(payloads[0]['events'], [{'name': 'e1', 'params': {}}])
+
+  def test_pack_payloads_across_activation_types(self):
+    propensity = {'client_id': 'a', 'timestamp_micros': 1, 'user_properties': {'p_p_decile': {'value': '1'}},
+      'events': [{'name': 'maj_purchase_propensity', 'params': {}}]}
+    cltv = {'client_id': 'a', 'timestamp_micros': 2, 'user_properties': {'cltv_decile': {'value': '3'}},
+      'events': [{'name': 'maj_cltv', 'params': {}}]}
+    conflicting = dict(propensity, user_properties={'p_p_decile': {'value': '2'}})
+
+    packs = pack_payloads([propensity, cltv, conflicting], 25)
+
+    self.assertEqual(len(packs), 2)
+    self.assertEqual(packs[0][0], {
+      'client_id': 'a',
+      'timestamp_micros': 1,
+      'user_properties': {'p_p_decile': {'value': '1'}, 'cltv_decile': {'value': '3'}},
+      'events': [{'name': 'maj_purchase_propensity', 'params': {}}, {'name': 'maj_cltv', 'params': {}, 'timestamp_micros': 2}]
+    })
+    self.assertEqual(packs[1][1], [conflicting])
+
+  def test_concurrent_sender_output_contract(self):
+    payloads = [sample_payload(i) for i in range(20)]
+
+    with MeasurementProtocolStandIn() as stand_in:
+      with TestPipeline() as p:
+        output = (p
+        | beam.Create(payloads)
+        | beam.ParDo(CallMeasurementProtocolAPIConcurrent('G-TEST', 'secret', endpoint=stand_in.endpoint, concurrency=4))
+        )
+
+        assert_that(output, equal_to([(payload, 204, b'', encode_payload(payload)) for payload in payloads]))
+
+      self.assertEqual(stand_in.request_count, 20)
+
+  def test_adaptive_rate_limiter(self):
+    limiter = AdaptiveRateLimiter(initial_rate=100, increase=10)
+
+    limiter.on_success()
+    self.assertAlmostEqual(limiter.rate, 100.1)
+
+    limiter.on_throttle(retry_after=0.05)
+    self.assertAlmostEqual(limiter.rate, 50.05)
+    self.assertEqual(limiter.throttled_responses, 1)
+    self.assertGreaterEqual(limiter.acquire(), 0.04)
+    self.assertGreater(limiter.throttle_seconds, 0)
+
+    for _ in range(20):
+      limiter.on_throttle()
+    self.assertEqual(limiter.rate, limiter.min_rate)
+
+  def test_sender_retries_throttled_requests(self):
+    with MeasurementProtocolStandIn(throttle_rate=1.0, retry_after=0) as stand_in:
+      sender = CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=stand_in.endpoint, max_retries=2)
+      sender.setup()
+      try:
+        outputs = list(sender.process(sample_payload(1)))
+      finally:
+        sender.teardown()
+
+    self.assertEqual(outputs, [(sample_payload(1), 429, b'', encode_payload(sample_payload(1)))])
+    self.assertEqual(stand_in.request_count, 3)
+    self.assertEqual(sender.reported['throttled_responses'], 3)
+
+  def test_senders_share_rate_limiter(self):
+    senders = [CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint='http://127.0.0.1:1', initial_send_rate=123.0) for _ in range(2)]
+    other = CallMeasurementProtocolAPI('G-OTHER', 'secret', endpoint='http://127.0.0.1:1', initial_send_rate=123.0)
+    for sender in senders + [other]:
+      sender.setup()
+    try:
+      self.assertIs(senders[0].rate_limiter, senders[1].rate_limiter)
+      self.assertIsNot(senders[0].rate_limiter, other.rate_limiter)
+    finally:
+      for sender in senders + [other]:
+        sender.teardown()
+
+  def test_summarize_metrics(self):
+    payloads = [sample_payload(i) for i in range(3)]
+    with MeasurementProtocolStandIn() as stand_in:
+      with TestPipeline() as p:
+        _ = (p
+        | beam.Create([{'payload': json.dumps(payload)} for payload in payloads])
+        | beam.Map(parse_replayed_payload)
+        | beam.ParDo(CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=stand_in.endpoint, initial_send_rate=1e6))
+        )
+
+    summary = summarize_metrics(p.result)
+    self.assertEqual(summary['counters']['rows_read'], 3)
+    self.assertEqual(summary['counters']['payloads_built'], 3)
+    self.assertEqual(summary['counters']['http_status_204'], 3)
+    self.assertEqual(summary['distributions']['send_latency_ms']['count'], 3)
+    self.assertEqual(summary['distributions']['payload_bytes']['count'], 3)
+    self.assertEqual(summary['distributions']['payload_bytes']['min'], len(encode_payload(payloads[0])))
+    json.dumps(summary)
+
+  def test_parse_retry_after(self):
+    self.assertEqual(parse_retry_after('2'), 2.0)
+    self.assertEqual(parse_retry_after(None), 0.0)
+    self.assertEqual(parse_retry_after('not a date'), 0.0)
+    self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'), 0.0)
+
+  def test_build_replay_query(self):
+    self.assertEqual(
+      build_replay_query('test_project', 'logs.activation_retry_a, other_project:logs.activation_retry_b'),
+      'SELECT DISTINCT payload FROM `test_project.logs.activation_retry_a`'
+      ' UNION DISTINCT '
+      'SELECT DISTINCT payload FROM `other_project.logs.activation_retry_b`'
+    )
+
+    with self.assertRaises(ValueError):
+      build_replay_query('test_project', 'activation_retry_a')
+
+  def test_build_undelivered_query(self):
+    query = build_undelivered_query('SELECT * FROM `test_project.predictions.scores`', 'test_project', 'logs', 'maj_benchmark')
+
+    self.assertIn('WITH source AS (SELECT * FROM `test_project.predictions.scores`)', query)
+    self.assertIn('FROM `test_project.logs.activation_log*` AS log', query)
+    self.assertIn("JSON_VALUE(event, '$.name') = 'maj_benchmark'", query)
+    # Only the log partitions updated since the earliest inference date are scanned.
+    self.assertIn('log.updated_at >= (SELECT TIMESTAMP(MIN(inference_date)) FROM source)', query)
+    # The client ids are sanitized like the payloads before they are matched.
+    self.assertIn("""REPLACE(source.client_id, '<img onerror="_exploit_dom_xss(20007)', '')""", query)
+    self.assertIn('WHERE delivered.client_id IS NULL', query)
+
+  def test_parse_bool(self):
+    self.assertTrue(parse_bool('true'))
+    self.assertTrue(parse_bool('True'))
+    self.assertTrue(parse_bool('1'))
+    self.assertFalse(parse_bool('false'))
+    self.assertFalse(parse_bool('0'))
+
+    options = activation_options('http://localhost', '--skip_delivered=false').view_as(ActivationOptions)
+    self.assertFalse(options.skip_delivered)
+    options = activation_options('http://localhost', '--skip_delivered').view_as(ActivationOptions)
+    self.assertTrue(options.skip_delivered)
+    options = activation_options('http://localhost', '--batched_transforms=false').view_as(ActivationOptions)
+    self.assertFalse(options.batched_transforms)
+
+  def test_build_replay_run_query(self):
+    self.assertEqual(
+      build_replay_run_query('test_project', 'logs', 'run_a, run_b'),
+      "SELECT DISTINCT payload FROM `test_project.logs.activation_log` "
+      "WHERE run_id IN ('run_a', 'run_b') AND STARTS_WITH(latest_state, 'SEND_FAIL')"
+    )
+
+  def test_to_log_format(self):
+    payload = sample_payload(1)
+
+    payload['events'][0]['params']['value'] = Decimal('1.5')
+    payload['events'][0]['params']['date'] = datetime.date(2023, 2, 25)
+
+    rows = list(ToLogFormat(run_id='test_run').process((payload, 204, b'')))
+
+    self.assertEqual(len(rows), 1)
+    self.assertEqual(rows[0]['activation_id'], 'maj_benchmark')
+    self.assertEqual(json.loads(rows[0]['payload'])['events'][0]['params'], {'p_p_prediction': 'true', 'value': 1.5, 'date': '2023-02-25'})
+    self.assertEqual(rows[0]['latest_state'], 'SEND_OK 204')
+    self.assertEqual(rows[0]['run_id'], 'test_run')
+
+    storage_write_row = to_storage_write_row(rows[0])
+    self.assertIsInstance(storage_write_row['updated_at'], Timestamp)
+    self.assertEqual(
+      storage_write_row['updated_at'].to_utc_datetime(has_tz=True),
+      datetime.datetime.fromisoformat(rows[0]['updated_at'])
+    )
+
+  def test_encode_payload(self):
+    payload = sample_payload(1)
+    payload['events'][0]['params']['value'] = Decimal('1.5')
+    payload['events'][0]['params']['date'] = datetime.date(2023, 2, 25)
+    payload['events'][0]['params']['updated_at'] = datetime.datetime(2023, 2, 25, 10, 30)
+
+    body = encode_payload(payload)
+    with patch('main.orjson', None):
+      fallback_body = encode_payload(payload)
+
+    self.assertEqual(json.loads(body), json.loads(fallback_body))
+    self.assertEqual(json.loads(body)['events'][0]['params']['updated_at'], '2023-02-25T10:30:00')
+
+    # The log row reuses the request body instead of encoding the payload again.
+    rows = list(ToLogFormat().process((payload, 204, b'', b'{"sent":true}')))
+    self.assertEqual(rows[0]['payload'], '{"sent":true}')
+
+  def test_parse_activations(self):
+    options = data(activation_type='cltv-180-30', source_table='ds.cltv', activations=None,
+      activation_type_configuration='gs://bucket/config.json', replay_table=None, replay_run_id=None, input_subscription=None,
+      priority_expression=None, max_events=0, send_deadline_seconds=0)
+    self.assertEqual(parse_activations(options), [('cltv-180-30', 'ds.cltv')])
+
+    options.activations = json.dumps([
+      {'activation_type': 'cltv-180-30', 'source_table': 'ds.cltv'},
+      {'activation_type': 'churn-propensity-30-15', 'source_table': 'ds.churn'},
+      {'activation_type': 'cltv-180-30', 'source_table': 'ds.cltv'},
+    ])
+    options.activation_type = options.source_table = None
+    validate_options(options)
+    self.assertEqual(parse_activations(options), [('cltv-180-30', 'ds.cltv'), ('churn-propensity-30-15', 'ds.churn')])
+
+    for activations in ('not json', '[]', '[{"activation_type": "cltv-180-30"}]'):
+      options.activations = activations
+      with self.assertRaises(ValueError):
+        validate_options(options)
+
+  def test_validate_prioritization_options(self):
+    options = data(activation_type='cltv-180-30', source_table='ds.cltv', activations=None,
+      activation_type_configuration='gs://bucket/config.json', replay_table=None, replay_run_id=None, input_subscription=None,
+      priority_expression='user_prop_p_p_decile ASC', max_events=1000, send_deadline_seconds=0)
+    validate_options(options)
+
+    # A priority expression only ranks the rows kept by the event budget, the deadline ignores it.
+    options.max_events = 0
+    options.send_deadline_seconds = 600
+    with self.assertRaises(ValueError):
+      validate_options(options)
+
+    options.priority_expression = None
+    validate_options(options)
+
+  def test_validate_replay_options(self):
+    options = data(activation_type=None, source_table=None, activations=None, activation_type_configuration=None,
+      replay_table=None, replay_run_id='2024_01_01_1a2b3c4d', input_subscription=None, skip_delivered=False,
+      priority_expression=None, max_events=0, send_deadline_seconds=0)
+    validate_options(options)
+
+    # Replays send the failed payloads of previous runs, the delivered payloads are not looked up.
+    options.skip_delivered = True
+    with self.assertRaises(ValueError):
+      validate_options(options)
+
+  def test_load_activation_type_configurations(self):
+    with tempfile.TemporaryDirectory() as config_dir:
+      files = {
+        'config.json': json.dumps({
+          'a': {'activation_event_name': 'event_a', 'source_query_template': f'file://{config_dir}/shared.sqlx'},
+          'b': {'activation_event_name': 'event_b', 'source_query_template': f'file://{config_dir}/shared.sqlx'},
+          'c': {'activation_event_name': 'event_c', 'source_query_template': f'file://{config_dir}/other.sqlx'},
+        }),
+        'shared.sqlx': 'SELECT *\nFROM {{source_table}}',
+        'other.sqlx': 'SELECT 1 FROM {{source_table}}',
+      }
+      for name, contents in files.items():
+        with open(os.path.join(config_dir, name), 'w') as f:
+          f.write(contents)
+      options = data(project='test_project', activation_type_configuration=f'file://{config_dir}/config.json', source_table=None)
+
+      with patch('main.read_config_file', wraps=read_config_file) as mock_read:
+        configurations = load_activation_type_configurations(options, ['a', 'b'])
+
+    self.assertEqual(sorted(configurations), ['a', 'b'])
+    self.assertEqual(configurations['b']['activation_event_name'], 'event_b')
+    self.assertEqual(build_query(options, configurations['a'], 'ds.table_a'), 'SELECT * FROM ds.table_a')
+    self.assertEqual(mock_read.call_count, 2)
+
+  def test_prediction_event_payloads(self):
+    row = {'client_id': '1.1', 'user_id': None, 'inference_date': '2023-02-25', 'user_prop_p': 'a', 'event_param_e': 'b'}
+    messages = [
+      PubsubMessage(json.dumps(row).encode(), {'activation_type': 'type_a'}),
+      PubsubMessage(json.dumps(dict(row, client_id='2.2')).encode(), {'activation_type': 'type_b'}),
+      PubsubMessage(json.dumps(dict(row, client_id='3.3')).encode(), {}),
+      PubsubMessage(json.dumps(row).encode(), {'activation_type': 'unknown'}),
+      PubsubMessage(b'not json', {'activation_type': 'type_a'}),
+    ]
+
+    with TestPipeline() as p:
+      payloads = prediction_event_payloads(p | beam.Create(messages), {'type_a': 'event_a', 'type_b': 'event_b'}, 'type_a')
+
+      assert_that(
+        payloads | beam.Map(lambda payload: (payload['client_id'], payload['events'][0]['name'], payload['user_properties'])),
+        equal_to([
+          ('1.1', 'event_a', {'p': {'value': 'a'}}),
+          ('2.2', 'event_b', {'p': {'value': 'a'}}),
+          ('3.3', 'event_a', {'p': {'value': 'a'}}),
+        ]))
+
+    self.assertEqual(summarize_metrics(p.result)['counters']['invalid_prediction_events'], 2)
+
+  def test_activate_without_pipeline(self):
+    rows = [{'client_id': f'{i}.1', 'user_id': None, 'inference_date': datetime.date(2023, 2, 25), 'user_prop_p': Decimal('0.5')} for i in range(10)]
+
+    with MeasurementProtocolStandIn() as stand_in:
+      log_rows = activate_without_pipeline(rows, 'event_a', 'G-TEST', 'secret', 'test_run',
+        concurrency=4, endpoint=stand_in.endpoint, initial_send_rate=1e6)
+
+    self.assertEqual(stand_in.request_count, 10)
+    self.assertEqual(sorted(json.loads(row['payload'])['client_id'] for row in log_rows), sorted(row['client_id'] for row in rows))
+    self.assertEqual({(row['activation_id'], row['latest_state'], row['run_id']) for row in log_rows}, {('event_a', 'SEND_OK 204', 'test_run')})
+
+  def test_activate_without_pipeline_request_error(self):
+    rows = [{'client_id': f'{i}.1', 'user_id': None, 'inference_date': datetime.date(2023, 2, 25)} for i in range(4)]
+    send = CallMeasurementProtocolAPI.send
+
+    def send_or_fail(sender, data):
+      if b'"2.1"' in data:
+        raise requests.ConnectionError('Connection reset by peer')
+      return send(sender, data)
+
+    with MeasurementProtocolStandIn() as stand_in, patch.object(CallMeasurementProtocolAPI, 'send', autospec=True, side_effect=send_or_fail):
+      log_rows = activate_without_pipeline(rows, 'event_a', 'G-TEST', 'secret', 'test_run',
+        concurrency=2, endpoint=stand_in.endpoint, initial_send_rate=1e6)
+
+    # The failed request does not prevent the other payloads from being logged.
+    self.assertEqual(stand_in.request_count, 3)
+    self.assertEqual(sorted((json.loads(row['payload'])['client_id'], row['latest_state']) for row in log_rows),
+      [('0.1', 'SEND_OK 204'), ('1.1', 'SEND_OK 204'), ('2.1', 'SEND_FAIL ConnectionError'), ('3.1', 'SEND_OK 204')])
+
+  def test_enforce_payload_limits(self):
+    payload = sample_payload(1)
+    self.assertIs(next(EnforcePayloadLimits().process(payload)), payload)
+
+    payload['user_properties'] = {f'p{i:02}': {'value': 'v'} for i in range(30)}
+    payload['user_properties']['a_user_property_name_too_long'] = {'value': 'v'}
+    payload['events'][0]['params'] = {'long': 'x' * 150, 'number': 10 ** 120, 'a' * 41: 'v'}
+    payload['events'].append({'name': 'e' * 41, 'params': {}})
+
+    limited = next(EnforcePayloadLimits().process(payload))
+
+    self.assertEqual(list(limited['user_properties']), [f'p{i:02}' for i in range(25)])
+    self.assertEqual(limited['events'], [{'name': 'maj_benchmark', 'params': {'long': 'x' * 100, 'number': 10 ** 120}}])
+    self.assertEqual(len(payload['user_properties']), 31)
+    self.assertEqual(list(EnforcePayloadLimits().process(dict(payload, events=[{'name': 'e' * 41, 'params': {}}]))), [])
+
+  def test_oversized_requests(self):
+    payloads = [sample_payload(i) for i in range(4)]
+    for payload in payloads:
+      payload['client_id'] = 'same_client'
+      payload['user_properties'] = {}
+      payload['events'][0]['params']['padding'] = 'x' * 40000
+
+    with MeasurementProtocolStandIn() as stand_in:
+      sender = CallMeasurementProtocolAPIBatch('G-TEST', 'secret', endpoint=stand_in.endpoint, initial_send_rate=1e6)
+      sender.setup()
+      try:
+        outputs = sender.send_element(('same_client', payloads))
+        oversized = dict(payloads[0], events=[dict(payloads[0]['events'][0], params={'padding': 'x' * 140000})])
+        oversized_outputs = sender.send_element(('same_client', [oversized]))
+      finally:
+        sender.teardown()
+
+    # The four 40kB events are split into two requests of two events.
+    self.assertEqual([status for _, status, _, _ in outputs], [204] * 4)
+    self.assertEqual(oversized_outputs[0][1], 413)
+    self.assertEqual(stand_in.request_count, 2)
+
+  def test_send_shards(self):
+    payloads = [sample_payload(i) for i in range(20)]
+
+    with MeasurementProtocolStandIn() as stand_in:
+      options = activation_options(stand_in.endpoint, '--send_shards=4', '--initial_send_rate=1e6')
+      with TestPipeline(options=options) as p:
+        responses = send_to_measurement_protocol(p | beam.Create(payloads), options.view_as(ActivationOptions))
+
+        assert_that(responses | beam.Map(lambda response: (response[0]['client_id'], response[1])),
+          equal_to([(payload['client_id'], 204) for payload in payloads]))
+
+    self.assertEqual(stand_in.request_count, 20)
+    self.assertIn('Reshuffle payloads across workers', str(p.to_runner_api()))
+
+  def test_validate_payload(self):
+    self.assertEqual(validate_payload(sample_payload(1)), [])
+
+    # Dates and timestamps of direct BigQuery reads are valid parameter values, as they are encoded as strings.
+    payload = sample_payload(1)
+    payload['events'][0]['params'].update(day=datetime.date(2023, 2, 25), updated_at=datetime.datetime(2023, 2, 25, 10, 30))
+    self.assertEqual(validate_payload(payload), [])
+
+    payload = sample_payload(1)
+    payload['client_id'] = ''
+    payload['user_properties']['first_open_time'] = {'value': '1'}
+    payload['events'] = [
+      {'name': 'session_start', 'params': {}},
+      {'name': '1st_event', 'params': {'google_source': 'a', 'nested': {'a': 1}, 'items': [{'item_id': 'a'}]}},
+    ]
+
+    self.assertEqual(validate_payload(payload), [
+      "client_id is required and must be a non-empty string",
+      "Invalid user property name 'first_open_time': it is reserved",
+      "Invalid event name 'session_start': it is reserved",
+      "Invalid event name '1st_event': it must start with a letter and contain only letters, digits and underscores",
+      "Invalid parameter name 'google_source': it is reserved",
+      "Invalid value of parameter 'nested': {'a': 1}",
+    ])
+
+  def test_send_and_log_validation(self):
+    invalid_payload = dict(sample_payload(0), events=[{'name': 'session_start', 'params': {}}])
+    payloads = [invalid_payload] + [sample_payload(i) for i in range(1, 5)]
+
+    with MeasurementProtocolStandIn() as stand_in:
+      options = activation_options(stand_in.endpoint, '--validation_sample_rate=1', '--initial_send_rate=1e6')
+      with TestPipeline(options=options) as p:
+        log_rows = send_and_log(p | beam.Create(payloads), options.view_as(ActivationOptions), 'test_run')
+
+        assert_that(log_rows | beam.Map(lambda row: (json.loads(row['payload'])['client_id'], row['latest_state'])),
+          equal_to([(invalid_payload['client_id'], 'SEND_FAIL 400')] + [(sample_payload(i)['client_id'], 'SEND_OK 204') for i in range(1, 5)]))
+
+    # The valid payloads are sent to the validation server and to the collection endpoint, the invalid one is not sent.
+    self.assertEqual(stand_in.status_counts, {200: 4, 204: 4})
+
+  def test_sample_debug_validation_reports_stats(self):
+    with MeasurementProtocolStandIn() as stand_in:
+      validation = SampleDebugValidation('G-TEST', 'secret', 1, endpoint=stand_in.endpoint, initial_send_rate=1e6)
+      validation.setup()
+      try:
+        for i in range(3):
+          self.assertEqual(list(validation.process(sample_payload(i))), [sample_payload(i)])
+      finally:
+        validation.teardown()
+
+    self.assertEqual(stand_in.status_counts, {200: 3})
+    self.assertEqual(len(validation.sender.send_stats), 0)
+    # The validation requests are not counted with the events sent.
+    self.assertEqual(validation.sender.status_counter(200).metric_name.name, 'validation_http_status_200')
+    self.assertEqual(validation.sender.payload_bytes_distribution.metric_name.name, 'validation_payload_bytes')
+
+  def test_sender_gzip_bodies(self):
+    payload = dict(sample_payload(1), user_properties={f'p_{i}': {'value': 'x' * 30} for i in range(25)})
+    body = encode_payload(payload)
+    with MeasurementProtocolStandIn() as stand_in:
+      sender = CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=stand_in.endpoint, gzip_level=6)
+      sender.setup()
+      try:
+        outputs = list(sender.process(payload))
+      finally:
+        sender.teardown()
+
+    # The log keeps the uncompressed body, the stand-in receives the compressed one.
+    self.assertEqual(outputs, [(payload, 204, b'', body)])
+    self.assertEqual(stand_in.bytes_decoded, len(body))
+    self.assertLess(stand_in.bytes_received, len(body) / 2)
+
+  def test_build_priority_query(self):
+    self.assertEqual(
+      build_priority_query('SELECT * FROM `predictions`', 'user_prop_p_p_decile ASC'),
+      "SELECT *, ROW_NUMBER() OVER (ORDER BY user_prop_p_p_decile ASC) AS activation_priority FROM (SELECT * FROM `predictions`)"
+    )
+    self.assertEqual(
+      build_priority_query('SELECT * FROM `predictions`'),
+      "SELECT *, ROW_NUMBER() OVER () AS activation_priority FROM (SELECT * FROM `predictions`)"
+    )
+
+  def test_apply_send_budget(self):
+    rows = [{'client_id': f'c{rank}', 'activation_priority': rank} for rank in range(1, 6)]
+
+    outputs = [output for row in rows for output in ApplySendBudget(3).process(row)]
+
+    self.assertEqual(outputs[:3], rows[:3])
+    self.assertEqual([(output.tag, output.value) for output in outputs[3:]], [('skipped', rows[3]), ('skipped', rows[4])])
+
+  def test_sender_skips_after_deadline(self):
+    with MeasurementProtocolStandIn() as stand_in:
+      sender = CallMeasurementProtocolAPI('G-TEST', 'secret', endpoint=stand_in.endpoint, deadline=0)
+      sender.setup()
+      try:
+        outputs = list(sender.process(sample_payload(1)))
+      finally:
+        sender.teardown()
+
+    self.assertEqual(outputs, [(sample_payload(1), SKIPPED_DEADLINE, b'', encode_payload(sample_payload(1)))])
+    self.assertEqual(stand_in.request_count, 0)
+    self.assertEqual(next(ToLogFormat().process(outputs[0]))['latest_state'], SKIPPED_DEADLINE)
+    self.assertEqual(next(ToLogFormat().process((sample_payload(2), SKIPPED_BUDGET, b'')))['latest_state'], SKIPPED_BUDGET)
+
+  def test_transform_to_payload_batch(self):
+    rows = [sample_row(i, 12) for i in range(10)] + [dict(sample_row(10, 4), inference_date=datetime.date(2023, 2, 26))]
+    transform = TransformToPayload('maj_benchmark')
+    transform.start_bundle()
+    expected = [payload for row in rows for payload in transform.process(row)]
+
+    batch_transform = TransformToPayloadBatch('maj_benchmark')
+    batch_transform.start_bundle()
+    self.assertEqual(list(batch_transform.process_batch(rows)), [expected])
+
+    # Beam buffers the input elements into lists and explodes the output lists for the downstream steps.
+    with TestPipeline() as p:
+      payloads = p | beam.Create(rows) | beam.ParDo(TransformToPayloadBatch('maj_benchmark'))
+      assert_that(payloads, equal_to(expected))
+
+  def test_to_log_format_batch(self):
+    responses = [(sample_payload(1), 204, b''), (sample_payload(2), 500, b''), (sample_payload(3), SKIPPED_BUDGET, b'')]
+
+    rows, = ToLogFormatBatch(run_id='test_run').process_batch(responses)
+
+    self.assertEqual([row['latest_state'] for row in rows], ['SEND_OK 204', 'SEND_FAIL 500', SKIPPED_BUDGET])
+    self.assertEqual([row['payload'] for row in rows], [encode_payload(response[0]).decode('utf-8') for response in responses])
+    self.assertEqual(len({row['id'] for row in rows}), 3)
+    self.assertEqual({row['run_id'] for row in rows}, {'test_run'})
+    self.assertEqual(len({row['updated_at'] for row in rows}), 1)
+
+  def test_batched_transforms_with_events_per_request(self):
+    payloads = [sample_payload(i) for i in range(6)]
+
+    with MeasurementProtocolStandIn() as stand_in:
+      options = activation_options(stand_in.endpoint, '--batched_transforms', '--events_per_request=5', '--initial_send_rate=1e6')
+      # GroupIntoBatches makes the DirectRunner switch to the BundleBasedDirectRunner, which has no batched DoFns.
+      self.assertFalse(use_batched_transforms(options.view_as(ActivationOptions)))
+      # The BundleBasedDirectRunner fires the pane of assert_that before the batches flushed at the end of the window,
+      # so the log states are appended to a file instead.
+      with tempfile.TemporaryDirectory() as output_dir:
+        states_path = os.path.join(output_dir, 'states')
+
+        def append_state(row):
+          with open(states_path, 'a') as states:
+            states.write(row['latest_state'] + '\n')
+
+        with TestPipeline(options=options) as p:
+          log_rows = send_and_log(p | beam.Create(payloads), options.view_as(ActivationOptions), 'test_run')
+          log_rows | beam.Map(append_state)
+        with open(states_path) as states:
+          self.assertEqual(states.read().splitlines(), ['SEND_OK 204'] * 6)
+    self.assertEqual(stand_in.request_count, 6)
+
+    self.assertTrue(use_batched_transforms(activation_options(stand_in.endpoint, '--batched_transforms').view_as(ActivationOptions)))
+    self.assertTrue(use_batched_transforms(activation_options(stand_in.endpoint, '--batched_transforms', '--events_per_request=5',
+      '--runner=DataflowRunner').view_as(ActivationOptions)))
+
+  def test_is_payload_column(self):
+    columns = ['client_id', 'user_id', 'inference_date', 'user_prop_a', 'event_param_b', 'feature_c', 'prediction']
+
+    self.assertEqual(
+      [column for column in columns if is_payload_column(column)],
+      ['client_id', 'user_id', 'inference_date', 'user_prop_a', 'event_param_b']
+    )
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,195 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the cold and warm invocation latency of the trigger_activation Cloud Function.
+
+Every run starts a fresh Python process which loads the function with `functions_framework`, as a new Cloud Functions
+instance does, and posts Pub/Sub CloudEvents to it with the Flask test client. The benchmark process stubs the
+Dataflow Flex Templates client when the function first imports it: the client is created with anonymous credentials
+and `launch_flex_template` returns an empty response, so the launch request is built without being sent, and the
+function keeps paying its own imports and client creation.
+
+Pass `--baseline` with another version of the function, e.g. the one of the baseline commit, to compare both:
+
+  git show $(git rev-list --max-parents=0 HEAD):python/function/trigger_activation/main.py > /tmp/main_baseline.py
+  python benchmark.py --runs 5 --invocations 20 --baseline /tmp/main_baseline.py
+"""
+
+import argparse
+import base64
+import contextlib
+import importlib.abc
+import importlib.util
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+DATAFLOW_MODULE = 'google.cloud.dataflow_v1beta3'
+
+BENCHMARK_ENVIRONMENT = {
+  'ACTIVATION_PROJECT': 'benchmark-project',
+  'ACTIVATION_REGION': 'us-central1',
+  'TEMPLATE_FILE_GCS_LOCATION': 'gs://benchmark-bucket/dataflow/templates/activation-pipeline.json',
+  'GA4_MEASUREMENT_ID': 'G-BENCHMARK',
+  'GA4_MEASUREMENT_SECRET': 'secret',
+  'ACTIVATION_TYPE_CONFIGURATION': 'gs://benchmark-bucket/activation-type-configuration.json',
+  'PIPELINE_TEMP_LOCATION': 'gs://benchmark-bucket/tmp/',
+  'LOG_DATA_SET': 'activation',
+  'PIPELINE_WORKER_EMAIL': 'dataflow-worker@benchmark-project.iam.gserviceaccount.com',
+}
+
+
+class StubDataflowClient(importlib.abc.MetaPathFinder):
+  """
+  Stubs the Dataflow Flex Templates client once its module is imported, so it is not imported ahead of the function.
+  """
+
+  def find_spec(self, name, path, target=None):
+    if name != DATAFLOW_MODULE:
+      return None
+    sys.meta_path.remove(self)
+    spec = importlib.util.find_spec(name)
+    exec_module = spec.loader.exec_module
+
+    def exec_and_stub(module):
+      exec_module(module)
+      stub_client(module)
+
+    spec.loader.exec_module = exec_and_stub
+    return spec
+
+
+def stub_client(module):
+  """
+  Creates the clients of a Dataflow module with anonymous credentials and stubs their launch requests.
+
+  Args:
+    module: The `google.cloud.dataflow_v1beta3` module.
+  """
+  from google.auth.credentials import AnonymousCredentials
+
+  client_class = module.FlexTemplatesServiceClient
+  init = client_class.__init__
+
+  def init_anonymous(self, *args, **kwargs):
+    kwargs.setdefault('credentials', AnonymousCredentials())
+    init(self, *args, **kwargs)
+
+  client_class.__init__ = init_anonymous
+  client_class.launch_flex_template = lambda self, request: module.LaunchFlexTemplateResponse()
+
+
+def invoke(client, message):
+  """
+  Posts a Pub/Sub CloudEvent to the function.
+
+  Args:
+    client: The Flask test client of the function.
+    message: The activation message.
+
+  Returns:
+    The latency of the invocation, in milliseconds.
+  """
+  headers = {
+    'ce-id': '1',
+    'ce-source': '//pubsub.googleapis.com/projects/benchmark-project/topics/activation-trigger',
+    'ce-type': 'google.cloud.pubsub.topic.v1.messagePublished',
+    'ce-specversion': '1.0',
+  }
+  body = {'message': {'data': base64.b64encode(json.dumps(message).encode()).decode()}}
+  start = time.perf_counter()
+  response = client.post('/', headers=headers, json=body)
+  elapsed = (time.perf_counter() - start) * 1000
+  if response.status_code != 200:
+    raise RuntimeError(f"Invocation failed with status {response.status_code}: {response.get_data(as_text=True)}")
+  return elapsed
+
+
+def measure(source, invocations):
+  """
+  Loads the function and invokes it, in the current process.
+
+  Args:
+    source: The path of the main.py file of the function.
+    invocations: The number of warm invocations.
+
+  Returns:
+    A dictionary with the load, cold invocation and warm invocation latencies, in milliseconds.
+  """
+  message = {'activation_type': 'purchase-propensity-30-15', 'source_table': 'purchase_propensity.predictions_view'}
+  sys.meta_path.insert(0, StubDataflowClient())
+  start = time.perf_counter()
+  from functions_framework import create_app
+  app = create_app(target='subscribe', source=source, signature_type='cloudevent')
+  client = app.test_client()
+  load_ms = (time.perf_counter() - start) * 1000
+
+  # The function prints the launch response, which is not part of the result.
+  with contextlib.redirect_stdout(io.StringIO()):
+    cold_ms = invoke(client, message)
+    warm_ms = [invoke(client, message) for _ in range(invocations)]
+  return {'load_ms': load_ms, 'cold_invocation_ms': cold_ms, 'warm_invocation_ms': statistics.median(warm_ms)}
+
+
+def benchmark(source, runs, invocations):
+  """
+  Measures a version of the function in fresh processes.
+
+  Args:
+    source: The path of the main.py file of the function.
+    runs: The number of fresh processes, i.e. of cold starts.
+    invocations: The number of warm invocations per process.
+
+  Returns:
+    A dictionary with the median load, cold invocation, warm invocation and cold start latencies, in milliseconds.
+  """
+  results = []
+  for _ in range(runs):
+    output = subprocess.run(
+      [sys.executable, os.path.abspath(__file__), '--measure', '--source', source, '--invocations', str(invocations)],
+      env=dict(os.environ, **BENCHMARK_ENVIRONMENT), capture_output=True, text=True, check=True).stdout
+    results.append(json.loads(output.strip().splitlines()[-1]))
+
+  summary = {key: round(statistics.median(result[key] for result in results), 1) for key in results[0]}
+  summary['cold_start_ms'] = round(summary['load_ms'] + summary['cold_invocation_ms'], 1)
+  return summary
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--runs', type=int, default=5, help='number of fresh processes, i.e. of cold starts')
+  parser.add_argument('--invocations', type=int, default=20, help='number of warm invocations per process')
+  parser.add_argument('--source', default=MAIN_PATH, help='main.py file of the function to measure')
+  parser.add_argument('--baseline', help='main.py file of another version of the function to compare with')
+  parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.measure:
+    print(json.dumps(measure(args.source, args.invocations)))
+    return
+
+  summary = benchmark(os.path.abspath(args.source), args.runs, args.invocations)
+  if args.baseline:
+    summary = {'baseline': benchmark(os.path.abspath(args.baseline), args.runs, args.invocations), 'current': summary}
+  print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -13,22 +13,341 @@
 # limitations under the License.
 
 import base64
+import functools
 import functions_framework 
+import hashlib
+import importlib.util
 import json
 import os
+import time
 
 from datetime import datetime
-from google.cloud import dataflow_v1beta3
+from types import SimpleNamespace
 
 from google.api_core.gapic_v1.client_info import ClientInfo
+from google.cloud import dataflow_v1beta3
+
+# The Dataflow client library is imported with the module, which Cloud Functions loads when an instance starts, so the
+# first launch does not wait for it. The client libraries used by some invocations only, BigQuery and Cloud Storage,
+# are imported when they are first used.
 
 USER_AGENT_ACTIVATION = 'cloud-solutions/marketing-analytics-jumpstart-activation-v1'
+# Locations of the activation application: packaged next to this file by Terraform, or in the source tree.
+ACTIVATION_PIPELINE_PATHS = (
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'activation_pipeline.py'),
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'activation', 'main.py'),
+)
+# Maximum number of Measurement Protocol requests in flight when activating without Dataflow.
+DIRECT_SEND_CONCURRENCY = 16
+# Optional message fields passed to the activation pipeline to send the highest priority events first within a budget.
+PRIORITIZATION_PARAMETERS = ('priority_expression', 'max_events', 'send_deadline_seconds')
+
+
+@functools.lru_cache(maxsize=1)
+def get_config():
+  """
+  Reads the configuration of the function from the environment variables, once per instance.
+
+  Returns:
+      A namespace with the configuration of the function.
+  """
+  return SimpleNamespace(
+    # ACTIVATION_PROJECT: The Google Cloud project ID.
+    project_id=os.environ.get('ACTIVATION_PROJECT'),
+    # ACTIVATION_REGION: The Google Cloud region where the Dataflow Flex Template will be launched.
+    region=os.environ.get('ACTIVATION_REGION'),
+    # TEMPLATE_FILE_GCS_LOCATION: The Google Cloud Storage location of the Dataflow Flex Template file.
+    template_file_gcs_location=os.environ.get('TEMPLATE_FILE_GCS_LOCATION'),
+    # GA4_MEASUREMENT_ID: The Google Analytics 4 measurement ID.
+    ga4_measurement_id=os.environ.get('GA4_MEASUREMENT_ID'),
+    # GA4_MEASUREMENT_SECRET: The Google Analytics 4 measurement secret.
+    ga4_measurement_secret=os.environ.get('GA4_MEASUREMENT_SECRET'),
+    # ACTIVATION_TYPE_CONFIGURATION: The path to a JSON file containing the configuration for the activation type.
+    activation_type_configuration=os.environ.get('ACTIVATION_TYPE_CONFIGURATION'),
+    # PIPELINE_TEMP_LOCATION: The Google Cloud Storage location for temporary files used by the Dataflow Flex Template.
+    temp_location=os.environ.get('PIPELINE_TEMP_LOCATION'),
+    # LOG_DATA_SET: The BigQuery dataset where the logs of the Dataflow Flex Template will be stored.
+    log_db_dataset=os.environ.get('LOG_DATA_SET'),
+    # PIPELINE_WORKER_EMAIL: The service account email used by the Dataflow Flex Template workers.
+    service_account_email=os.environ.get('PIPELINE_WORKER_EMAIL'),
+    # DIRECT_SEND_MAX_ROWS: The maximum number of rows of a source table activated by the function itself. 0 disables it.
+    direct_send_max_rows=int(os.environ.get('DIRECT_SEND_MAX_ROWS', '0')),
+    # LAUNCH_LEASE_LOCATION: The gs:// prefix, or local directory, where launch leases are stored. Unset disables deduplication.
+    launch_lease_location=os.environ.get('LAUNCH_LEASE_LOCATION'),
+    # LAUNCH_DEDUP_WINDOW_SECONDS: The time during which a launch of the same activation is skipped as a duplicate.
+    launch_dedup_window_seconds=int(os.environ.get('LAUNCH_DEDUP_WINDOW_SECONDS', '3600')),
+  )
+
+
+@functools.lru_cache(maxsize=1)
+def get_dataflow_client():
+  """
+  Creates the Dataflow Flex Templates client, once per instance.
+
+  Returns:
+      A `FlexTemplatesServiceClient`.
+  """
+  return dataflow_v1beta3.FlexTemplatesServiceClient(client_info=ClientInfo(user_agent=USER_AGENT_ACTIVATION))
+
+
+@functools.lru_cache(maxsize=1)
+def get_bigquery_client():
+  """
+  Creates the BigQuery client, once per instance.
+
+  Returns:
+      A BigQuery `Client`.
+  """
+  from google.cloud import bigquery
+
+  return bigquery.Client(project=get_config().project_id)
+
+
+def launch_lease_name(activation_params):
+  """
+  Names the launch lease of an activation, so redelivered messages of the same activation share it.
+
+  Args:
+      activation_params: The Flex Template parameters selecting what the activation job activates.
+
+  Returns:
+      The name of the lease.
+  """
+  return hashlib.sha256(json.dumps(activation_params, sort_keys=True).encode()).hexdigest()
+
+
+def acquire_launch_lease(location, name, window_seconds):
+  """
+  Acquires the launch lease of an activation, unless it was acquired less than `window_seconds` ago.
+
+  Leases are objects created with a generation precondition in Google Cloud Storage, so only one of several concurrent
+  launches acquires a lease. A local directory can be used instead for testing.
+
+  Args:
+      location: The gs://bucket/prefix or the local directory where the leases are stored.
+      name: The name of the lease.
+      window_seconds: The time during which the lease is held.
+
+  Returns:
+      True if the lease was acquired, False if the activation was launched less than `window_seconds` ago.
+  """
+  if location.startswith('gs://'):
+    return _acquire_gcs_lease(location, name, window_seconds)
+  return _acquire_file_lease(location, name, window_seconds)
+
+
+def _acquire_gcs_lease(location, name, window_seconds):
+  """
+  Acquires a launch lease stored in Google Cloud Storage.
+
+  The lease object is created only if it does not exist, or replaced only if it still has the expired
+  generation that was read, so a single launch acquires the lease.
+  """
+  from google.api_core.exceptions import PreconditionFailed
+
+  bucket_name, _, prefix = location[len('gs://'):].partition('/')
+  blob = get_storage_client().bucket(bucket_name).blob(f"{prefix.rstrip('/')}/{name}".lstrip('/'))
+  try:
+    blob.upload_from_string(str(time.time()), if_generation_match=0)
+    return True
+  except PreconditionFailed:
+    pass
+
+  blob.reload()
+  if time.time() - blob.updated.timestamp() < window_seconds:
+    return False
+  try:
+    blob.upload_from_string(str(time.time()), if_generation_match=blob.generation)
+    return True
+  except PreconditionFailed:
+    return False
+
+
+def _acquire_file_lease(location, name, window_seconds):
+  """
+  Acquires a launch lease stored in a local directory, as a stand-in for Google Cloud Storage.
+
+  The lease file is created with O_CREAT | O_EXCL, so a single process creates it. An expired lease is renamed
+  away and removed before the file is created again.
+  """
+  os.makedirs(location, exist_ok=True)
+  path = os.path.join(location, name)
+  try:
+    if time.time() - os.path.getmtime(path) < window_seconds:
+      return False
+    expired_path = f"{path}.{time.time_ns()}.expired"
+    os.rename(path, expired_path)
+    os.remove(expired_path)
+  except FileNotFoundError:
+    pass
+  try:
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    return True
+  except FileExistsError:
+    return False
+
+
+def release_launch_lease(location, name):
+  """
+  Releases the launch lease of an activation whose launch failed, so a redelivered message launches it again.
+
+  Args:
+      location: The gs://bucket/prefix or the local directory where the leases are stored.
+      name: The name of the lease.
+  """
+  if location.startswith('gs://'):
+    from google.api_core.exceptions import NotFound
+
+    bucket_name, _, prefix = location[len('gs://'):].partition('/')
+    try:
+      get_storage_client().bucket(bucket_name).blob(f"{prefix.rstrip('/')}/{name}".lstrip('/')).delete()
+    except NotFound:
+      pass
+  else:
+    try:
+      os.remove(os.path.join(location, name))
+    except FileNotFoundError:
+      pass
+
+
+@functools.lru_cache(maxsize=1)
+def get_storage_client():
+  """
+  Creates the Cloud Storage client, once per instance.
+
+  Returns:
+      A Cloud Storage `Client`.
+  """
+  from google.cloud import storage
+
+  return storage.Client(project=get_config().project_id)
+
+
+@functools.lru_cache(maxsize=1)
+def load_activation_pipeline():
+  """
+  Loads the activation application, so small tables are activated with the same code as the Dataflow pipeline.
+
+  Returns:
+      The activation application module.
+
+  Raises:
+      ImportError: If the activation application cannot be found.
+  """
+  for path in ACTIVATION_PIPELINE_PATHS:
+    if os.path.exists(path):
+      spec = importlib.util.spec_from_file_location('activation_pipeline', path)
+      module = importlib.util.module_from_spec(spec)
+      spec.loader.exec_module(module)
+      return module
+  raise ImportError(f"Activation application not found in {ACTIVATION_PIPELINE_PATHS}")
+
+
+class PartialActivationError(Exception):
+  """
+  Raised when a direct activation fails once its events started to be sent.
+
+  Its launch lease is kept, so the message redelivered by Pub/Sub does not send the same events again.
+  """
+
+
+def activate_directly(project_id, activation_type, source_table, activation_type_configuration,
+    ga4_measurement_id, ga4_measurement_secret, log_db_dataset, max_rows):
+  """
+  Activates a small source table from the function, without paying the startup of a Dataflow job.
+
+  The activation query is only run when the source table is a view or has at most `max_rows` rows. It is limited
+  to `max_rows + 1` rows, so the query of a large view stops early, and its result is only activated when it has
+  at most `max_rows` rows.
+
+  Args:
+      project_id: The Google Cloud project ID.
+      activation_type: The activation type.
+      source_table: The source table, in the format dataset.table.
+      activation_type_configuration: The GCS path to the configuration file for all activation types.
+      ga4_measurement_id: The Google Analytics 4 measurement ID.
+      ga4_measurement_secret: The Google Analytics 4 measurement secret.
+      log_db_dataset: The BigQuery dataset of the activation log table.
+      max_rows: The maximum number of rows activated without Dataflow.
+
+  Returns:
+      True if the source table was activated, False if it must be activated by Dataflow.
+
+  Raises:
+      PartialActivationError: If the activation failed once its events started to be sent.
+  """
+  client = get_bigquery_client()
+  table = client.get_table(source_table)
+  if table.table_type == 'TABLE' and table.num_rows > max_rows:
+    return False
+
+  activation_pipeline = load_activation_pipeline()
+  args = SimpleNamespace(
+    project=project_id,
+    activation_type=activation_type,
+    activation_type_configuration=activation_type_configuration,
+    source_table=source_table
+  )
+  configuration = activation_pipeline.load_activation_type_configuration(args)
+  query = f"SELECT * FROM ({activation_pipeline.build_query(args, configuration)}) LIMIT {max_rows + 1}"
+  rows = client.query(query).result()
+  if rows.total_rows > max_rows:
+    return False
+
+  run_id = activation_pipeline.new_run_id()
+  try:
+    log_rows = activation_pipeline.activate_without_pipeline(
+      (dict(row) for row in rows),
+      configuration['activation_event_name'],
+      ga4_measurement_id,
+      ga4_measurement_secret,
+      run_id,
+      concurrency=DIRECT_SEND_CONCURRENCY
+    )
+    activation_pipeline.load_log_rows(project_id, log_db_dataset, log_rows)
+  except Exception as e:
+    raise PartialActivationError(f"Activation of {source_table} in run {run_id} failed after sending its events") from e
+  print(f"Activated {len(log_rows)} rows of {source_table} without Dataflow in run {run_id}")
+  return True
+
+
+def activation_parameters(message_obj):
+  """
+  Builds the Flex Template parameters selecting what the activation job activates.
+
+  A message with an `activations` list of {"activation_type": ..., "source_table": ...} objects is activated by a
+  single job, which shares the Dataflow startup and the workers between all the activation types.
+
+  Args:
+      message_obj: The parsed Pub/Sub message.
+
+  Returns:
+      A dictionary with either the `activations` parameter or the `activation_type` and `source_table` parameters,
+      and the prioritization parameters set in the message.
+  """
+  if message_obj.get('activations'):
+    activations = [
+      {'activation_type': activation['activation_type'], 'source_table': activation['source_table']}
+      for activation in message_obj['activations']
+    ]
+    activation_params = {'activations': json.dumps(activations)}
+  else:
+    activation_params = {
+      'activation_type': message_obj['activation_type'],
+      'source_table': message_obj['source_table']
+    }
+  # Flex Template parameters are strings.
+  for name in PRIORITIZATION_PARAMETERS:
+    if message_obj.get(name):
+      activation_params[name] = str(message_obj[name])
+  return activation_params
 
 @functions_framework.cloud_event
 def subscribe(cloud_event):
   """
-  This function is triggered by a Pub/Sub message. The message contains the activation type and the source table.
-  The function then launches a Dataflow Flex Template to process the data and send the activation events to GA4.
+  This function is triggered by a Pub/Sub message. The message contains the activation type and the source table,
+  or an `activations` list of activation type and source table pairs to be activated together.
+  The function then launches a single Dataflow Flex Template to process the data and send the activation events to GA4.
   This function demonstrates how to use Cloud Functions to trigger a Dataflow Flex Template based on a Pub/Sub message. 
   This allows for automated processing of data and sending activation events to GA4.
 
@@ -39,52 +358,79 @@ def subscribe(cloud_event):
       None.
   """
 
-  # ACTIVATION_PROJECT: The Google Cloud project ID.
-  project_id = os.environ.get('ACTIVATION_PROJECT')
-  # ACTIVATION_REGION: The Google Cloud region where the Dataflow Flex Template will be launched.
-  region = os.environ.get('ACTIVATION_REGION')
-  # TEMPLATE_FILE_GCS_LOCATION: The Google Cloud Storage location of the Dataflow Flex Template file.
-  template_file_gcs_location = os.environ.get('TEMPLATE_FILE_GCS_LOCATION')
-  # GA4_MEASUREMENT_ID: The Google Analytics 4 measurement ID.
-  ga4_measurement_id = os.environ.get('GA4_MEASUREMENT_ID')
-  # GA4_MEASUREMENT_SECRET: The Google Analytics 4 measurement secret.
-  ga4_measurement_secret = os.environ.get('GA4_MEASUREMENT_SECRET')
-  # ACTIVATION_TYPE_CONFIGURATION: The path to a JSON file containing the configuration for the activation type.
-  activation_type_configuration = os.environ.get('ACTIVATION_TYPE_CONFIGURATION')
-  # PIPELINE_TEMP_LOCATION: The Google Cloud Storage location for temporary files used by the Dataflow Flex Template.
-  temp_location = os.environ.get('PIPELINE_TEMP_LOCATION')
-  # LOG_DATA_SET: The BigQuery dataset where the logs of the Dataflow Flex Template will be stored.
-  log_db_dataset = os.environ.get('LOG_DATA_SET')
-  # PIPELINE_WORKER_EMAIL: The service account email used by the Dataflow Flex Template workers.
-  service_account_email = os.environ.get('PIPELINE_WORKER_EMAIL')
+  config = get_config()
 
   # Decodes the base64 encoded data in the message and parses it as JSON.
-  # It then extracts the activation_type and source_table values from the JSON object.
+  # It then extracts the activation_type and source_table values, or the activations list, from the JSON object.
   message_data = base64.b64decode(cloud_event.data["message"]["data"]).decode()
   message_obj = json.loads(message_data)
 
-  activation_type = message_obj['activation_type']
-  source_table = message_obj['source_table']
+  activation_params = activation_parameters(message_obj)
+
+  # Acknowledges redelivered messages of an activation launched less than LAUNCH_DEDUP_WINDOW_SECONDS ago without launching it again.
+  if not config.launch_lease_location or config.launch_dedup_window_seconds <= 0:
+    launch_activation(config, message_obj, activation_params)
+    return
+  lease_name = launch_lease_name(activation_params)
+  if not acquire_launch_lease(config.launch_lease_location, lease_name, config.launch_dedup_window_seconds):
+    print(f"Skipping duplicate launch of {activation_params}, lease {lease_name} is held")
+    return
+  try:
+    launch_activation(config, message_obj, activation_params)
+  except PartialActivationError:
+    # Keeps the lease of an activation which sent events, as they would be sent again with an unknown outcome.
+    raise
+  except Exception:
+    # Releases the lease of a failed launch, so the message redelivered by Pub/Sub launches the activation again.
+    release_launch_lease(config.launch_lease_location, lease_name)
+    raise
+
+
+def launch_activation(config, message_obj, activation_params):
+  """
+  Activates the source tables of a message, directly for small source tables or with a Dataflow Flex Template.
+
+  Args:
+      config: The configuration of the function.
+      message_obj: The parsed Pub/Sub message.
+      activation_params: The Flex Template parameters selecting what the activation job activates.
+  """
+  # Activates small source tables directly, as the Dataflow job startup would take longer than sending the events.
+  # Prioritized activations are left to the pipeline, which ranks the rows and enforces the budget.
+  prioritized = any(name in activation_params for name in PRIORITIZATION_PARAMETERS)
+  if config.direct_send_max_rows > 0 and 'activations' not in activation_params and not prioritized and activate_directly(
+      config.project_id,
+      activation_params['activation_type'],
+      activation_params['source_table'],
+      config.activation_type_configuration,
+      config.ga4_measurement_id,
+      config.ga4_measurement_secret,
+      config.log_db_dataset,
+      config.direct_send_max_rows):
+    return
 
   # Creates a FlexTemplateRuntimeEnvironment object with the service account email.
-  environment_param = dataflow_v1beta3.FlexTemplateRuntimeEnvironment(service_account_email=service_account_email)
+  environment_param = dataflow_v1beta3.FlexTemplateRuntimeEnvironment(service_account_email=config.service_account_email)
 
   # It then creates a dictionary of parameters for the Dataflow Flex Template, including the project ID, activation type, 
   # activation type configuration, source table, temporary location, GA4 measurement ID, GA4 measurement secret, and log dataset.
   # Finally, it creates a LaunchFlexTemplateParameter object with the job name, container spec GCS path, environment, and parameters.
   parameters = {
-    'project': project_id,
-    'activation_type': activation_type,
-    'activation_type_configuration': activation_type_configuration,
-    'source_table': source_table,
-    'temp_location': temp_location,
-    'ga4_measurement_id': ga4_measurement_id,
-    'ga4_api_secret': ga4_measurement_secret,
-    'log_db_dataset': log_db_dataset
+    'project': config.project_id,
+    'activation_type_configuration': config.activation_type_configuration,
+    'temp_location': config.temp_location,
+    'ga4_measurement_id': config.ga4_measurement_id,
+    'ga4_api_secret': config.ga4_measurement_secret,
+    'log_db_dataset': config.log_db_dataset,
+    **activation_params
   }
+  if 'activations' in activation_params:
+    job_suffix = f"{len(message_obj['activations'])}-types"
+  else:
+    job_suffix = activation_params['activation_type'].replace('_','-')
   flex_template_param = dataflow_v1beta3.LaunchFlexTemplateParameter(
-    job_name=f"activation-pipeline-{activation_type.replace('_','-')}-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
-    container_spec_gcs_path=template_file_gcs_location,
+    job_name=f"activation-pipeline-{job_suffix}-{datetime.now().strftime('%Y%m%d-%H%M%S')}",
+    container_spec_gcs_path=config.template_file_gcs_location,
     environment=environment_param,
     parameters=parameters
   )
@@ -92,11 +438,10 @@ def subscribe(cloud_event):
   # Creates a LaunchFlexTemplateRequest object with the project ID, region, and launch parameter.
   # It then uses the FlexTemplatesServiceClient to launch the Dataflow Flex Template.
   request = dataflow_v1beta3.LaunchFlexTemplateRequest(
-    project_id=project_id,
-    location=region,
+    project_id=config.project_id,
+    location=config.region,
     launch_parameter=flex_template_param
   )
-  client = dataflow_v1beta3.FlexTemplatesServiceClient(client_info=ClientInfo(user_agent=USER_AGENT_ACTIVATION))
-  response = client.launch_flex_template(request=request)
+  response = get_dataflow_client().launch_flex_template(request=request)
 
   print(response)
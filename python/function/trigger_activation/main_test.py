@@ -0,0 +1,181 @@
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import json
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from main import acquire_launch_lease, release_launch_lease, launch_lease_name, subscribe
+from main import activate_directly, activation_parameters, PartialActivationError
+
+
+def cloud_event(message_obj):
+  return SimpleNamespace(data={'message': {'data': base64.b64encode(json.dumps(message_obj).encode())}})
+
+
+def config(lease_location):
+  return SimpleNamespace(launch_lease_location=lease_location, launch_dedup_window_seconds=3600)
+
+
+class LaunchLeaseTest(unittest.TestCase):
+
+  def setUp(self):
+    self.lease_location = tempfile.mkdtemp()
+
+  def test_acquire_lease(self):
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    self.assertTrue(os.path.exists(os.path.join(self.lease_location, 'lease')))
+
+  def test_duplicate_lease(self):
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    self.assertFalse(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'other_lease', 3600))
+
+  def test_expired_lease(self):
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    expired = time.time() - 3601
+    os.utime(os.path.join(self.lease_location, 'lease'), (expired, expired))
+
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    self.assertFalse(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    self.assertEqual(os.listdir(self.lease_location), ['lease'])
+
+  def test_release_lease(self):
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+    release_launch_lease(self.lease_location, 'lease')
+    release_launch_lease(self.lease_location, 'lease')
+
+    self.assertTrue(acquire_launch_lease(self.lease_location, 'lease', 3600))
+
+  def test_release_lease_on_failure(self):
+    message_obj = {'activation_type': 'purchase-propensity-30-15', 'source_table': 'dataset.predictions'}
+    lease_name = launch_lease_name(message_obj)
+
+    with patch('main.get_config', return_value=config(self.lease_location)), \
+        patch('main.launch_activation', side_effect=RuntimeError('Launch failed')) as launch_activation:
+      with self.assertRaises(RuntimeError):
+        subscribe(cloud_event(message_obj))
+      self.assertFalse(os.path.exists(os.path.join(self.lease_location, lease_name)))
+
+      # The redelivered message launches the activation again.
+      launch_activation.side_effect = None
+      subscribe(cloud_event(message_obj))
+      self.assertTrue(os.path.exists(os.path.join(self.lease_location, lease_name)))
+
+      # Further redeliveries are skipped while the lease is held.
+      subscribe(cloud_event(message_obj))
+      self.assertEqual(launch_activation.call_count, 2)
+
+
+  def test_keep_lease_after_partial_activation(self):
+    message_obj = {'activation_type': 'purchase-propensity-30-15', 'source_table': 'dataset.predictions'}
+
+    with patch('main.get_config', return_value=config(self.lease_location)), \
+        patch('main.launch_activation', side_effect=PartialActivationError('Send failed')) as launch_activation:
+      with self.assertRaises(PartialActivationError):
+        subscribe(cloud_event(message_obj))
+      self.assertTrue(os.path.exists(os.path.join(self.lease_location, launch_lease_name(message_obj))))
+
+      # The redelivered message does not send the events again.
+      subscribe(cloud_event(message_obj))
+      self.assertEqual(launch_activation.call_count, 1)
+
+
+class ActivateDirectlyTest(unittest.TestCase):
+
+  def activate(self, table_type, num_rows, query_rows, max_rows=10):
+    client = MagicMock()
+    client.get_table.return_value = SimpleNamespace(table_type=table_type, num_rows=num_rows)
+    client.query.return_value.result.return_value = MagicMock(total_rows=len(query_rows), __iter__=lambda _: iter(query_rows))
+    activation_pipeline = MagicMock()
+    activation_pipeline.load_activation_type_configuration.return_value = {'activation_event_name': 'purchase_propensity_30_15'}
+    activation_pipeline.build_query.return_value = 'SELECT * FROM dataset.predictions_view'
+    activation_pipeline.activate_without_pipeline.side_effect = lambda rows, *args, **kwargs: [{'row': row} for row in rows]
+    with patch('main.get_bigquery_client', return_value=client), patch('main.load_activation_pipeline', return_value=activation_pipeline):
+      activated = activate_directly('project', 'purchase-propensity-30-15', 'dataset.predictions_view', 'gs://bucket/config.json',
+        'G-TEST', 'secret', 'activation', max_rows)
+    return activated, client, activation_pipeline
+
+  def test_table_under_threshold(self):
+    activated, client, activation_pipeline = self.activate('TABLE', 2, [{'client_id': '1'}, {'client_id': '2'}])
+
+    self.assertTrue(activated)
+    self.assertEqual(client.query.call_args[0][0], 'SELECT * FROM (SELECT * FROM dataset.predictions_view) LIMIT 11')
+    activation_pipeline.load_log_rows.assert_called_once_with('project', 'activation', [{'row': {'client_id': '1'}}, {'row': {'client_id': '2'}}])
+
+  def test_table_over_threshold(self):
+    activated, client, activation_pipeline = self.activate('TABLE', 11, [])
+
+    # The size of a table is read from its metadata, without running the activation query.
+    self.assertFalse(activated)
+    client.query.assert_not_called()
+    activation_pipeline.activate_without_pipeline.assert_not_called()
+
+  def test_view_under_threshold(self):
+    activated, client, activation_pipeline = self.activate('VIEW', 0, [{'client_id': str(i)} for i in range(10)])
+
+    self.assertTrue(activated)
+    self.assertEqual(len(activation_pipeline.load_log_rows.call_args[0][2]), 10)
+
+  def test_view_over_threshold(self):
+    activated, client, activation_pipeline = self.activate('VIEW', 0, [{'client_id': str(i)} for i in range(11)])
+
+    # The query of a view is limited to one row over the threshold before falling back to Dataflow.
+    self.assertFalse(activated)
+    self.assertTrue(client.query.call_args[0][0].endswith('LIMIT 11'))
+    activation_pipeline.activate_without_pipeline.assert_not_called()
+
+  def test_partial_activation(self):
+    client = MagicMock()
+    client.get_table.return_value = SimpleNamespace(table_type='TABLE', num_rows=1)
+    client.query.return_value.result.return_value = MagicMock(total_rows=1, __iter__=lambda _: iter([{'client_id': '1'}]))
+    activation_pipeline = MagicMock()
+    activation_pipeline.load_log_rows.side_effect = RuntimeError('Load job failed')
+    with patch('main.get_bigquery_client', return_value=client), patch('main.load_activation_pipeline', return_value=activation_pipeline):
+      with self.assertRaises(PartialActivationError):
+        activate_directly('project', 'purchase-propensity-30-15', 'dataset.predictions', 'gs://bucket/config.json',
+          'G-TEST', 'secret', 'activation', 10)
+
+
+class ActivationParametersTest(unittest.TestCase):
+
+  def test_activation_type_and_source_table(self):
+    self.assertEqual(
+      activation_parameters({'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view', 'extra': 'ignored'}),
+      {'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view'}
+    )
+
+  def test_activations(self):
+    activations = [{'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view', 'extra': 'ignored'}]
+    self.assertEqual(
+      activation_parameters({'activations': activations}),
+      {'activations': json.dumps([{'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view'}])}
+    )
+
+  def test_prioritization_parameters(self):
+    self.assertEqual(
+      activation_parameters({'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view',
+        'priority_expression': 'user_prop_p_p_decile ASC', 'max_events': 1000, 'send_deadline_seconds': 0}),
+      {'activation_type': 'cltv-180-30', 'source_table': 'dataset.cltv_view',
+        'priority_expression': 'user_prop_p_p_decile ASC', 'max_events': '1000'}
+    )
+
+
+if __name__ == '__main__':
+  unittest.main()